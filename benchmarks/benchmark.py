@@ -0,0 +1,871 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Micro benchmarks for the ble_gateway pipeline.
+# Not part of the installed package, run from the repository root with:
+#   python -m benchmarks.benchmark <benchmark> [options]
+# Use --help to list available benchmarks.
+#
+
+import argparse
+import os
+import queue
+import random
+import struct
+import sys
+import time
+from multiprocessing import Process, Queue
+
+from ble_gateway import decode, defs, helpers, prefilter, ringbuffer
+
+
+def print_latencies(title, latencies):
+    # latencies in seconds, recorded to a Histogram in nanoseconds so that
+    # the numbers are computed the same way as the runtime stats
+    histogram = helpers.Histogram()
+    for latency in latencies:
+        histogram.record(int(latency * 1e9))
+    print("{:<28} n={:<6} {}".format(title, histogram.count, histogram.summary()))
+
+
+# -----------------------------------------------------------------------------
+# wakeup: decoder_q consumer wake-up latency and idle CPU usage
+# -----------------------------------------------------------------------------
+def _wakeup_producer(q, count, gap):
+    for i in range(count):
+        time.sleep(gap)
+        q.put(time.perf_counter())
+    q.put(defs.STOPMESSAGE)
+
+
+def _wakeup_consumer(q, busy_poll):
+    latencies = []
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    while True:
+        if busy_poll:
+            # The old way: spin on get_nowait()
+            try:
+                data = q.get_nowait()
+            except queue.Empty:
+                continue
+        else:
+            try:
+                data = q.get(timeout=defs.MAX_QUEUE_WAIT)
+            except queue.Empty:
+                continue
+        if data == defs.STOPMESSAGE:
+            break
+        latencies.append(time.perf_counter() - data)
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    return latencies, 100.0 * cpu / wall
+
+
+def bench_wakeup(args):
+    print(
+        "Wake-up latency for {} messages sent every {} secs:".format(
+            args.count, args.gap
+        )
+    )
+    for busy_poll in (True, False):
+        q = Queue()
+        producer = Process(target=_wakeup_producer, args=(q, args.count, args.gap))
+        producer.start()
+        latencies, cpu_percent = _wakeup_consumer(q, busy_poll)
+        producer.join()
+        title = "get_nowait() busy-poll" if busy_poll else "blocking get(timeout)"
+        print_latencies(title, latencies)
+        print("{:<28} consumer CPU {:.1f}%".format("", cpu_percent))
+
+
+# -----------------------------------------------------------------------------
+# ipc: frames per second from BLE process to decoder, per-frame vs batched puts
+# -----------------------------------------------------------------------------
+# A RuuviTag data format 5 advertisement as received from the HCI socket
+RUUVI_DF5_FRAME = bytes.fromhex(
+    "043e2b02010001"
+    "45c369f7b6da"
+    "1f"
+    "0201061bff9904"
+    "0512fc5394c37c0004fffc040cac364200cdcbb8334c884f"
+    "c5"
+)
+
+
+def _ipc_producer(q, count, batch_size):
+    batch = []
+    for i in range(count):
+        batch.append(RUUVI_DF5_FRAME)
+        if len(batch) >= batch_size:
+            q.put(batch)
+            batch = []
+    if batch:
+        q.put(batch)
+    q.put(defs.STOPMESSAGE)
+
+
+def bench_ipc(args):
+    print("Sending {} frames thru multiprocessing.Queue:".format(args.count))
+    for batch_size in sorted({1, args.batch}):
+        q = Queue()
+        producer = Process(target=_ipc_producer, args=(q, args.count, batch_size))
+        t_start = time.perf_counter()
+        producer.start()
+        frames = 0
+        while True:
+            data = q.get()
+            if data == defs.STOPMESSAGE:
+                break
+            frames += len(data)
+        elapsed = time.perf_counter() - t_start
+        producer.join()
+        print(
+            "batch size {:<4} {:>10.0f} frames/sec".format(batch_size, frames / elapsed)
+        )
+
+
+# -----------------------------------------------------------------------------
+# transport: multiprocessing.Queue vs shared memory ring buffer
+# -----------------------------------------------------------------------------
+# Frames carry send time (perf_counter_ns) in their last 8 bytes
+_STAMP = struct.Struct("<Q")
+
+
+def _transport_producer(q, ring, count, batch_size, gap):
+    batch = []
+    for i in range(count):
+        frame = RUUVI_DF5_FRAME + _STAMP.pack(time.perf_counter_ns())
+        if ring is None:
+            batch.append(frame)
+        else:
+            while not ring.put(frame):
+                time.sleep(0)  # Wait for consumer to make room
+            batch.append(None)
+        if len(batch) >= batch_size:
+            if ring is None:
+                q.put(batch)
+            else:
+                ring.commit()
+            batch = []
+            if gap:
+                time.sleep(gap)
+    if batch:
+        q.put(batch) if ring is None else ring.commit()
+    if ring is not None:
+        ring.close()
+
+
+def _transport_run(count, batch_size, gap, use_ring):
+    q = Queue()
+    ring = ringbuffer.RingBuffer() if use_ring else None
+    receive = ring.get if ring is not None else q.get
+    producer = Process(
+        target=_transport_producer, args=(q, ring, count, batch_size, gap)
+    )
+    latencies = []
+    t_start = time.perf_counter()
+    producer.start()
+    while len(latencies) < count:
+        frames = receive(timeout=5)
+        now = time.perf_counter_ns()
+        for frame in frames:
+            latencies.append((now - _STAMP.unpack_from(frame, len(frame) - 8)[0]) / 1e9)
+        if ring is not None:
+            ring.release()
+    elapsed = time.perf_counter() - t_start
+    producer.join()
+    if ring is not None:
+        ring.close()
+        ring.unlink()
+    return count / elapsed, latencies
+
+
+def bench_transport(args):
+    if ringbuffer.shared_memory is None:
+        print("multiprocessing.shared_memory not available.")
+        return
+    print("{} frames in batches of {}:".format(args.count, args.batch))
+    for use_ring in (False, True):
+        name = "shm ring buffer" if use_ring else "multiprocessing.Queue"
+        fps, latencies = _transport_run(args.count, args.batch, 0, use_ring)
+        print("{:<22} {:>10.0f} frames/sec (max rate)".format(name, fps))
+        fps, latencies = _transport_run(args.count, args.batch, args.gap, use_ring)
+        print_latencies("{} latency with {} sec gaps".format(name, args.gap), latencies)
+
+
+# -----------------------------------------------------------------------------
+# ruuvi: raw frame fast path vs aioblescan based RuuviTag decoding
+# -----------------------------------------------------------------------------
+# Test vectors from RuuviTag data format specifications (payload after 0x0499)
+RUUVI_TEST_PAYLOADS = [
+    "0512FC5394C37C0004FFFC040CAC364200CDCBB8334C884F",  # DF5 valid
+    "057FFFFFFEFFFE7FFF7FFF7FFFFFDEFEFFFECBB8334C884F",  # DF5 max
+    "058001000000008001800180010000000000CBB8334C884F",  # DF5 min
+    "03291A1ECE1EFC18F94202CA0B53",  # DF3 valid
+    "03FF7F63FFFF7FFF7FFF7FFFFFFF",  # DF3 max
+    "03FFFF630000800180018001FFFF",  # DF3 min
+]
+
+
+def make_adv_frame(peer, adv_data, rssi=-60):
+    # Build raw HCI LE advertising report from peer address bytes
+    # (as in frame) and advertising data
+    params = bytes([0x02, 0x01, 0x00, 0x01]) + peer + bytes([len(adv_data)])
+    params += adv_data + bytes([rssi & 0xFF])
+    return bytes([0x04, 0x3E, len(params)]) + params
+
+
+def make_ruuvi_frame(peer, payload, rssi=-60):
+    mfg = b"\x99\x04" + payload
+    adv_data = bytes.fromhex("020106") + bytes([len(mfg) + 1, 0xFF]) + mfg
+    return make_adv_frame(peer, adv_data, rssi)
+
+
+def ruuvi_corpus(count, seed=1):
+    # Test vectors and random DF3/DF5 frames, some of them malformed
+    rnd = random.Random(seed)
+    peers = [bytes(rnd.randrange(256) for i in range(6)) for j in range(10)]
+    corpus = [make_ruuvi_frame(peers[0], bytes.fromhex(p)) for p in RUUVI_TEST_PAYLOADS]
+    while len(corpus) < count:
+        fmt = rnd.choice([3, 5])
+        length = (14 if fmt == 3 else 24) - (rnd.random() < 0.05)
+        payload = bytes([fmt]) + bytes(rnd.randrange(256) for i in range(length - 1))
+        corpus.append(
+            make_ruuvi_frame(rnd.choice(peers), payload, rnd.randrange(-100, 0))
+        )
+    return corpus
+
+
+def bench_ruuvi(args):
+    corpus = ruuvi_corpus(args.count)
+    fast = decode.Decoder(fast_path=True, negative_cache_ttl=0)
+    slow = decode.Decoder(fast_path=False, negative_cache_ttl=0)
+    for decoder in (fast, slow):
+        decoder.enable_fixed_decoders(["ruuviraw"])
+
+    # Verify that fast path gives identical results
+    mismatches = 0
+    for frame in corpus:
+        expected = slow.run(frame)
+        got = fast.run(frame)
+        if got != expected or list(got) != list(expected):
+            mismatches += 1
+            print("MISMATCH:", frame.hex(), expected, got)
+    print(
+        "{} frames, {} decoded with fast path, {} mismatches.".format(
+            len(corpus), fast.fast_count, mismatches
+        )
+    )
+
+    results = {}
+    for name, decoder in (("aioblescan", slow), ("fast path", fast)):
+        t_start = time.perf_counter()
+        for frame in corpus:
+            decoder.run(frame)
+        results[name] = (time.perf_counter() - t_start) / len(corpus)
+        print("{:<12} {:8.2f} usecs per frame".format(name, 1e6 * results[name]))
+    print("Speedup {:.1f}x".format(results["aioblescan"] / results["fast path"]))
+
+
+# -----------------------------------------------------------------------------
+# ruuvibatch: Decoder.run_batch() with numpy vs run() one frame at a time
+# -----------------------------------------------------------------------------
+def bench_ruuvibatch(args):
+    from ble_gateway import ruuvitagbatch
+
+    if ruuvitagbatch.np is None:
+        print("numpy not available.")
+        return
+    # Only well formed frames, the aioblescan decoder can't decode short ones
+    corpus = [
+        f
+        for f in ruuvi_corpus(args.count)
+        if decode.Decoder.ruuvitagraw.decode_frame(f)
+    ]
+    results = {}
+    for name in ("run()", "run_batch()"):
+        decoder = decode.Decoder(negative_cache_ttl=0)
+        decoder.enable_fixed_decoders(["ruuviraw"])
+        t_start = time.perf_counter()
+        if name == "run()":
+            mesgs = [decoder.run(frame) for frame in corpus]
+        else:
+            mesgs = []
+            for i in range(0, len(corpus), args.batch):
+                mesgs.extend(decoder.run_batch(corpus[i : i + args.batch]))
+        results[name] = ((time.perf_counter() - t_start) / len(corpus), mesgs)
+
+    mismatches = 0
+    for frame, expected, got in zip(
+        corpus, results["run()"][1], results["run_batch()"][1]
+    ):
+        if got != expected or list(got) != list(expected):
+            mismatches += 1
+            if mismatches <= 10:
+                print("MISMATCH:", frame.hex(), expected, got)
+    print(
+        "{} frames in batches of {}, {} mismatches.".format(
+            len(corpus), args.batch, mismatches
+        )
+    )
+    for name, (secs, mesgs) in results.items():
+        print("{:<18} {:8.2f} usecs per frame".format(name, 1e6 * secs))
+    print("Speedup {:.1f}x".format(results["run()"][0] / results["run_batch()"][0]))
+
+
+# -----------------------------------------------------------------------------
+# dispatch: decoders [all] with pinned decoders and negative cache
+# -----------------------------------------------------------------------------
+def mixed_corpus(count):
+    # Ruuvi frames mixed with frames from other devices no decoder knows
+    rnd = random.Random(2)  # Not the seed of ruuvi_corpus, to get other macs
+    ruuvi = ruuvi_corpus(count // 2)
+    others = [bytes(rnd.randrange(256) for i in range(6)) for j in range(50)]
+    corpus = []
+    for frame in ruuvi:
+        corpus.append(frame)
+        mfg = b"\x4c\x00" + bytes(rnd.randrange(256) for i in range(20))
+        adv_data = bytes.fromhex("020106") + bytes([len(mfg) + 1, 0xFF]) + mfg
+        corpus.append(make_adv_frame(rnd.choice(others), adv_data))
+    return corpus
+
+
+def bench_dispatch(args):
+    corpus = mixed_corpus(args.count)
+    results = {}
+    for ttl in (0, 60):
+        decoder = decode.Decoder(negative_cache_ttl=ttl)
+        decoder.enable_fixed_decoders(["all"])
+        t_start = time.perf_counter()
+        decoded = sum(1 for frame in corpus if "mac" in decoder.run(frame))
+        results[ttl] = (time.perf_counter() - t_start) / len(corpus)
+        print(
+            "negative_cache_ttl={:<3} {:8.2f} usecs per frame, {} frames decoded.".format(
+                ttl, 1e6 * results[ttl], decoded
+            )
+        )
+        decoder.print_stats()
+    print("Speedup {:.1f}x".format(results[0] / results[60]))
+
+
+# -----------------------------------------------------------------------------
+# pool: decoding throughput with 1..N decoder worker processes
+# -----------------------------------------------------------------------------
+def bench_pool(args):
+    from ble_gateway import config_management, run_decoder
+
+    # Scan mode config where every frame is decoded and sent to writers,
+    # frames of unknown devices are tried with all decoders every time
+    config = config_management.Configuration()
+    config.update_config(
+        {
+            defs.C_SEC_COMMON: {
+                "mode": defs.SCANMODE,
+                "decode": ["all", "unknown"],
+                "negative_cache_ttl": 0,
+            }
+        },
+        True,
+    )
+    corpus = mixed_corpus(args.count)
+    print("Decoding {} frames, batch size {}:".format(len(corpus), args.batch))
+    results = {}
+    for workers in range(1, args.workers + 1):
+        writers_q = Queue()
+        pool = run_decoder.DecoderPool(config, writers_q, workers)
+        pool.start()
+        time.sleep(0.5)  # Let workers start up
+        t_start = time.perf_counter()
+        for i in range(0, len(corpus), args.batch):
+            for frame in corpus[i : i + args.batch]:
+                pool.put(frame)
+            pool.flush()
+        for i in range(len(corpus)):
+            writers_q.get()
+        results[workers] = len(corpus) / (time.perf_counter() - t_start)
+        pool.stop()
+        print(
+            "{} workers {:>10.0f} frames/sec, {:.1f}x".format(
+                workers, results[workers], results[workers] / results[1]
+            )
+        )
+
+
+# -----------------------------------------------------------------------------
+# transform: per message source and destination modifications in writers
+# -----------------------------------------------------------------------------
+TRANSFORM_SOURCE = {
+    "fields_remove": ["decoder", "tx_power"],
+    "fields_rename": ["acceleration_x=accelerationX", "acceleration_y=accelerationY"],
+    "fields_add": ["location=Ulkona", "sensor=ruuvi"],
+    "values_uppercase": ["mac"],
+    "fields_order": ["timestamp", "mac"],
+}
+TRANSFORM_DESTINATION = {
+    "fields_rename": ["temperature=temp"],
+    "fields_add": ["site=home"],
+}
+
+
+def _legacy_modify_packet(mesg, mconfig):
+    # Modifications as they were done before transform plans:
+    # configuration strings are parsed for every message
+    for f in mconfig.get("fields_remove", []):
+        if f in mesg:
+            mesg.pop(f)
+    for f in mconfig.get("fields_rename", []):
+        (t, v) = f.split("=")
+        if t and v and t in mesg:
+            mesg[v] = mesg.pop(t)
+    for f in mconfig.get("fields_add", []):
+        (t, v) = f.split("=")
+        if t and v:
+            mesg[t] = v
+    for f in mconfig.get("values_uppercase", []):
+        if f in mesg and isinstance(mesg[f], str):
+            mesg[f] = mesg[f].upper()
+    ordered_fields = {}
+    for f in mconfig.get("fields_order", []):
+        if f in mesg:
+            ordered_fields[f] = mesg.pop(f)
+    return {**ordered_fields, **mesg}
+
+
+def bench_transform(args):
+    from ble_gateway import writers
+
+    decoder = decode.Decoder()
+    decoder.enable_fixed_decoders(["ruuviraw"])
+    mesg = decoder.run(RUUVI_DF5_FRAME)
+    mesg["timestamp"] = time.time()
+    legacy_mesg = mesg.to_dict()  # Messages were dicts
+
+    def before():
+        m = writers.Writer().modify_packet(
+            legacy_mesg.copy(), {}
+        )  # Writer() per message
+        m = _legacy_modify_packet(m, TRANSFORM_SOURCE)
+        return _legacy_modify_packet(m.copy(), TRANSFORM_DESTINATION)
+
+    plan = writers.TransformPlan(TRANSFORM_SOURCE) + writers.TransformPlan(
+        TRANSFORM_DESTINATION
+    )
+
+    def after():
+        return plan.apply_to_copy(mesg)
+
+    expected = before()
+    got = after()
+    print("Results are {}.".format("identical" if expected == got else "DIFFERENT"))
+    if list(expected) != list(got):
+        print("Field order differs:", list(expected), list(got))
+
+    results = {}
+    for name, func in (("before", before), ("after", after)):
+        t_start = time.perf_counter()
+        for i in range(args.count):
+            func()
+        results[name] = (time.perf_counter() - t_start) / args.count
+        print("{:<8} {:8.2f} usecs per message".format(name, 1e6 * results[name]))
+    print("Speedup {:.1f}x".format(results["before"] / results["after"]))
+
+
+# -----------------------------------------------------------------------------
+# lineprotocol: InfluxDB line protocol serialization, lines per second
+# -----------------------------------------------------------------------------
+def _legacy_influx_line(mesg, measurement, tags):
+    # writers.influx_line() before lineprotocol.LineSerializer
+    mesg["timestamp"] = int(mesg["timestamp"] * 1000)
+    timestamp = mesg.pop("timestamp")
+    tag_set = []
+    for tag in tags:
+        if tag in mesg:
+            tag_set.append("{}={}".format(tag, mesg.pop(tag)))
+    tag_set.sort()
+    fields = []
+    for field, value in mesg.items():
+        if isinstance(value, int):
+            fields.append("{}={}i".format(field, value))
+        else:
+            fields.append("{}={}".format(field, value))
+    return "{measurement},{tags} {fields} {timestamp}".format(
+        measurement=measurement,
+        tags=",".join(tag_set),
+        fields=",".join(fields),
+        timestamp=timestamp,
+    )
+
+
+def bench_lineprotocol(args):
+    from ble_gateway import lineprotocol
+
+    decoder = decode.Decoder()
+    decoder.enable_fixed_decoders(["ruuviraw"])
+    mesg = decoder.run(RUUVI_DF5_FRAME)
+    tags = ["mac", "location", "decoder"]
+    rng = random.Random(1)
+    macs = [
+        ":".join("{:02x}".format(rng.randrange(256)) for i in range(6))
+        for n in range(20)
+    ]
+    messages = []
+    for i in range(args.count):
+        m = mesg.copy()
+        m["mac"] = macs[i % len(macs)]
+        m["location"] = "Ulkona" if i % 2 else "Olohuone"
+        m["timestamp"] = time.time()
+        messages.append(m)
+    serializer = lineprotocol.LineSerializer("ruuvi", tags)
+    legacy_messages = [m.to_dict() for m in messages]  # Messages were dicts
+    print("Before:", _legacy_influx_line(legacy_messages[0].copy(), "ruuvi", tags))
+    print("After: ", serializer.line(messages[0]))
+
+    def before():
+        data = [_legacy_influx_line(m.copy(), "ruuvi", tags) for m in legacy_messages]
+        return "\n".join(data).encode()
+
+    def after():
+        return serializer.serialize(messages)
+
+    results = {}
+    for name, func in (("before", before), ("after", after)):
+        t_start = time.perf_counter()
+        for i in range(max(1, 100000 // max(1, args.count))):
+            func()
+        elapsed = time.perf_counter() - t_start
+        results[name] = (i + 1) * args.count / elapsed
+        print("{:<8} {:10.0f} lines/sec".format(name, results[name]))
+    print("Speedup {:.1f}x".format(results["after"] / results["before"]))
+
+
+# -----------------------------------------------------------------------------
+# file: FileWriter formats, messages per second
+# -----------------------------------------------------------------------------
+def bench_file(args):
+    import tempfile
+
+    from ble_gateway import writers
+
+    decoder = decode.Decoder()
+    decoder.enable_fixed_decoders(["ruuviraw"])
+    mesg = decoder.run(RUUVI_DF5_FRAME)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for fmt in ("repr", "jsonl", "csv"):
+            filename = os.path.join(tmpdir, "bench." + fmt)
+            writer = writers.FileWriter(
+                fmt,
+                {
+                    "filename": filename,
+                    "format": fmt,
+                    "batch": args.batch,
+                    "fsync_interval": 1,
+                },
+            )
+            t_start = time.perf_counter()
+            for i in range(args.count):
+                m = mesg.copy()
+                m["timestamp"] = time.time()
+                writer.send(m)
+            writer.close()
+            elapsed = time.perf_counter() - t_start
+            print(
+                "{:<8} {:>10.0f} messages/sec, {:.0f} bytes per message".format(
+                    fmt, args.count / elapsed, os.path.getsize(filename) / args.count
+                )
+            )
+
+
+# -----------------------------------------------------------------------------
+# measurement: dict vs Measurement messages, memory and time from decoder
+# to line protocol
+# -----------------------------------------------------------------------------
+def _legacy_decode(decoder, frame):
+    # Decoder.run_fast() before Measurement, a new dict per message
+    decoded = decoder.ruuvitagraw.decode_frame(frame)
+    mesg = {
+        "decoder": "ruuviraw",
+        "rssi": decoded[0],
+        "mac": decoder.get_mac(prefilter.peer_bytes(frame)),
+    }
+    mesg.update(decoded[1])
+    return mesg
+
+
+def bench_measurement(args):
+    import tracemalloc
+
+    from ble_gateway import lineprotocol, writers
+
+    decoder = decode.Decoder(negative_cache_ttl=0)
+    decoder.enable_fixed_decoders(["ruuviraw"])
+    corpus = [
+        f for f in ruuvi_corpus(args.count) if decoder.ruuvitagraw.decode_frame(f)
+    ]
+    plans = [
+        writers.TransformPlan(TRANSFORM_SOURCE) + writers.TransformPlan(destination)
+        for destination in (TRANSFORM_DESTINATION, {"fields_remove": ["rssi"]})
+    ]
+    serializer = lineprotocol.LineSerializer("ruuvi", ["mac", "location", "site"])
+
+    def pipeline(decode_frame):
+        # Decode, timestamp, modify for each destination and buffer all,
+        # then serialize buffered messages
+        buffers = [[] for plan in plans]
+        for frame in corpus:
+            mesg = decode_frame(frame)
+            mesg["timestamp"] = time.time()
+            for plan, buffer in zip(plans, buffers):
+                buffer.append(plan.apply_to_copy(mesg))
+        return [serializer.lines(buffer) for buffer in buffers], buffers
+
+    setups = (
+        ("dict", lambda frame: _legacy_decode(decoder, frame)),
+        ("Measurement", decoder.run),
+    )
+    print("{} messages to 2 destinations:".format(len(corpus)))
+    results = {}
+    for name, decode_frame in setups:
+        pipeline(decode_frame)  # Warm up caches
+        tracemalloc.start()
+        held = [decode_frame(frame) for frame in corpus]
+        held_bytes = tracemalloc.get_traced_memory()[0]
+        del held
+        base = tracemalloc.get_traced_memory()[0]
+        lines, buffers = pipeline(decode_frame)
+        buffered_bytes = tracemalloc.get_traced_memory()[0] - base
+        tracemalloc.stop()
+        del lines, buffers
+
+        t_start = time.perf_counter()
+        pipeline(decode_frame)
+        elapsed = (time.perf_counter() - t_start) / len(corpus)
+        results[name] = (held_bytes, buffered_bytes, elapsed)
+        print(
+            "{:<12} {:6.0f} bytes per decoded message, {:6.0f} bytes per message "
+            "buffered in pipeline, {:6.2f} usecs per message".format(
+                name,
+                held_bytes / len(corpus),
+                buffered_bytes / len(corpus),
+                1e6 * elapsed,
+            )
+        )
+    print(
+        "Measurement uses {:.0f}% of dict memory when decoded, {:.1f}x faster.".format(
+            100 * results["Measurement"][0] / results["dict"][0],
+            results["dict"][2] / results["Measurement"][2],
+        )
+    )
+
+
+# -----------------------------------------------------------------------------
+# wire: writers_q message encoding, pickle vs struct packed
+# -----------------------------------------------------------------------------
+class _ListQueue(list):
+    put = list.append
+
+
+def bench_wire(args):
+    import pickle
+
+    from ble_gateway import wireformat
+
+    decoder = decode.Decoder(negative_cache_ttl=0)
+    decoder.enable_fixed_decoders(["ruuviraw"])
+    messages = [decoder.run(frame) for frame in ruuvi_corpus(args.count)]
+    messages = [m for m in messages if "mac" in m]
+
+    def pickle_round():
+        # multiprocessing.Queue pickles each message separately
+        sent = [pickle.dumps(m) for m in messages]
+        return sent, [pickle.loads(data) for data in sent]
+
+    wire_q = _ListQueue()
+    writer = wireformat.WireWriter(wire_q)
+    reader = wireformat.WireReader()
+
+    def struct_round(unpack=True):
+        del wire_q[:]
+        for m in messages:
+            writer.put(m)
+        sent = [pickle.dumps(data) for data in wire_q]  # bytes are pickled too
+        received = []
+        for data in map(pickle.loads, sent):
+            if type(data) is bytes:
+                reader.mac(data)  # Interval is checked first
+                if unpack:
+                    data = reader.unpack(data)
+            else:
+                reader.register(data)
+            received.append(data)
+        return sent, received
+
+    sent, received = struct_round()
+    same = all(
+        a == b and list(a) == list(b)
+        for a, b in zip(messages, [m for m in received if type(m) is not tuple])
+    )
+    print(
+        "{} messages, struct results are {}.".format(
+            len(messages), "identical" if same else "DIFFERENT"
+        )
+    )
+    results = {}
+    for name, func in (
+        ("pickle", pickle_round),
+        ("struct", struct_round),
+        ("struct mac only", lambda: struct_round(unpack=False)),
+    ):
+        t_start = time.perf_counter()
+        sent, received = func()
+        elapsed = time.perf_counter() - t_start
+        results[name] = len(messages) / elapsed
+        print(
+            "{:<16} {:6.1f} bytes per message {:>10.0f} messages/sec".format(
+                name, sum(map(len, sent)) / len(messages), results[name]
+            )
+        )
+    print("Speedup {:.1f}x".format(results["struct"] / results["pickle"]))
+
+
+# -----------------------------------------------------------------------------
+# influx: points per second to a local stand-in InfluxDB HTTP server
+# -----------------------------------------------------------------------------
+def _influx_stand_in(port, delay, points, ready):
+    import gzip
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            if not (
+                self.path.startswith("/write?")
+                or self.path.startswith("/api/v2/write?")
+            ):
+                self.send_response(404)
+            else:
+                with points.get_lock():
+                    points.value += len(body.splitlines())
+                time.sleep(delay)  # Simulated network and database latency
+                self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    ready.set()
+    server.serve_forever()
+
+
+def bench_influx(args):
+    from multiprocessing import Event, Value
+
+    from ble_gateway import writers
+
+    port = 18086
+    points = Value("q", 0)
+    ready = Event()
+    server = Process(target=_influx_stand_in, args=(port, args.gap, points, ready))
+    server.daemon = True
+    server.start()
+    ready.wait(5)
+
+    decoder = decode.Decoder()
+    decoder.enable_fixed_decoders(["ruuviraw"])
+    mesg = decoder.run(RUUVI_DF5_FRAME)
+    common = {
+        "measurement": "ruuvi",
+        "tags": ["mac", "decoder"],
+        "batch": args.batch,
+        "database": "bench",
+    }
+    url = "http://127.0.0.1:{}".format(port)
+    setups = [
+        ("influxdb", writers.InfluxDBWriter, {"host": "127.0.0.1", "port": port}),
+        ("influxdb_http v1", writers.InfluxDBHTTPWriter, {"url": url, "gzip": False}),
+        ("influxdb_http v1 gzip", writers.InfluxDBHTTPWriter, {"url": url}),
+        (
+            "influxdb_http v2 gzip",
+            writers.InfluxDBHTTPWriter,
+            {"url": url, "version": 2, "org": "o", "bucket": "b", "token": "t"},
+        ),
+    ]
+    print(
+        "Writing {} points in batches of {}, server latency {} secs:".format(
+            args.count, args.batch, args.gap
+        )
+    )
+    for name, cls, wconfig in setups:
+        writer = cls(name, {**common, **wconfig})
+        points.value = 0
+        t_start = time.perf_counter()
+        for i in range(args.count):
+            m = mesg.copy()
+            m["timestamp"] = time.time()
+            writer.send(m)
+        writer.close()
+        elapsed = time.perf_counter() - t_start
+        print(
+            "{:<24} {:>10.0f} points/sec, {} points received".format(
+                name, args.count / elapsed, points.value
+            )
+        )
+    server.terminate()
+
+
+BENCHMARKS = {
+    "wakeup": (bench_wakeup, "decoder_q wake-up latency and idle CPU usage"),
+    "ipc": (bench_ipc, "BLE to decoder throughput, per-frame vs batched puts"),
+    "transport": (bench_transport, "Queue vs shared memory ring buffer transport"),
+    "ruuvi": (bench_ruuvi, "RuuviTag fast path vs aioblescan decoding"),
+    "ruuvibatch": (bench_ruuvibatch, "RuuviTag numpy batch vs single decoding"),
+    "dispatch": (bench_dispatch, "Decoder dispatch with pinning and negative cache"),
+    "pool": (bench_pool, "Decoding throughput with 1..N decoder workers"),
+    "transform": (bench_transform, "Writers message modifications per message"),
+    "influx": (bench_influx, "InfluxDB writers to a local stand-in server"),
+    "wire": (bench_wire, "writers_q messages pickled vs struct packed"),
+    "measurement": (bench_measurement, "dict vs Measurement memory and speed"),
+    "file": (bench_file, "FileWriter formats to a temporary file"),
+    "lineprotocol": (bench_lineprotocol, "InfluxDB line protocol serialization"),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BLE Gateway micro benchmarks")
+    parser.add_argument(
+        "benchmark",
+        choices=list(BENCHMARKS.keys()),
+        help=", ".join("{}: {}".format(k, v[1]) for k, v in BENCHMARKS.items()),
+    )
+    parser.add_argument(
+        "-n", "--count", type=int, default=200, help="Number of messages to use."
+    )
+    parser.add_argument(
+        "--gap",
+        type=float,
+        default=0.01,
+        help="Seconds between messages for latency benchmarks.",
+    )
+    parser.add_argument(
+        "--batch", type=int, default=32, help="Batch size for batched benchmarks."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Max number of worker processes for scaling benchmarks.",
+    )
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark][0](args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
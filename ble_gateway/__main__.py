@@ -2,13 +2,23 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import functools
 import os
 import queue
 import sys
 from multiprocessing import Event, Process, Queue
-from time import sleep
+from time import monotonic, sleep
 
-from ble_gateway import config_management, decode, defs, helpers, run_ble, run_writers
+from ble_gateway import (
+    config_management,
+    defs,
+    helpers,
+    metrics,
+    ringbuffer,
+    run_ble,
+    run_decoder,
+    run_writers,
+)
 
 
 def define_cmd_line_arguments(parser, defaults_dict):
@@ -22,6 +32,14 @@ def define_cmd_line_arguments(parser, defaults_dict):
         else:
             raise argparse.ArgumentTypeError("%s is not a MAC address" % val)
 
+    # helper func to parse device number or comma separated device numbers
+    def device_list(val):
+        try:
+            devices = [int(d) for d in val.split(",")]
+        except ValueError:
+            raise argparse.ArgumentTypeError("%s is not a device number" % val)
+        return devices if len(devices) > 1 else devices[0]
+
     #
     # !! Use lowercase and no whitespaces in parameter names !!
     #
@@ -123,9 +141,10 @@ def define_cmd_line_arguments(parser, defaults_dict):
     parser.add_argument(
         "-D",
         "--device",
-        type=int,
+        type=device_list,
         default=defaults_dict[defs.C_SEC_COMMON].get("device"),
-        help="Select the hciX device to use (default 0, i.e. hci0).",
+        help="Select the hciX device to use (default 0, i.e. hci0). \
+        Several devices can be given separated by commas, e.g. 0,1.",
     )
     parser.add_argument(
         "--simulator",
@@ -142,6 +161,28 @@ def define_cmd_line_arguments(parser, defaults_dict):
         default=defaults_dict[defs.C_SEC_COMMON].get("max_mesgs"),
         help="Receive max N messgaes and exit.",
     )
+    parser.add_argument(
+        "--record",
+        metavar="FILE",
+        type=str,
+        default=defaults_dict[defs.C_SEC_COMMON].get("record"),
+        help="Append raw frames received from BLE to capture FILE.",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="FILE",
+        type=str,
+        default=defaults_dict[defs.C_SEC_COMMON].get("replay"),
+        help="Replay frames of capture FILE instead of real bluetooth hardware\
+        and exit.",
+    )
+    parser.add_argument(
+        "--replay_speed",
+        metavar="N",
+        type=str,
+        default=defaults_dict[defs.C_SEC_COMMON].get("replay_speed"),
+        help="Replay N times faster than recorded, max = as fast as possible.",
+    )
 
 
 # EOF add_cmd_line_arguments
@@ -187,6 +228,117 @@ def setup_configuration(config):
     config.print()
 
 
+def make_ring(config):
+    # Optionally raw frames from BLE are passed thru shared memory instead of queue
+    if config.TRANSPORT != "shm" or config.SIMULATOR:
+        return None
+    try:
+        return ringbuffer.RingBuffer(config.RING_SIZE, config.RECEIVE_TIMES)
+    except (RuntimeError, OSError) as e:
+        print("Shared memory transport not available: {}".format(e))
+        print("Using queue transport instead.")
+        return None
+
+
+def make_ble_process(config, QUIT_BLE_EVENT, decoder_q, ring, pipeline_metrics):
+    # Setup BLE subprocess (either simulator or real hardware)
+    if config.SIMULATOR:
+        # Run BLE simulator instead of real hardware
+        from ble_gateway import ble_simulator
+
+        return Process(
+            target=ble_simulator.run_simulator, args=(config, QUIT_BLE_EVENT, decoder_q)
+        )
+    if config.REPLAY:
+        # Replay recorded frames instead of real hardware
+        from ble_gateway import ble_simulator
+
+        return Process(
+            target=ble_simulator.run_replay,
+            args=(config, QUIT_BLE_EVENT, decoder_q, ring, pipeline_metrics),
+        )
+    # Setup real BLE process
+    return Process(
+        target=run_ble.run_ble,
+        args=(config, QUIT_BLE_EVENT, decoder_q, ring, pipeline_metrics),
+    )
+
+
+def serve_metrics(main_metrics, decoder_q, writers_q, ring):
+    # Serve metrics with queue depths sampled when they are read
+    def publish_queue_depths():
+        depths = {"decoder_q": decoder_q.qsize(), "writers_q": writers_q.qsize()}
+        if ring is not None:
+            depths["ring_bytes"] = ring.pending_bytes()
+        main_metrics.publish("queue_depth", depths)
+
+    sample_queues = None
+    try:
+        writers_q.qsize()
+        sample_queues = publish_queue_depths
+    except NotImplementedError:  # e.g. macOS
+        pass
+    main_metrics.serve(sample_queues)
+
+
+def receive_from_ring(ring, decoder_q, timeout=None):
+    # Next batch of frames from ring buffer. STOPMESSAGE comes thru
+    # decoder_q, it is sent only after all frames in ring are released.
+    try:
+        return ring.get(timeout=timeout)
+    except queue.Empty:
+        return decoder_q.get_nowait()
+
+
+def make_receive(ring, decoder_q):
+    # Function to receive next batch of frames from BLE with timeout
+    if ring is None:
+        return decoder_q.get
+    return functools.partial(receive_from_ring, ring, decoder_q)
+
+
+def unpack_batch(config, data, ring=None):
+    # (frames, adapter numbers or None, reception times or None) of a batch.
+    # With several adapters frames come with adapter numbers and,
+    # if needed, with reception times.
+    if ring is not None:
+        return (
+            data,
+            ring.tags if len(config.DEVICES) > 1 else None,
+            ring.times if config.RECEIVE_TIMES else None,
+        )
+    if isinstance(data, tuple):
+        return data
+    return data, None, None
+
+
+def print_timer_stats(my_timer):
+    print("{} messages received for decode.".format(my_timer.get_count()))
+    print(
+        "Average time for decoding a message was {} usecs.".format(
+            my_timer.get_average() * 1000 * 1000
+        )
+    )
+    print(
+        "Max time for decoding a message was {} usecs.".format(
+            my_timer.MAX_SPLIT * 1000 * 1000
+        )
+    )
+    print("Time for decoding a message: {}.".format(my_timer.summary()))
+
+
+def print_summary(main_metrics, my_timer, next_summary):
+    # Print metrics summary every metrics_interval seconds,
+    # returns monotonic() time of next summary
+    if next_summary is None or monotonic() < next_summary:
+        return next_summary
+    print(main_metrics.summary())
+    print(
+        "Time for decoding a message in main: {}.".format(my_timer.interval().summary())
+    )
+    return monotonic() + main_metrics.interval
+
+
 def main():
 
     # Create configuration object with built-in default configuration parameters
@@ -198,45 +350,56 @@ def main():
     writers_q = Queue()
     QUIT_BLE_EVENT = Event()
 
-    # Setup writers subprocess
-    writers_process = Process(target=run_writers.run_writers, args=(config, writers_q))
+    ring = make_ring(config)
+    # Function to receive next batch of frames from BLE
+    receive = make_receive(ring, decoder_q)
 
-    # Setup BLE subprocess (either simulator or real hardware)
-    if config.SIMULATOR:
-        # Run BLE simulator instead of real hardware
-        from ble_gateway import ble_simulator
+    # Counters of all processes are kept in shared memory
+    pipeline_metrics = metrics.Metrics.from_config(config)
 
-        ble_process = Process(
-            target=ble_simulator.run_simulator, args=(config, QUIT_BLE_EVENT, decoder_q)
-        )
-    else:
-        # Setup real BLE process
-        ble_process = Process(
-            target=run_ble.run_ble, args=(config.DEVICE, QUIT_BLE_EVENT, decoder_q)
-        )
+    # Setup writers subprocess
+    writers_process = Process(
+        target=run_writers.run_writers, args=(config, writers_q, pipeline_metrics)
+    )
+    ble_process = make_ble_process(
+        config, QUIT_BLE_EVENT, decoder_q, ring, pipeline_metrics
+    )
 
     print("--------- Running in {} mode ------------".format(config.MODE))
     ble_process.start()
     writers_process.start()
 
-    decoder = decode.Decoder()
-    if config.MODE == defs.SCANMODE:
-        decoder.enable_fixed_decoders(config.DECODE)
-    else:
-        decoder.enable_per_mac_decoders(config.SOURCES)
-
     # Main loop here -- implementing event/signal handler to break out of it??
     # If no messages received from BLE_process for >no_messgae_timeout seconds
     # we'll break out from the loop, do clenup and exit main loop
     my_timer = helpers.StopWatch(config.find_by_key("no_messages_timeout", 60))
+
+    # Decode in this process or in a pool of decoder worker processes
+    frame_decoder = run_decoder.FrameDecoder(
+        config, writers_q, my_timer, pipeline_metrics
+    )
+
+    main_metrics = metrics.bind(pipeline_metrics, metrics.MAIN)
+    next_summary = None
+    if main_metrics is not None:
+        serve_metrics(main_metrics, decoder_q, writers_q, ring)
+        if main_metrics.interval:
+            next_summary = monotonic() + main_metrics.interval
+
     # MAIN LOOP START -----------------------------------------------------------
-    while writers_process.is_alive() and ble_process.is_alive():
+    while (
+        writers_process.is_alive()
+        and ble_process.is_alive()
+        and frame_decoder.is_alive()
+    ):
         # DECODE START ---------------------------------------------
-        # Read decoder queue
+        # Block on decoder queue until a message arrives, timeout expires,
+        # frames held by dedup are ready or it's time to check that
+        # subprocesses are still alive
+        wait = frame_decoder.time_to_ready(my_timer.time_left(defs.MAX_QUEUE_WAIT))
         try:
-            data = decoder_q.get_nowait()
+            data = receive(timeout=wait)
         except queue.Empty:
-            data = None
             if my_timer.is_timeout():
                 print(
                     "Time out! No messages received from BLE for",
@@ -244,45 +407,35 @@ def main():
                     "seconds.",
                 )
                 break
+            data = []
 
-        if data:  # got data, let's decode it
-            my_timer.start()  # Reset wait timer
+        if data == defs.STOPMESSAGE:
+            print("STOP message received from ble_process.")
+            break
 
-            if data == defs.STOPMESSAGE:
-                print("STOP message received from ble_process.")
-                break
-            mesg = decoder.run(data, simulator=config.SIMULATOR)
-            if "mac" in mesg and (
-                not config.ALLOWED_MACS or mesg["mac"] in config.ALLOWED_MACS
-            ):
-                # Send decoded message to writers
-                writers_q.put(mesg)
-                if config.SHOWRAW:
-                    print("Raw data: {}".format(data))
-
-            my_timer.split()
-
-            if config.MAX_MESGS and config.MAX_MESGS <= my_timer.get_count():
-                print("Max message limit reached!")
-                break
+        # Got a batch of frames, let's decode them
+        max_reached = frame_decoder.decode_batch(*unpack_batch(config, data, ring))
+        if ring is not None and data:
+            ring.release()  # Frames are processed, free space in ring buffer
+
+        if main_metrics is not None and main_metrics.publish_due():
+            frame_decoder.publish_metrics()
+            next_summary = print_summary(main_metrics, my_timer, next_summary)
+        if max_reached:
+            break
 
         # DECODE STOP ---------------------------------------------
     # MAIN LOOP STOP -----------------------------------------------------------
 
+    # Decode frames still held by dedup, also if max message limit was reached
+    frame_decoder.release_held()
+
     # Stop subprocesses and cleanup
     print("Closing main.")
-    print("{} messages received for decode.".format(my_timer.get_count()))
-    print(
-        "Average time for decoding a message was {} usecs.".format(
-            my_timer.get_average() * 1000 * 1000
-        )
-    )
-    print(
-        "Max time for decoding a message was {} usecs.".format(
-            my_timer.MAX_SPLIT * 1000 * 1000
-        )
-    )
+    print_timer_stats(my_timer)
+    frame_decoder.print_stats()
     QUIT_BLE_EVENT.set()
+    frame_decoder.stop()
     writers_q.put(defs.STOPMESSAGE)
     sleep(1)
     while not decoder_q.empty():
@@ -291,8 +444,20 @@ def main():
         writers_q.get(block=True, timeout=0.05)
     ble_process.join()
     writers_process.join()
+    if main_metrics is not None:
+        frame_decoder.publish_metrics()
+        print(main_metrics.summary())
+        main_metrics.close()
+    if ring is not None:
+        if ring.dropped:
+            print("{} frames dropped, ring buffer was full.".format(ring.dropped))
+        ring.close()
+        ring.unlink()
 
     exit_code = config.SIMULATOR
+    if config.REPLAY:
+        # Don't restart, replay is done
+        exit_code = max(1, my_timer.get_count())
     if config.MAX_MESGS:
         exit_code = config.MAX_MESGS
     return exit_code
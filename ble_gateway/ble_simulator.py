@@ -1,7 +1,7 @@
 import random
-from time import sleep
+from time import sleep, time
 
-from ble_gateway import decode
+from ble_gateway import capture, decode, run_ble
 
 
 def random_mac():
@@ -32,8 +32,22 @@ def run_simulator(config, QUIT_BLE_EVENT, decoder_q):
         mesg["simutemp"] = round(random.randint(0, 400) / 10 - 20, 2)
         mesg["simuhumid"] = round(random.randint(0, 200) / 10 + 20, 2)
         mesg["_simulated_data_"] = random.randint(0, 100)
-        decoder_q.put(mesg)
+        # decoder expects batches of messages
+        if config.RECEIVE_TIMES:
+            decoder_q.put(([mesg], None, [time()]))
+        else:
+            decoder_q.put([mesg])
         sleep(random.randint(5, 50) / 100)
         packetcount += 1
 
     print("Closing simulator.")
+
+
+# Replay frames of capture file recorded with --record, at recorded pace
+# times replay_speed or as fast as possible. Frames go thru run_ble, so
+# they are filtered, batched, decoded and written as received frames.
+def run_replay(config, QUIT_BLE_EVENT, decoder_q, ring=None, pipeline_metrics=None):
+    source = capture.Replayer(config.REPLAY, config.REPLAY_SPEED)
+    return run_ble.run_ble(
+        config, QUIT_BLE_EVENT, decoder_q, ring, pipeline_metrics, source
+    )
@@ -0,0 +1,133 @@
+#
+# Capture files of raw HCI frames, for recording frames received by
+# run_ble and replaying them later instead of BLE adapters.
+#
+# File starts with MAGIC and format version (1 byte), followed by a record
+# for each frame:
+#   time.time_ns() when received (8 bytes), adapter (1 byte),
+#   frame length (2 bytes), frame
+# Recording appends to an existing capture file.
+#
+
+import os
+import struct
+import time
+
+MAGIC = b"BLEGWCAP"
+VERSION = 1
+_FILE_HEADER = struct.Struct("<8sB")
+_RECORD = struct.Struct("<qBH")
+
+
+def _check_header(f, filename):
+    header = f.read(_FILE_HEADER.size)
+    if len(header) < _FILE_HEADER.size or _FILE_HEADER.unpack(header)[0] != MAGIC:
+        raise ValueError("{} is not a capture file".format(filename))
+    version = _FILE_HEADER.unpack(header)[1]
+    if version != VERSION:
+        raise ValueError(
+            "{}: unsupported capture file version {}".format(filename, version)
+        )
+
+
+class CaptureWriter:
+    # Appends frames to capture file
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.count = 0
+        if os.path.exists(filename) and os.path.getsize(filename):
+            with open(filename, "rb") as f:
+                _check_header(f, filename)
+        self.f = open(filename, "ab")
+        if not self.f.tell():
+            self.f.write(_FILE_HEADER.pack(MAGIC, VERSION))
+
+    def write(self, frame, adapter=0, t_ns=None):
+        if t_ns is None:
+            t_ns = time.time_ns()
+        self.f.write(_RECORD.pack(t_ns, adapter & 0xFF, len(frame)) + bytes(frame))
+        self.count += 1
+
+    def close(self):
+        self.f.close()
+        print("{} frames recorded to {}.".format(self.count, self.filename))
+
+
+def read_capture(filename):
+    # Yields (time in ns, adapter, frame) of frames in capture file.
+    # Incomplete last record, e.g. if recording was killed, is skipped.
+    with open(filename, "rb") as f:
+        _check_header(f, filename)
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            t_ns, adapter, length = _RECORD.unpack(header)
+            frame = f.read(length)
+            if len(frame) < length:
+                return
+            yield t_ns, adapter, frame
+
+
+def parse_speed(speed):
+    # Replay speed factor, 0 = as fast as possible ("max")
+    if speed in (None, "", "max"):
+        return 0.0
+    speed = float(speed)
+    if speed < 0:
+        raise ValueError("Replay speed must not be negative")
+    return speed
+
+
+class Replayer:
+    """
+    Feeds frames of a capture file to callback(frame, adapter) in an
+    asyncio event loop instead of BLE adapters. Frames are fed at the
+    pace they were recorded, speed times faster, or, with speed 0, as
+    fast as possible in chunks of CHUNK frames, so that other callbacks
+    of the loop get to run. done() is called when all frames are fed.
+    """
+
+    CHUNK = 256
+
+    def __init__(self, filename, speed=1.0):
+        self.filename = filename
+        self.speed = parse_speed(speed)
+        self.records = read_capture(filename)
+        self.count = 0
+
+    def start(self, event_loop, callback, done):
+        self.loop = event_loop
+        self.callback = callback
+        self.done = done
+        self._start = None  # (loop time, capture time in ns) of first frame
+        self._next = next(self.records, None)
+        print(
+            "Replaying {} at {}.".format(
+                self.filename,
+                "{}x speed".format(self.speed) if self.speed else "max speed",
+            )
+        )
+        event_loop.call_soon(self._feed)
+
+    def _feed(self):
+        n = 0
+        while self._next is not None:
+            t_ns, adapter, frame = self._next
+            if self.speed:
+                if self._start is None:
+                    self._start = (self.loop.time(), t_ns)
+                due = self._start[0] + (t_ns - self._start[1]) / 1e9 / self.speed
+                if due > self.loop.time():
+                    self.loop.call_at(due, self._feed)
+                    return
+            elif n >= self.CHUNK:
+                self.loop.call_soon(self._feed)
+                return
+            self.callback(frame, adapter)
+            self.count += 1
+            n += 1
+            self._next = next(self.records, None)
+        print("{} frames replayed from {}.".format(self.count, self.filename))
+        self.done()
@@ -33,7 +33,38 @@ class Configuration:
         self.SHOWRAW = self.find_by_key("showraw", False)
         self.SIMULATOR = self.find_by_key("simulator", 0)
         self.DEVICE = self.find_by_key("device", 0)
+        if isinstance(self.DEVICE, (list, tuple)):
+            self.DEVICES = [int(d) for d in self.DEVICE]
+            self.DEVICE = self.DEVICES[0] if self.DEVICES else -1
+        else:
+            self.DEVICES = [int(self.DEVICE)]
         self.MAX_MESGS = self.find_by_key("max_mesgs", 0)
+        self.RECORD = self.find_by_key("record", "")
+        self.REPLAY = self.find_by_key("replay", "")
+        self.REPLAY_SPEED = self.find_by_key("replay_speed", 1.0)
+        self.IPC_BATCH_SIZE = self.find_by_key("ipc_batch_size", 1)
+        self.IPC_BATCH_DELAY = self.find_by_key("ipc_batch_delay", 0)
+        self.TRANSPORT = self.find_by_key("transport", "queue")
+        self.RING_SIZE = self.find_by_key("ring_size", 1024 * 1024)
+        self.PREFILTER = self.find_by_key("prefilter", "main")
+        self.MANUFACTURER_IDS = self.find_by_key("manufacturer_ids", [])
+        self.THROTTLE = self.find_by_key("throttle", "none")
+        self.NEGATIVE_CACHE_TTL = self.find_by_key("negative_cache_ttl", 60)
+        self.DEDUP = self.find_by_key("dedup", "none")
+        self.DEDUP_TTL = self.find_by_key("dedup_ttl", 1.0)
+        self.DEDUP_MAX_ENTRIES = self.find_by_key("dedup_max_entries", 10000)
+        self.DEDUP_KEEP_BEST_RSSI = self.find_by_key("dedup_keep_best_rssi", False)
+        self.DEDUP_WINDOW = self.find_by_key("dedup_window", 0.05)
+        self.DECODER_WORKERS = self.find_by_key("decoder_workers", 0)
+        self.BATCH_DECODE = self.find_by_key("batch_decode", False)
+        self.WRITERS_Q_FORMAT = self.find_by_key("writers_q_format", "pickle")
+        self.METRICS_PORT = self.find_by_key("metrics_port", 0)
+        self.METRICS_ADDRESS = self.find_by_key("metrics_address", "127.0.0.1")
+        self.METRICS_INTERVAL = self.find_by_key("metrics_interval", 0)
+        self.TRACE = self.find_by_key("trace", False)
+        self.TIMESTAMP_SOURCE = self.find_by_key("timestamp_source", "writer")
+        # Reception times of frames are carried to writers process
+        self.RECEIVE_TIMES = bool(self.TRACE) or self.TIMESTAMP_SOURCE == "received"
 
         if self.SIMULATOR:
             self.SIMUMACS = list(self.SOURCES.keys())
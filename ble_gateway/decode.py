@@ -1,7 +1,10 @@
+import time
+
 import aioblescan as aiobs
 from aioblescan.plugins import BlueMaestro, EddyStone
 
-from ble_gateway import helpers
+from ble_gateway import helpers, prefilter, ruuvitagbatch
+from ble_gateway.measurement import Measurement, Schema
 from ble_gateway.ruuvitagraw import RuuviTagRaw
 from ble_gateway.ruuvitagurl import RuuviTagUrl
 
@@ -22,37 +25,62 @@ def packet_info(ev):
 
 
 class Decoder:
+    ruuvitagraw = RuuviTagRaw()
     all_decoders = {
         "pebble": BlueMaestro().decode,
-        "ruuviraw": RuuviTagRaw().decode,
+        "ruuviraw": ruuvitagraw.decode,
         "ruuviurl": RuuviTagUrl().decode,
         "eddy": EddyStone().decode,
     }
 
-    def __init__(self):
+    MAX_CACHED_MACS = 10000
+    NEGATIVE_CACHE_AFTER = 3  # Consecutive frames all decoders failed to decode
+    # Schema of messages which were not decoded and first keys of fast path
+    NOT_DECODED = Schema.of(("decoder",))
+    FAST_KEYS = ("decoder", "rssi", "mac")
+
+    def __init__(self, fast_path=True, negative_cache_ttl=60):
         self.use_fixed_decoders = False
         self.fixed_decoders = []
         self.mac_decoders = {}
+        # Decode RuuviTag RAW formats directly from raw frames when possible
+        self.fast_path = fast_path
+        self.fast_count = 0
+        self._fast_schemas = {}  # Ruuvi data format -> Schema of fast path messages
+        self._macs = {}  # Cache of peer address bytes -> mac string
+        # Decoder which last succeeded for a mac is tried first. Macs for which
+        # all decoders failed repeatedly (and never succeeded) are not decoded
+        # for negative_cache_ttl seconds
+        self.pinned = {}  # mac -> decoder name
+        self.negative = {}  # mac -> time until decoding is skipped
+        self._failures = {}  # mac -> consecutive failed frames
+        self.negative_cache_ttl = negative_cache_ttl
+        self.stats = {"hits": 0, "misses": 0, "scans": 0, "negative": 0}
+        self.failures = dict.fromkeys(self.all_decoders, 0)  # Failed decodes
+
+    def _expand_decoders(self, decoders):
+        # 'all' is replaced by all decoders, other names are kept,
+        # e.g. [all, unknown] -> [pebble, ruuviraw, ruuviurl, eddy, unknown]
+        if "all" not in decoders:
+            return decoders
+        return list(self.all_decoders.keys()) + [
+            d for d in decoders if d != "all" and d not in self.all_decoders
+        ]
 
     def enable_fixed_decoders(self, decoders=[]):
         # if enabled, uses fixed decoders-list
         self.use_fixed_decoders = True
         print("Setting fixed_decoders = {}".format(decoders))
-        if "all" in decoders:
-            self.fixed_decoders = list(self.all_decoders.keys())
-        else:
-            self.fixed_decoders = decoders
+        self.fixed_decoders = self._expand_decoders(decoders)
 
     def enable_per_mac_decoders(self, sources=[]):
         # Enable per mac decoders as defined in sources configuration
         self.use_fixed_decoders = False
         print("Setting per_mac_decoders = {}".format(sources))
         for mac, mac_config in sources.items():
-            _d = mac_config.get("decoders", [])
-            if "all" in _d:
-                self.mac_decoders[mac] = list(self.all_decoders.keys())
-            else:
-                self.mac_decoders[mac] = _d
+            self.mac_decoders[mac] = self._expand_decoders(
+                mac_config.get("decoders", [])
+            )
 
     def get_decoders(self, mac):
         if self.use_fixed_decoders:
@@ -63,12 +91,51 @@ class Decoder:
             else:
                 return self.mac_decoders.get("*", None)
 
+    def get_mac(self, peer):
+        # Peer address bytes from raw frame -> mac string, cached
+        mac = self._macs.get(peer)
+        if mac is None:
+            if len(self._macs) >= self.MAX_CACHED_MACS:
+                self._macs.clear()
+            mac = self._macs[peer] = prefilter.bytes_to_mac(peer)
+        return mac
+
+    def is_negative(self, mac, now=None):
+        # True if decoding of mac should be skipped, see NEGATIVE_CACHE_AFTER
+        until = self.negative.get(mac)
+        if until is None:
+            return False
+        if now is None:
+            now = time.monotonic()
+        if now < until:
+            return True
+        del self.negative[mac]
+        return False
+
     def run(self, data, simulator=0):
+        # Returns decoded message as a Measurement
         if simulator > 0:
             # data is from BLE simulator, just return the data
-            return data
+            return Measurement.from_dict(data)
+
+        base_mesg = Measurement(self.NOT_DECODED, ["none"])
+        if prefilter.is_adv_report(data):
+            mac = self.get_mac(prefilter.peer_bytes(data))
+            if self.is_negative(mac):
+                # Skip also aioblescan if there is no catch-all decoder
+                decoders = self.get_decoders(mac) or []
+                if all(d in self.all_decoders for d in decoders):
+                    self.stats["negative"] += 1
+                    return base_mesg
+            elif self.fast_path:
+                mesg = self.run_fast(data, mac)
+                if mesg is not None:
+                    return mesg
+
+        if isinstance(data, memoryview):
+            # Frame from shared memory ring buffer, aioblescan needs bytes
+            data = data.tobytes()
 
-        base_mesg = {"decoder": "none"}
         ev = aiobs.HCI_Event()
         ev.decode(data)
         mesg = packet_info(ev)
@@ -81,12 +148,149 @@ class Decoder:
             return base_mesg
 
         # Try actually decode the message
+        decoded = self.dispatch(ev, mesg["mac"], decoders)
+        if decoded is None:
+            return base_mesg
+        return Measurement.from_dict({"decoder": decoded[0], **mesg, **decoded[1]})
+
+    def dispatch(self, ev, mac, decoders):
+        # Returns (decoder name, decoded fields) or None if all decoders failed.
+        # Names which are not in all_decoders, e.g. 'unknown', match any
+        # packet and give just the basic packet info.
+        negative = self.is_negative(mac)
+        if negative:
+            self.stats["negative"] += 1
+        pinned = None if negative else self.pinned.get(mac)
+        if pinned is not None:
+            result = self.all_decoders[pinned](ev)
+            if result:
+                self.stats["hits"] += 1
+                return pinned, result
+            self.stats["misses"] += 1
+            self.failures[pinned] += 1
+
+        # Full scan of decoders
+        if not negative:
+            self.stats["scans"] += 1
+        tried = False
         for decoder in decoders:
             func = self.all_decoders.get(decoder, None)
-            if func:
-                mesg.update(func(ev))
-            if mesg:
-                mesg["decoder"] = decoder
-                return {**base_mesg, **mesg}
+            if func is None:
+                break  # Catch-all decoder
+            if negative or decoder == pinned:
+                continue
+            tried = True
+            result = func(ev)
+            if result:  # Decoders return None or {} if they can't decode
+                self._pin(mac, decoder)
+                return decoder, result
+            self.failures[decoder] += 1
+        else:
+            decoder = None
+
+        # Pinned decoder is kept if no other decoder succeeded. Only macs
+        # which have never been decoded are put to negative cache.
+        if tried and pinned is None and self.negative_cache_ttl > 0:
+            # Device may send also undecodable frames (e.g. scan responses),
+            # so skip it only after several consecutive failures
+            failures = self._failures.get(mac, 0) + 1
+            if failures < self.NEGATIVE_CACHE_AFTER:
+                if len(self._failures) >= self.MAX_CACHED_MACS:
+                    self._failures.clear()
+                self._failures[mac] = failures
+            else:
+                self._failures.pop(mac, None)
+                if len(self.negative) >= self.MAX_CACHED_MACS:
+                    self.negative.clear()
+                self.negative[mac] = time.monotonic() + self.negative_cache_ttl
+        if decoder is None:
+            return None
+        return decoder, {}
+
+    def _pin(self, mac, decoder):
+        self._failures.pop(mac, None)
+        if mac not in self.pinned and len(self.pinned) >= self.MAX_CACHED_MACS:
+            self.pinned.clear()
+        self.pinned[mac] = decoder
+
+    def use_fast_path(self, mac):
+        # True if ruuviraw is the decoder to use for the mac
+        pinned = self.pinned.get(mac)
+        if pinned is None:
+            decoders = self.get_decoders(mac)
+            return bool(decoders) and decoders[0] == "ruuviraw"
+        return pinned == "ruuviraw"
+
+    def run_fast(self, data, mac):
+        # Decode without aioblescan if ruuviraw is the decoder to use for the mac.
+        # Returns None if decoding must be done by run()
+        if not self.use_fast_path(mac):
+            return None
+        decoded = self.ruuvitagraw.decode_frame(data)
+        if decoded is None:
+            return None
+        return self._fast_message(mac, *decoded)
+
+    def run_batch(self, frames):
+        # Same as run() for each frame, but RuuviTag frames are decoded
+        # together by ruuvitagbatch if numpy is available.
+        # Returns list of decoded messages
+        if not self.fast_path or ruuvitagbatch.np is None:
+            return [self.run(frame) for frame in frames]
+        mesgs = [None] * len(frames)
+        rows = []  # (index of frame, mac) of each payload
+        payloads = []
+        for i, frame in enumerate(frames):
+            if not prefilter.is_adv_report(frame):
+                continue
+            mac = self.get_mac(prefilter.peer_bytes(frame))
+            if self.is_negative(mac) or not self.use_fast_path(mac):
+                continue
+            payload = ruuvitagbatch.ruuvi_payload(frame)
+            if payload is not None:
+                rows.append((i, mac))
+                payloads.append(payload)
+        if payloads:
+            columns = ruuvitagbatch.decode_batch(payloads)
+            for (i, mac), fields in zip(rows, ruuvitagbatch.to_records(columns)):
+                if fields is not None:
+                    rssi = frames[i][-1]
+                    rssi = rssi - 256 if rssi > 127 else rssi
+                    mesgs[i] = self._fast_message(mac, rssi, fields)
+        # Frames which were not decoded in batch are decoded one by one
+        return [
+            self.run(frame) if mesg is None else mesg
+            for frame, mesg in zip(frames, mesgs)
+        ]
+
+    def _fast_message(self, mac, rssi, fields):
+        # Message of fields decoded by ruuviraw from a raw frame
+        self.fast_count += 1
+        if mac in self.pinned:
+            self.stats["hits"] += 1
+        else:
+            self.stats["scans"] += 1
+            self._pin(mac, "ruuviraw")
+        # Fields of each data format are always the same
+        schema = self._fast_schemas.get(fields["data_format"])
+        if schema is None or len(schema.keys) != len(fields) + len(self.FAST_KEYS):
+            schema = Schema.of(self.FAST_KEYS + tuple(fields))
+            self._fast_schemas[fields["data_format"]] = schema
+        return Measurement(schema, ["ruuviraw", rssi, mac, *fields.values()])
 
-        return base_mesg
+    def print_stats(self):
+        print(
+            "Decoder: {} pinned hits, {} pinned misses, {} full scans, "
+            "{} negative cache hits, {} decoded from raw frames.".format(
+                self.stats["hits"],
+                self.stats["misses"],
+                self.stats["scans"],
+                self.stats["negative"],
+                self.fast_count,
+            )
+        )
+        print(
+            "Decoder: {} macs pinned, {} macs in negative cache.".format(
+                len(self.pinned), len(self.negative)
+            )
+        )
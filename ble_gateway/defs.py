@@ -2,6 +2,10 @@ STOPMESSAGE = "STOP"
 SCANMODE = "SCAN"
 GWMODE = "GATEWAY"
 
+# Max seconds to block waiting on a queue before checking
+# that the other processes are still alive
+MAX_QUEUE_WAIT = 1.0
+
 C_SEC_COMMON = "common"
 C_SEC_SOURCES = "sources"
 C_SEC_DESTINATIONS = "destinations"
@@ -17,10 +21,68 @@ DEFAULT_CONFIG = {
     # COMMON section:
     #
     C_SEC_COMMON: {
+        # hciX device number or list of device numbers to scan
         "device": int(0),
         "no_messages_timeout": int(10),
         "simulator": int(0),
         "max_mesgs": int(0),
+        # Append raw frames received from BLE to capture file record.
+        # Replay capture file replay instead of BLE adapters, at recorded pace
+        # times replay_speed, "max" = as fast as possible.
+        "record": "",
+        "replay": "",
+        "replay_speed": 1.0,
+        # Frames from BLE are sent to decoder in batches of max
+        # ipc_batch_size frames, waiting max ipc_batch_delay seconds
+        "ipc_batch_size": int(32),
+        "ipc_batch_delay": 0.05,
+        # Transport for raw frames from BLE to decoder: "queue" or "shm"
+        # shm uses a shared memory ring buffer of ring_size bytes
+        "transport": "queue",
+        "ring_size": 1024 * 1024,
+        # Where to reject frames from unwanted macs before decoding them:
+        # "main" process, "ble" process or "none"
+        "prefilter": "main",
+        # Optionally accept only frames with these manufacturer ids,
+        # e.g. [0x0499] for Ruuvi
+        "manufacturer_ids": [],
+        # Where to apply source intervals: in "main" or "ble" process before
+        # decoding or "none" to apply them in writers process after decoding
+        "throttle": "none",
+        # Seconds to skip decoding frames from macs for which all decoders
+        # failed, 0 = try decoders for every frame
+        "negative_cache_ttl": 60,
+        # Where to drop repeated copies of the same advertisement before
+        # decoding: "main" or "ble" process or "none". Copies are dropped for
+        # dedup_ttl seconds, max dedup_max_entries advertisements are tracked.
+        # With dedup_keep_best_rssi frames are held for dedup_window seconds
+        # and the copy with the strongest rssi is decoded.
+        "dedup": "none",
+        "dedup_ttl": 1.0,
+        "dedup_max_entries": 10000,
+        "dedup_keep_best_rssi": False,
+        "dedup_window": 0.05,
+        # Number of decoder worker processes, frames are divided between
+        # workers by mac. 0 = decode in main process
+        "decoder_workers": 0,
+        # Decode RuuviTag frames of each batch together with numpy
+        # (optional dependency), one frame at a time if it's not installed
+        "batch_decode": False,
+        # Decoded messages are sent to writers process "pickle"d or packed
+        # with "struct", field names are sent only once per kind of message
+        "writers_q_format": "pickle",
+        # Serve pipeline metrics in Prometheus text format at
+        # http://metrics_address:metrics_port/metrics, 0 = no endpoint,
+        # and print a summary of them every metrics_interval secs, 0 = never
+        "metrics_port": 0,
+        "metrics_address": "127.0.0.1",
+        "metrics_interval": 0,
+        # Trace latency of each message from reception in BLE process to
+        # acknowledged write by InfluxDB and file destinations
+        "trace": False,
+        # Message timestamp is the time message arrived to writers process
+        # ("writer") or time frame was received from BLE ("received")
+        "timestamp_source": "writer",
     },
     #
     # SOURCES section:
@@ -50,6 +112,15 @@ DEFAULT_CONFIG = {
         # to all defined destinations. Additional settings
         # defined for a particular destination will override settings
         # inherited from DEFAULTS
-        "DEFAULTS": {}
+        "DEFAULTS": {
+            # Max seconds a message may wait in a writer's batch buffer
+            "max_latency": 30,
+            # Max estimated size of a batch in bytes, 0 = no limit
+            "max_bytes": 0,
+            # Each destination is written in its own thread, messages wait
+            # in an inbox of max inbox_size messages (dropped when it's full)
+            "threaded": True,
+            "inbox_size": 1000,
+        }
     },
 }
@@ -2,25 +2,147 @@ import re
 import time
 
 
+class Histogram:
+    """
+    Log-bucketed (HDR style) histogram of integer values, e.g. latencies
+    in nanoseconds. Values below 2**precision are counted exactly, larger
+    values in 2**(precision-1) buckets per power of two, so that the
+    relative error is below 2**(1-precision), 0.8% with precision 8.
+    Memory is fixed and recording is O(1).
+
+    Histograms of the same precision and max_value can be merged, e.g.
+    snapshots from several processes, and delta() of two snapshots is
+    the histogram of values recorded between them.
+    """
+
+    def __init__(self, precision=8, max_value=1 << 40):
+        self.precision = precision
+        self.max_value = max_value  # Larger values are counted as max_value
+        self._half = 1 << (precision - 1)
+        self.counts = [0] * (self._index(max_value) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def _index(self, value):
+        shift = value.bit_length() - self.precision
+        if shift <= 0:
+            return value
+        return shift * self._half + (value >> shift)
+
+    def _highest(self, index):
+        # Highest value counted in bucket index
+        shift = index // self._half - 1
+        if shift <= 0:
+            return index
+        return ((index - shift * self._half + 1) << shift) - 1
+
+    def record(self, value):
+        if value < 0:
+            value = 0
+        elif value > self.max_value:
+            value = self.max_value
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def percentile(self, p):
+        # Value at percentile p (0..100), 0 if histogram is empty
+        if not self.count:
+            return 0
+        target = max(1, -int(-p * self.count // 100))  # Rounded up
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min(self._highest(index), self.max)
+        return self.max
+
+    def average(self):
+        return self.total / self.count if self.count else 0
+
+    def _check(self, other):
+        if (other.precision, other.max_value) != (self.precision, self.max_value):
+            raise ValueError("Histograms have different precision or range")
+
+    def merge(self, other):
+        # Add values of other histogram to this one
+        self._check(other)
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        return self
+
+    def snapshot(self):
+        h = Histogram(self.precision, self.max_value)
+        return h.merge(self)
+
+    def delta(self, earlier):
+        # Histogram of values recorded after snapshot earlier was taken,
+        # min and max are those of the whole histogram
+        self._check(earlier)
+        h = self.snapshot()
+        h.counts = [a - b for a, b in zip(self.counts, earlier.counts)]
+        h.count -= earlier.count
+        h.total -= earlier.total
+        return h
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def summary(self, scale=1000, unit="usecs"):
+        # E.g. "avg 12.1 p50 10.0 p99 40.2 p99.9 80.1 max 120.5 usecs"
+        # of values divided by scale
+        return "avg {:.1f} p50 {:.1f} p99 {:.1f} p99.9 {:.1f} max {:.1f} {}".format(
+            self.average() / scale,
+            self.percentile(50) / scale,
+            self.percentile(99) / scale,
+            self.percentile(99.9) / scale,
+            self.max / scale,
+            unit,
+        )
+
+
 class StopWatch:
+    # Times between start() and split() are measured with perf_counter_ns
+    # and recorded to a Histogram. start() and split() return and timeouts
+    # use wall clock time, now().
+
     def __init__(self, timeout=0):
         self.TIMER_SECS = 0.0  # Cumulative seconds
         self.TIMER_COUNT = 0  # Cumulative counter
         self.__start_t = self.now()
+        self.__start_ns = time.perf_counter_ns()
         self.__timeout = timeout
         self.MAX_SPLIT = 0.0
+        self.histogram = Histogram()  # Split times in nanoseconds
+        self._interval_start = None  # Histogram snapshot of previous interval()
 
     def start(self):
+        self.__start_ns = time.perf_counter_ns()
         self.__start_t = self.now()
         return self.__start_t
 
     def split(self):
-        split_t = self.now()
-        laptime = split_t - self.__start_t
+        lap_ns = time.perf_counter_ns() - self.__start_ns
+        self.histogram.record(lap_ns)
+        laptime = lap_ns / 1e9
         self.MAX_SPLIT = max(self.MAX_SPLIT, laptime)
         self.TIMER_SECS += laptime
         self.TIMER_COUNT += 1
-        return split_t
+        return self.__start_t + laptime
 
     def set_timeout(self, tout):
         self.__timeout = tout
@@ -34,6 +156,16 @@ class StopWatch:
         else:
             return False
 
+    def time_left(self, max_wait=None):
+        # Seconds until timeout, capped to max_wait.
+        # Returns max_wait (None = wait forever) if no timeout is set
+        if not self.__timeout:
+            return max_wait
+        left = max(0.0, self.__start_t + self.__timeout - self.now())
+        if max_wait is not None:
+            left = min(left, max_wait)
+        return left
+
     def now(self):
         return time.time()
 
@@ -46,6 +178,24 @@ class StopWatch:
         else:
             return 0
 
+    def get_percentile(self, p):
+        # Split time in seconds at percentile p (0..100)
+        return self.histogram.percentile(p) / 1e9
+
+    def interval(self):
+        # Histogram of splits since previous interval(), for rolling windows
+        snapshot = self.histogram.snapshot()
+        if self._interval_start is None:
+            window = snapshot.snapshot()
+        else:
+            window = snapshot.delta(self._interval_start)
+        self._interval_start = snapshot
+        return window
+
+    def summary(self):
+        # Split times in microseconds, e.g. for printing stats on exit
+        return self.histogram.summary()
+
     def reset(self):
         self.__init__(self.__timeout)
 
@@ -0,0 +1,199 @@
+#
+# InfluxDB line protocol serializer, see
+# https://docs.influxdata.com/influxdb/v1.8/write_protocols/line_protocol_reference/
+#
+#   measurement,tag1=value1,tag2=value2 field1=1.5,field2=3i 1600000000000
+#
+# Timestamps are written in milliseconds.
+#
+
+import math
+from operator import itemgetter
+
+from ble_gateway.measurement import Measurement
+
+# Characters to escape in measurement, in tag keys and values and field keys
+_MEASUREMENT_ESCAPES = str.maketrans({",": "\\,", " ": "\\ ", "\n": "\\n"})
+_KEY_ESCAPES = str.maketrans({",": "\\,", "=": "\\=", " ": "\\ ", "\n": "\\n"})
+# String field values are in double quotes, newline would end the line
+_STRING_ESCAPES = str.maketrans({'"': '\\"', "\\": "\\\\", "\n": "\\n"})
+
+
+def escape_measurement(name):
+    return str(name).translate(_MEASUREMENT_ESCAPES)
+
+
+def escape_key(key):
+    # Escape tag key, tag value or field key
+    return str(key).translate(_KEY_ESCAPES)
+
+
+def _format_float(value):
+    if math.isfinite(value):
+        return repr(value)
+    return None  # NaN and infinity can't be written
+
+
+def _format_string(value):
+    return '"' + value.translate(_STRING_ESCAPES) + '"'
+
+
+_FORMATTERS = {
+    float: _format_float,
+    int: lambda value: "%di" % value,
+    bool: lambda value: "true" if value else "false",
+    str: _format_string,
+}
+
+
+def format_field(value):
+    # Field value with type suffix or quotes, None if value can't be written
+    formatter = _FORMATTERS.get(type(value))
+    if formatter is not None:
+        return formatter(value)
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return "%di" % value
+    if isinstance(value, float):
+        return _format_float(value)
+    return _format_string(str(value))
+
+
+def _getter(indexes):
+    # Tuple of values at indexes
+    if len(indexes) == 1:
+        i = indexes[0]
+        return lambda values: (values[i],)
+    return itemgetter(*indexes)
+
+
+class LineSerializer:
+    """
+    Serializes messages to line protocol lines of measurement.
+    Values of keys in tags are written as tags, sorted by key, other
+    values as fields and "timestamp" (seconds) as timestamp in ms.
+
+    Tag set of each combination of tag values (e.g. mac, location and
+    decoder) is escaped and formatted once and cached. Messages from the
+    same decoder have the same keys and value types, so field set is
+    formatted with a %-template cached for each such layout.
+    """
+
+    def __init__(self, measurement, tags=(), max_cached=10000):
+        self.measurement = escape_measurement(measurement)
+        self.tags = tuple(sorted(set(tags)))
+        self.max_cached = max_cached
+        self._prefixes = {}  # Tuple of tag values -> "measurement,tag=value,..."
+        # (Schema or keys, value types) -> field set template
+        self._templates = {}
+        self._skip = frozenset(self.tags + ("timestamp",))
+
+    def prefix(self, values):
+        # Measurement and tag set for tag values, missing tags are left out
+        prefix = self._prefixes.get(values)
+        if prefix is None:
+            if len(self._prefixes) >= self.max_cached:
+                self._prefixes.clear()
+            tag_set = [
+                "{}={}".format(escape_key(tag), escape_key(value))
+                for tag, value in zip(self.tags, values)
+                if value is not None and value != ""
+            ]
+            prefix = ",".join([self.measurement] + tag_set)
+            self._prefixes[values] = prefix
+        return prefix
+
+    def _template(self, keys, types):
+        # (template, getter of field values, indexes of strings among them,
+        # getter of float values or None) for messages with keys and value
+        # types, None if values need to be formatted one by one
+        parts = []
+        indexes = []
+        strings = []
+        floats = []
+        for i, (key, value_type) in enumerate(zip(keys, types)):
+            if key in self._skip or value_type is type(None):
+                continue
+            if value_type is int:
+                value = "%di"
+            elif value_type is float:
+                value = "%r"
+                floats.append(i)
+            elif value_type is str:
+                value = '"%s"'
+                strings.append(len(indexes))
+            else:
+                return None
+            parts.append(escape_key(key).replace("%", "%%") + "=" + value)
+            indexes.append(i)
+        if not parts:
+            return None
+        if len(self._templates) >= self.max_cached:
+            self._templates.clear()
+        floats = _getter(floats) if floats else None
+        return ",".join(parts), _getter(indexes), strings, floats
+
+    def fields(self, mesg):
+        # Field set of message, one field at a time
+        fields = []
+        for key, value in mesg.items():
+            if key in self._skip:
+                continue
+            value = format_field(value)
+            if value is not None:
+                fields.append(escape_key(key) + "=" + value)
+        return ",".join(fields)
+
+    def line(self, mesg):
+        # Line of message, None if message has no fields to write
+        prefix = self.prefix(tuple(map(mesg.get, self.tags)))
+        if type(mesg) is Measurement:
+            schema = mesg.schema
+            keys = schema.keys
+            values = mesg.row
+        else:
+            keys = schema = tuple(mesg)
+            values = tuple(mesg.values())
+        types = tuple(map(type, values))
+        try:
+            template = self._templates[schema, types]
+        except KeyError:
+            template = self._templates[schema, types] = self._template(keys, types)
+        if template is not None:
+            template, getter, strings, floats = template
+            # Sum of floats is NaN or infinity if any of them is (or if it
+            # overflows, then fields are just formatted one by one)
+            if floats is not None and not math.isfinite(sum(floats(values))):
+                template = None  # NaN and infinity are left out
+        if template is None:
+            fields = self.fields(mesg)
+        else:
+            field_values = getter(values)
+            if strings:
+                field_values = list(field_values)
+                for i in strings:
+                    field_values[i] = field_values[i].translate(_STRING_ESCAPES)
+                field_values = tuple(field_values)
+            fields = template % field_values
+        if not fields:
+            return None
+        timestamp = mesg.get("timestamp")
+        if timestamp is None:
+            return prefix + " " + fields
+        return "%s %s %d" % (prefix, fields, timestamp * 1000)
+
+    def lines(self, messages):
+        # Lines of messages, messages without fields are left out
+        lines = []
+        for mesg in messages:
+            line = self.line(mesg)
+            if line is not None:
+                lines.append(line)
+        return lines
+
+    def serialize(self, messages):
+        # Whole batch of messages as one utf-8 encoded buffer
+        return "\n".join(self.lines(messages)).encode()
@@ -0,0 +1,225 @@
+from collections.abc import MutableMapping
+from operator import itemgetter
+
+
+class Schema:
+    """
+    Field names of measurements, in order. Schemas are interned, so all
+    measurements with the same fields share one Schema, e.g. all messages
+    decoded by the same decoder. Adding or removing a field moves the
+    measurement to another schema, transitions are cached.
+    """
+
+    __slots__ = ("keys", "index", "_with", "_without")
+    MAX_SCHEMAS = 10000
+    _schemas = {}  # keys -> Schema
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.index = {key: i for i, key in enumerate(keys)}
+        self._with = {}  # key -> schema with key added
+        self._without = {}  # key -> schema without key
+
+    @classmethod
+    def of(cls, keys):
+        # Interned schema of tuple of keys
+        schema = cls._schemas.get(keys)
+        if schema is None:
+            if len(cls._schemas) >= cls.MAX_SCHEMAS:
+                cls._schemas.clear()
+            schema = cls._schemas[keys] = cls(keys)
+        return schema
+
+    def with_key(self, key):
+        schema = self._with.get(key)
+        if schema is None:
+            schema = self._with[key] = Schema.of(self.keys + (key,))
+        return schema
+
+    def without_key(self, key):
+        schema = self._without.get(key)
+        if schema is None:
+            i = self.index[key]
+            schema = Schema.of(self.keys[:i] + self.keys[i + 1 :])
+            self._without[key] = schema
+        return schema
+
+    def __repr__(self):
+        return "Schema{}".format(self.keys)
+
+
+def _restore(keys, row):
+    # Unpickle a measurement, schema is interned in this process
+    return Measurement(Schema.of(keys), row)
+
+
+class Measurement(MutableMapping):
+    """
+    Compact message passed from decoder to writers: a shared Schema of
+    field names and a list of values in the same order. Behaves like a
+    dict (repr and == included), convert with to_dict() where a real dict
+    is needed, e.g. for json.
+    """
+
+    __slots__ = ("schema", "row")
+
+    def __init__(self, schema, row):
+        self.schema = schema
+        self.row = row
+
+    @classmethod
+    def from_dict(cls, mapping):
+        return cls(Schema.of(tuple(mapping)), list(mapping.values()))
+
+    def __getitem__(self, key):
+        return self.row[self.schema.index[key]]
+
+    def get(self, key, default=None):
+        i = self.schema.index.get(key)
+        if i is None:
+            return default
+        return self.row[i]
+
+    def __contains__(self, key):
+        return key in self.schema.index
+
+    def __setitem__(self, key, value):
+        i = self.schema.index.get(key)
+        if i is None:
+            self.schema = self.schema.with_key(key)
+            self.row.append(value)
+        else:
+            self.row[i] = value
+
+    def __delitem__(self, key):
+        i = self.schema.index[key]
+        self.schema = self.schema.without_key(key)
+        del self.row[i]
+
+    _MISSING = object()
+
+    def pop(self, key, default=_MISSING):
+        i = self.schema.index.get(key)
+        if i is None:
+            if default is self._MISSING:
+                raise KeyError(key)
+            return default
+        self.schema = self.schema.without_key(key)
+        return self.row.pop(i)
+
+    def __iter__(self):
+        return iter(self.schema.keys)
+
+    def __len__(self):
+        return len(self.row)
+
+    def keys(self):
+        return self.schema.keys
+
+    def values(self):
+        return self.row
+
+    def items(self):
+        return zip(self.schema.keys, self.row)
+
+    def copy(self):
+        return Measurement(self.schema, self.row[:])
+
+    def to_dict(self):
+        return dict(zip(self.schema.keys, self.row))
+
+    def __eq__(self, other):
+        if isinstance(other, Measurement):
+            # Schemas of equal keys may be different objects, e.g. after
+            # interned schemas were cleared
+            if self.schema is other.schema or self.schema.keys == other.schema.keys:
+                return self.row == other.row
+            return self.to_dict() == other.to_dict()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def __reduce__(self):
+        return _restore, (self.schema.keys, self.row)
+
+
+def as_dict(mesg):
+    # Real dict of a measurement or dict
+    if isinstance(mesg, Measurement):
+        return mesg.to_dict()
+    return mesg
+
+
+class _Ref:
+    # Value of field index of the input measurement, see compile_steps()
+    __slots__ = ("index",)
+
+    def __init__(self, index):
+        self.index = index
+
+
+class _Upper:
+    # Value uppercased if it's a string
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+def compile_steps(schema, steps, uppercase_step):
+    """
+    Compile message modification steps (func, arg) for measurements of
+    schema, by running the steps once on a dict of placeholders.
+    uppercase_step is the step function which uppercases values, it is
+    applied when measurements are built. Returns function which builds
+    the modified measurement from a measurement of schema.
+    """
+    probe = {key: _Ref(i) for i, key in enumerate(schema.keys)}
+    for func, arg in steps:
+        if func is uppercase_step:
+            for f in arg:
+                if f in probe:
+                    probe[f] = _Upper(probe[f])
+        else:
+            probe = func(probe, arg)
+    out_schema = Schema.of(tuple(probe))
+
+    # Added constants are appended to input row, so that output row can be
+    # picked with one itemgetter. Then values to uppercase are uppercased.
+    constants = []
+    indexes = []
+    upper = []
+    for i, source in enumerate(probe.values()):
+        if isinstance(source, _Upper):
+            while isinstance(source, _Upper):
+                source = source.value
+            if isinstance(source, _Ref):
+                upper.append(i)
+            elif isinstance(source, str):
+                source = source.upper()
+        if isinstance(source, _Ref):
+            indexes.append(source.index)
+        else:
+            indexes.append(len(schema.keys) + len(constants))
+            constants.append(source)
+
+    if not indexes:
+        return lambda mesg: Measurement(out_schema, [])
+    if len(indexes) == 1:
+        i = indexes[0]
+        getter = lambda row: (row[i],)  # noqa: E731
+    else:
+        getter = itemgetter(*indexes)
+
+    def build(mesg):
+        row = list(getter(mesg.row + constants if constants else mesg.row))
+        for i in upper:
+            value = row[i]
+            if isinstance(value, str):
+                row[i] = value.upper()
+        return Measurement(out_schema, row)
+
+    return build
@@ -0,0 +1,350 @@
+#
+# Pipeline metrics shared by the gateway processes.
+#
+# Counters and gauges are values in a shared memory array with a row for
+# each process: main, BLE, writers and each decoder worker. A process
+# writes only its own row, so no locks are needed, and values are summed
+# over rows when they are read. Counters kept by filters, decoders and
+# writers themselves are published to the row periodically.
+#
+# Main process serves metrics in Prometheus text format at
+#   http://<metrics_address>:<metrics_port>/metrics
+# and prints a summary every metrics_interval seconds.
+#
+
+import http.server
+import threading
+import time
+from multiprocessing import RawArray
+
+from ble_gateway import decode, tracing
+
+PREFIX = "ble_gateway_"
+MAIN, BLE, WRITERS, DECODERS = 0, 1, 2, 3  # Rows, worker i uses DECODERS + i
+PUBLISH_INTERVAL = 1.0  # Seconds between publishing counters kept elsewhere
+DROP_REASONS = (
+    "invalid",  # Not an advertising report
+    "allowmac",  # Mac not in allowmac
+    "allowmac_decoded",  # Mac of decoded message not in allowmac
+    "unrouted",  # Mac would be routed only to DROP
+    "manufacturer",  # Unwanted manufacturer id
+    "dedup",  # Copy of an advertisement already decoded
+    "interval",  # Source interval not over
+    "drop_route",  # Routed to DROP destination
+    "inbox_full",  # Writer thread's inbox was full
+    "ring_full",  # Shared memory ring buffer was full
+)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """
+    Metrics of all processes. Each metric has at most one label and the
+    label values are known from configuration, so all processes have the
+    same slots in the shared array.
+
+    Process:  m = metrics.bind(row), m.inc(m.key(name, label)),
+              m.publish(name, {label: value, ...})
+    Main:     m.render() for Prometheus, m.summary() for the log
+    """
+
+    def __init__(self, config):
+        self.definitions = []  # (name, kind, help, label name, label values)
+        self.index = {}  # (name, label value) -> slot
+        # other = adapters not in configuration, e.g. of replayed captures
+        adapters = ["hci{}".format(d) for d in config.DEVICES] + ["other"]
+        decoders = list(decode.Decoder.all_decoders) + ["unknown", "none"]
+        destinations = [d for d in config.DESTINATIONS if d != "defaults"]
+        self.define(
+            "frames_received_total",
+            "counter",
+            "Frames received from BLE.",
+            "adapter",
+            adapters,
+        )
+        self.define(
+            "frames_batched_total",
+            "counter",
+            "Frames sent from BLE process to decoding.",
+        )
+        self.define(
+            "frames_decoded_total",
+            "counter",
+            "Frames decoded, decoder none if no decoder succeeded.",
+            "decoder",
+            decoders,
+        )
+        self.define(
+            "decoder_failures_total",
+            "counter",
+            "Frames a decoder was tried on and failed to decode.",
+            "decoder",
+            list(decode.Decoder.all_decoders),
+        )
+        self.define(
+            "frames_dropped_total",
+            "counter",
+            "Frames and messages dropped, by reason.",
+            "reason",
+            DROP_REASONS,
+        )
+        self.define(
+            "queue_depth",
+            "gauge",
+            "Items waiting in queue, bytes in shared memory ring buffer.",
+            "queue",
+            ["decoder_q", "writers_q", "ring_bytes"],
+        )
+        self.define(
+            "messages_to_writers_total",
+            "counter",
+            "Decoded messages received by writers process.",
+        )
+        self.define(
+            "writer_batches_total",
+            "counter",
+            "Batches written by destination.",
+            "destination",
+            destinations,
+        )
+        self.define(
+            "writer_messages_total",
+            "counter",
+            "Messages written in batches by destination.",
+            "destination",
+            destinations,
+        )
+        self.define(
+            "writer_write_seconds_total",
+            "counter",
+            "Seconds spent writing batches by destination.",
+            "destination",
+            destinations,
+        )
+        self.define(
+            "writer_write_seconds_max",
+            "gauge",
+            "Longest time to write a batch by destination.",
+            "destination",
+            destinations,
+        )
+        self.define(
+            "writer_write_seconds_p99",
+            "gauge",
+            "99th percentile of time to write a batch by destination.",
+            "destination",
+            destinations,
+        )
+        stages = tracing.stage_names(destinations)
+        self.define(
+            "latency_seconds_p50",
+            "gauge",
+            "Median latency of traced messages by stage.",
+            "stage",
+            stages,
+        )
+        self.define(
+            "latency_seconds_p99",
+            "gauge",
+            "99th percentile latency of traced messages by stage.",
+            "stage",
+            stages,
+        )
+        self.width = len(self.index)
+        self.rows = DECODERS + max(0, config.DECODER_WORKERS)
+        self.values = RawArray("d", self.rows * self.width)
+        self.offset = 0
+        self._next_publish = 0.0
+        self.interval = config.METRICS_INTERVAL
+        self.port = config.METRICS_PORT
+        self.address = config.METRICS_ADDRESS
+        self._server = None
+        self._gauges = None
+        self._last = None  # (time, totals) of previous summary
+
+    @classmethod
+    def from_config(cls, config):
+        # Metrics if endpoint or summary is enabled, otherwise None
+        if not config.METRICS_PORT and not config.METRICS_INTERVAL:
+            return None
+        return cls(config)
+
+    def define(self, name, kind, help, label=None, label_values=(None,)):
+        self.definitions.append((name, kind, help, label, list(label_values)))
+        for value in label_values:
+            self.index[name, value] = len(self.index)
+
+    def bind(self, row):
+        # Metrics writing to row of a process, values are shared
+        m = object.__new__(Metrics)
+        m.__dict__.update(self.__dict__)
+        m.offset = row * self.width
+        return m
+
+    def key(self, name, label=None):
+        # Slot of metric in own row, None if label is not known
+        slot = self.index.get((name, label))
+        if slot is None:
+            return None
+        return self.offset + slot
+
+    def inc(self, key, n=1):
+        if key is not None:
+            self.values[key] += n
+
+    def set(self, key, value):
+        if key is not None:
+            self.values[key] = value
+
+    def publish(self, name, values):
+        # Set labelled values of metric, e.g. counters kept by a filter
+        for label, value in values.items():
+            self.set(self.key(name, label), value)
+
+    def publish_due(self, now=None):
+        # True once per PUBLISH_INTERVAL
+        if now is None:
+            now = time.monotonic()
+        if now < self._next_publish:
+            return False
+        self._next_publish = now + PUBLISH_INTERVAL
+        return True
+
+    def total(self, name, label=None):
+        slot = self.index[name, label]
+        return sum(self.values[slot :: self.width])
+
+    def totals(self, name):
+        # {label value: total over processes}
+        for n, kind, help, label, label_values in self.definitions:
+            if n == name:
+                return {v: self.total(name, v) for v in label_values}
+        return {}
+
+    def render(self):
+        # All metrics in Prometheus text format
+        if self._gauges is not None:
+            self._gauges()
+        lines = []
+        for name, kind, help, label, label_values in self.definitions:
+            lines.append("# HELP {}{} {}".format(PREFIX, name, help))
+            lines.append("# TYPE {}{} {}".format(PREFIX, name, kind))
+            for value in label_values:
+                labels = ""
+                if label is not None:
+                    labels = '{{{}="{}"}}'.format(label, _escape(value))
+                lines.append(
+                    "{}{}{} {!r}".format(PREFIX, name, labels, self.total(name, value))
+                )
+        return "\n".join(lines) + "\n"
+
+    def summary(self, now=None):
+        # One line summary, rates are per second since previous summary
+        if self._gauges is not None:
+            self._gauges()
+        if now is None:
+            now = time.monotonic()
+        received = sum(self.totals("frames_received_total").values())
+        decoded = self.totals("frames_decoded_total")
+        decoded_ok = sum(v for k, v in decoded.items() if k != "none")
+        to_writers = self.total("messages_to_writers_total")
+        rates = ""
+        if self._last is not None:
+            secs = max(1e-9, now - self._last[0])
+            rates = " ({:.1f}/s received, {:.1f}/s decoded)".format(
+                (received - self._last[1]) / secs, (decoded_ok - self._last[2]) / secs
+            )
+        self._last = (now, received, decoded_ok)
+        drops = self.totals("frames_dropped_total")
+        depths = self.totals("queue_depth")
+        batches = self.totals("writer_batches_total")
+        messages = self.totals("writer_messages_total")
+        secs = self.totals("writer_write_seconds_total")
+        writes = [
+            "{} {:.0f} batches of {:.1f} in {:.1f} ms avg".format(
+                d, batches[d], messages[d] / batches[d], 1000 * secs[d] / batches[d]
+            )
+            for d in batches
+            if batches[d]
+        ]
+        return (
+            "Metrics: {:.0f} frames received{}, {:.0f} decoded, {:.0f} not decoded, "
+            "{:.0f} to writers. Dropped: {}. Queues: {}. Batches: {}.".format(
+                received,
+                rates,
+                decoded_ok,
+                decoded.get("none", 0),
+                to_writers,
+                ", ".join("{}={:.0f}".format(k, v) for k, v in drops.items() if v)
+                or "none",
+                ", ".join("{}={:.0f}".format(k, v) for k, v in depths.items()),
+                ", ".join(writes) or "none",
+            )
+        )
+
+    def serve(self, gauges=None):
+        # Serve metrics over HTTP in a thread, if metrics_port is set.
+        # gauges = function which sets gauges before metrics are read
+        self._gauges = gauges
+        if not self.port:
+            return
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # No log line for every scrape
+
+        try:
+            self._server = http.server.HTTPServer((self.address, self.port), Handler)
+        except OSError as e:
+            print("Metrics endpoint not available: {}".format(e))
+            return
+        self._server.daemon_threads = True
+        threading.Thread(
+            target=self._server.serve_forever, name="metrics", daemon=True
+        ).start()
+        print("Serving metrics at http://{}:{}/metrics".format(self.address, self.port))
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def bind(metrics, row):
+    # Metrics of process row, None if metrics are disabled
+    if metrics is None:
+        return None
+    return metrics.bind(row)
+
+
+def publish_filters(metrics, rawfilter=None, dedup=None, throttle=None):
+    # Drops counted by prefilter objects of the process
+    if rawfilter is not None:
+        metrics.publish("frames_dropped_total", rawfilter.drops)
+    if dedup is not None:
+        metrics.set(
+            metrics.key("frames_dropped_total", "dedup"), dedup.stats["duplicates"]
+        )
+    if throttle is not None:
+        metrics.set(metrics.key("frames_dropped_total", "interval"), throttle.throttled)
+
+
+def publish_decoder(metrics, decoder):
+    if decoder is not None:
+        metrics.publish("decoder_failures_total", decoder.failures)
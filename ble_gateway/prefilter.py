@@ -0,0 +1,414 @@
+import time
+from collections import OrderedDict
+
+from ble_gateway import defs, helpers
+
+# Raw HCI LE Advertising Report event as received from the bluetooth socket:
+#   0      packet type, 0x04 = HCI event
+#   1      event code, 0x3E = LE Meta event
+#   2      parameter length
+#   3      subevent code, 0x02 = LE Advertising Report
+#   4      number of reports
+#   5      event type
+#   6      address type
+#   7..12  peer address, least significant byte first
+#   13     length of advertising data
+#   14..   advertising data (AD structures: length, type, data)
+#   last   rssi
+HCI_EVENT_PKT = 0x04
+LE_META_EVENT = 0x3E
+LE_ADV_REPORT = 0x02
+PEER_OFFSET = 7
+ADV_DATA_OFFSET = 14
+MIN_FRAME_LEN = ADV_DATA_OFFSET + 1  # No advertising data, just rssi
+
+AD_TYPE_MANUFACTURER = 0xFF
+
+# Ruuvi RAWv2 (data format 5) measurement sequence number in manufacturer data
+RUUVI_ID = b"\x99\x04"
+RUUVI_DF5 = 5
+RUUVI_DF5_SEQ_OFFSET = 2 + 16  # After manufacturer id
+RUUVI_DF5_SEQ_INVALID = b"\xff\xff"
+
+
+def mac_to_bytes(mac):
+    # "aa:bb:cc:dd:ee:ff" -> peer address bytes as they are in the frame
+    return bytes.fromhex(mac.replace(":", ""))[::-1]
+
+
+def bytes_to_mac(peer):
+    # Peer address bytes from frame -> "aa:bb:cc:dd:ee:ff"
+    return ":".join("%02x" % b for b in reversed(peer))
+
+
+def is_adv_report(frame):
+    return (
+        len(frame) >= MIN_FRAME_LEN
+        and frame[0] == HCI_EVENT_PKT
+        and frame[1] == LE_META_EVENT
+        and frame[3] == LE_ADV_REPORT
+        and frame[4] == 1
+    )
+
+
+def peer_bytes(frame):
+    # Frame MUST be a valid advertising report, see is_adv_report()
+    return bytes(frame[PEER_OFFSET : PEER_OFFSET + 6])
+
+
+def find_ad(frame, ad_type):
+    # Returns offset and length of data of the first AD structure of ad_type
+    # in the advertising report's data, None if not found
+    # Like aioblescan, parse everything up to rssi at the end of the frame
+    pos = ADV_DATA_OFFSET
+    end = len(frame) - 1
+    while pos + 1 < end:
+        length = frame[pos]
+        if length == 0:
+            break
+        if frame[pos + 1] == ad_type:
+            if pos + 1 + length > end:
+                break  # Truncated AD structure
+            return pos + 2, length - 1
+        pos += 1 + length
+    return None
+
+
+def manufacturer_id(frame):
+    # Company identifier of manufacturer specific data, None if there is none
+    ad = find_ad(frame, AD_TYPE_MANUFACTURER)
+    if ad is None or ad[1] < 2:
+        return None
+    return frame[ad[0]] | frame[ad[0] + 1] << 8
+
+
+class RawFilter:
+    """
+    Rejects raw HCI frames before they are decoded:
+    - frames which are not LE advertising reports ("invalid")
+    - frames from macs not in allowed macs ("allowmac")
+    - frames from macs which would be routed only to DROP ("unrouted")
+    - frames without wanted manufacturer id ("manufacturer")
+    """
+
+    def __init__(self, allowed_macs=None, routed_macs=None, manufacturer_ids=None):
+        self.allowed_macs = None
+        if allowed_macs:
+            self.allowed_macs = {mac_to_bytes(mac) for mac in allowed_macs}
+        self.routed_macs = None
+        if routed_macs is not None:
+            self.routed_macs = {mac_to_bytes(mac) for mac in routed_macs}
+        self.manufacturer_ids = None
+        if manufacturer_ids:
+            # Ids may be given as strings in configuration, e.g. "0x0499"
+            self.manufacturer_ids = {
+                int(i, 0) if isinstance(i, str) else int(i) for i in manufacturer_ids
+            }
+        self.passed = 0
+        self.drops = {"invalid": 0, "allowmac": 0, "unrouted": 0, "manufacturer": 0}
+
+    @classmethod
+    def from_config(cls, config):
+        # Macs are filtered by allowmac list and, in Gateway mode, if
+        # unknown macs are routed only to DROP, by macs in sources
+        routed_macs = None
+        if config.MODE != defs.SCANMODE:
+            unknown_dests = config.SOURCES.get("*", {}).get("destinations", ["DROP"])
+            if list(unknown_dests) == ["DROP"]:
+                routed_macs = [
+                    mac
+                    for mac, mconfig in config.SOURCES.items()
+                    if helpers.check_and_format_mac(mac)
+                    and list(mconfig.get("destinations", ["DROP"])) != ["DROP"]
+                ]
+        return cls(config.ALLOWED_MACS, routed_macs, config.MANUFACTURER_IDS)
+
+    def check(self, frame):
+        # Returns True if frame should be decoded
+        if not is_adv_report(frame):
+            self.drops["invalid"] += 1
+            return False
+        if self.allowed_macs is not None or self.routed_macs is not None:
+            peer = peer_bytes(frame)
+            if self.allowed_macs is not None and peer not in self.allowed_macs:
+                self.drops["allowmac"] += 1
+                return False
+            if self.routed_macs is not None and peer not in self.routed_macs:
+                self.drops["unrouted"] += 1
+                return False
+        if self.manufacturer_ids is not None:
+            if manufacturer_id(frame) not in self.manufacturer_ids:
+                self.drops["manufacturer"] += 1
+                return False
+        self.passed += 1
+        return True
+
+    def print_stats(self, where=""):
+        print(
+            "Prefilter{}: {} frames passed, dropped {}.".format(
+                where,
+                self.passed,
+                ", ".join("{}={}".format(k, v) for k, v in self.drops.items()),
+            )
+        )
+
+
+class IntervalThrottle:
+    """
+    Applies per source 'interval' settings to raw frames, so that
+    frames arriving too soon after previous frame of the same mac are
+    dropped before they are decoded and sent to writers.
+    """
+
+    MAX_MACS = 10000  # Purge expired macs when more macs than this are tracked
+
+    def __init__(self, sources_config):
+        self.intervals = {}
+        for mac, mconfig in sources_config.items():
+            if helpers.check_and_format_mac(mac):
+                self.intervals[mac_to_bytes(mac)] = mconfig.get("interval") or 0
+        self.default_interval = sources_config.get("*", {}).get("interval") or 0
+        self.last_sent = {}
+        self.passed = 0
+        self.throttled = 0
+
+    def check(self, frame, now=None):
+        # Returns True if frame should be decoded
+        if not is_adv_report(frame):
+            return True  # Let decoder deal with it
+        peer = peer_bytes(frame)
+        interval = self.intervals.get(peer, self.default_interval)
+        if interval > 0:
+            if now is None:
+                now = time.monotonic()
+            last = self.last_sent.get(peer)
+            if last is not None and now - last < interval:
+                self.throttled += 1
+                return False
+            if last is None and len(self.last_sent) >= self.MAX_MACS:
+                self._purge(now)
+            self.last_sent[peer] = now
+        self.passed += 1
+        return True
+
+    def _purge(self, now):
+        for peer, last in list(self.last_sent.items()):
+            if now - last >= self.intervals.get(peer, self.default_interval):
+                del self.last_sent[peer]
+
+    def print_stats(self, where=""):
+        print(
+            "Throttle{}: {} frames passed, {} frames throttled before decoding.".format(
+                where, self.passed, self.throttled
+            )
+        )
+
+
+class DedupCache:
+    """
+    Drops repeated copies of the same advertisement, e.g. when a tag sends
+    it on all three advertising channels. Frames are identified by mac and
+    measurement sequence number for Ruuvi data format 5, otherwise by mac
+    and advertising data. Keys are remembered for ttl seconds, least
+    recently seen keys are evicted when there are more than max_entries.
+
+    With keep_best_rssi frames are held for window seconds with hold(), and
+    the copy with the strongest rssi is returned by ready() after that,
+    with the tag (e.g. adapter index) it was held with.
+    """
+
+    def __init__(self, ttl=1.0, max_entries=10000, keep_best_rssi=False, window=0.05):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.keep_best_rssi = keep_best_rssi
+        self.window = window
+        self.seen = OrderedDict()  # key -> time until copies are dropped
+        self.pending = OrderedDict()  # key -> [release time, rssi, frame, tag]
+        self.stats = {
+            "passed": 0,
+            "duplicates": 0,
+            "replaced": 0,
+            "expired": 0,
+            "evicted": 0,
+        }
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config.DEDUP_TTL,
+            config.DEDUP_MAX_ENTRIES,
+            config.DEDUP_KEEP_BEST_RSSI,
+            config.DEDUP_WINDOW,
+        )
+
+    @staticmethod
+    def key(frame):
+        # Frame MUST be a valid advertising report, see is_adv_report()
+        ad = find_ad(frame, AD_TYPE_MANUFACTURER)
+        if ad is not None and ad[1] >= RUUVI_DF5_SEQ_OFFSET + 2:
+            pos = ad[0]
+            if frame[pos : pos + 2] == RUUVI_ID and frame[pos + 2] == RUUVI_DF5:
+                seq = frame[pos + RUUVI_DF5_SEQ_OFFSET : pos + RUUVI_DF5_SEQ_OFFSET + 2]
+                if seq != RUUVI_DF5_SEQ_INVALID:
+                    return peer_bytes(frame) + bytes(seq)
+        # Peer address and advertising data, without rssi
+        return bytes(frame[PEER_OFFSET:-1])
+
+    def _is_duplicate(self, key, now):
+        # Returns True if key has been seen within ttl, otherwise remembers it
+        until = self.seen.get(key)
+        if until is not None:
+            if now < until:
+                self.seen.move_to_end(key)
+                self.stats["duplicates"] += 1
+                return True
+            self.stats["expired"] += 1
+        self.seen[key] = now + self.ttl
+        self.seen.move_to_end(key)
+        if len(self.seen) > self.max_entries:
+            self.seen.popitem(last=False)
+            self.stats["evicted"] += 1
+        return False
+
+    def check(self, frame, now=None):
+        # Returns True if frame is not a duplicate and should be decoded
+        if not is_adv_report(frame):
+            return True  # Let decoder deal with it
+        if now is None:
+            now = time.monotonic()
+        if self._is_duplicate(self.key(frame), now):
+            return False
+        self.stats["passed"] += 1
+        return True
+
+    def hold(self, frame, tag=None, now=None):
+        # Keep frame until ready() if it is the first or the strongest copy.
+        # Returns False if frame is not an advertising report and was not held.
+        if not is_adv_report(frame):
+            return False
+        if now is None:
+            now = time.monotonic()
+        key = self.key(frame)
+        rssi = frame[-1] - 256 if frame[-1] > 127 else frame[-1]
+        held = self.pending.get(key)
+        if held is not None:
+            self.stats["duplicates"] += 1
+            if rssi > held[1]:
+                held[1:] = rssi, bytes(frame), tag
+                self.stats["replaced"] += 1
+        elif not self._is_duplicate(key, now):
+            # Copy, frame may be a memoryview to a ring buffer
+            self.pending[key] = [now + self.window, rssi, bytes(frame), tag]
+        return True
+
+    def ready(self, now=None):
+        # Returns (frame, tag) of held frames whose window has passed
+        frames = []
+        if self.pending:
+            if now is None:
+                now = time.monotonic()
+            while self.pending:
+                key, held = next(iter(self.pending.items()))
+                if held[0] > now:
+                    break
+                del self.pending[key]
+                frames.append((held[2], held[3]))
+            self.stats["passed"] += len(frames)
+        return frames
+
+    def time_to_ready(self, max_wait=None):
+        # Seconds until next held frame is ready, capped to max_wait
+        if not self.pending:
+            return max_wait
+        left = max(0.0, next(iter(self.pending.values()))[0] - time.monotonic())
+        if max_wait is not None:
+            left = min(left, max_wait)
+        return left
+
+    def print_stats(self, where=""):
+        total = self.stats["passed"] + self.stats["duplicates"]
+        print(
+            "Dedup{}: {} frames passed, {} duplicates dropped ({:.1f}%), "
+            "{} replaced by stronger rssi, {} expired, {} evicted, "
+            "{} keys cached.".format(
+                where,
+                self.stats["passed"],
+                self.stats["duplicates"],
+                100.0 * self.stats["duplicates"] / max(1, total),
+                self.stats["replaced"],
+                self.stats["expired"],
+                self.stats["evicted"],
+                len(self.seen),
+            )
+        )
+
+
+class FrameFilters:
+    """
+    Prefilters of raw frames in one process, applied in order RawFilter,
+    DedupCache and IntervalThrottle, each of them optional. Frames are
+    checked with a tag, e.g. (adapter, reception time). With
+    dedup_keep_best_rssi frames are held by dedup and returned by ready()
+    with their tag when their dedup window has passed.
+
+      if filters.check(frame, tag): decode(frame, tag)
+      for frame, tag in filters.ready(): decode(frame, tag)
+    """
+
+    def __init__(self, rawfilter=None, dedup=None, throttle=None):
+        self.rawfilter = rawfilter
+        self.dedup = dedup
+        self.throttle = throttle
+
+    @classmethod
+    def from_config(cls, config, where, best_rssi=False):
+        # Filters configured to be applied in process where, "main" or "ble".
+        # With best_rssi only the strongest copy of an advertisement is
+        # passed, e.g. when several adapters receive it.
+        rawfilter = None
+        if config.PREFILTER == where:
+            rawfilter = RawFilter.from_config(config)
+        dedup = None
+        if config.DEDUP == where:
+            dedup = DedupCache.from_config(config)
+        if best_rssi and (dedup is None or not dedup.keep_best_rssi):
+            dedup = DedupCache(
+                config.DEDUP_TTL, config.DEDUP_MAX_ENTRIES, True, config.DEDUP_WINDOW
+            )
+        throttle = None
+        if config.THROTTLE == where:
+            throttle = IntervalThrottle(config.SOURCES)
+        return cls(rawfilter, dedup, throttle)
+
+    def check(self, frame, tag=None):
+        # Returns True if frame should be decoded now, False if it was
+        # rejected or is held until ready()
+        if self.rawfilter is not None and not self.rawfilter.check(frame):
+            return False
+        if self.dedup is not None:
+            if self.dedup.keep_best_rssi:
+                if self.dedup.hold(frame, tag):
+                    return False
+            elif not self.dedup.check(frame):
+                return False
+        return self.throttle is None or self.throttle.check(frame)
+
+    def ready(self, now=None):
+        # (frame, tag) of held frames to decode now, now=inf for all of them
+        if self.dedup is None:
+            return []
+        frames = self.dedup.ready(now)
+        if self.throttle is not None:
+            frames = [(f, tag) for f, tag in frames if self.throttle.check(f)]
+        return frames
+
+    def time_to_ready(self, max_wait=None):
+        # Seconds until next held frame is ready, capped to max_wait
+        if self.dedup is None:
+            return max_wait
+        return self.dedup.time_to_ready(max_wait)
+
+    def print_stats(self, where=""):
+        for f in (self.rawfilter, self.dedup, self.throttle):
+            if f is not None:
+                f.print_stats(where)
@@ -0,0 +1,191 @@
+import queue
+import struct
+import threading
+from multiprocessing import Event
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+
+class RingBuffer:
+    """
+    Single-producer/single-consumer ring buffer for raw HCI frames
+    in shared memory. Frames are stored length-prefixed with a one byte
+    tag (e.g. index of the adapter which received the frame) and, with
+    timestamps, time.time() when the frame was received. Frames never
+    wrap around the end of the buffer, so consumer can read them as
+    memoryviews without copying.
+
+    Shared memory layout:
+      0..8   head, total bytes written by producer (published by commit())
+      8..16  tail, total bytes consumed by consumer (published by release())
+      16..   frame data
+
+    Producer:  put(frame, tag, stamp) ... put(frame, tag, stamp), commit()
+    Consumer:  frames = get(timeout), process frames, tags and times, release()
+    """
+
+    _POSITIONS = struct.Struct("<QQ")
+    _POSITION = struct.Struct("<Q")
+    _LENGTH = struct.Struct("<H")  # Frame length prefix, 2 bytes
+    _HEADER = 3  # Length prefix and tag
+    _STAMP = struct.Struct("<d")  # Optional timestamp after tag
+    _WRAP = 0xFFFF  # Length marker: rest of the buffer is unused, continue from start
+    DEFAULT_SIZE = 1024 * 1024
+
+    def __init__(self, size=DEFAULT_SIZE, timestamps=False):
+        if shared_memory is None:
+            raise RuntimeError("multiprocessing.shared_memory requires python 3.8+")
+        self.size = int(size)
+        self.timestamps = timestamps
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=self._POSITIONS.size + self.size
+        )
+        self._POSITIONS.pack_into(self._shm.buf, 0, 0, 0)
+        self._event = Event()  # Set by producer when new frames are committed
+        self._attach()
+
+    def _attach(self):
+        self._data = self._shm.buf[self._POSITIONS.size :]
+        self._head, self._tail = self._POSITIONS.unpack_from(self._shm.buf, 0)
+        self._read_to = self._tail
+        self._frames = []  # Memoryviews returned by last get()
+        self.tags = []  # Tags of frames returned by last get()
+        self.times = []  # and their timestamps, if buffer has timestamps
+        self._header = self._HEADER + (self._STAMP.size if self.timestamps else 0)
+        self._barrier = threading.Lock()  # Used only as a memory barrier
+        self._records = {}  # Frame length -> struct.Struct for writing a frame
+        self.dropped = 0  # Frames dropped by producer because buffer was full
+
+    def __getstate__(self):
+        # Pickled when passed to a subprocess, which attaches to the same memory
+        return {
+            "name": self._shm.name,
+            "size": self.size,
+            "timestamps": self.timestamps,
+            "event": self._event,
+        }
+
+    def __setstate__(self, state):
+        self.size = state["size"]
+        self.timestamps = state["timestamps"]
+        self._shm = shared_memory.SharedMemory(name=state["name"])
+        self._event = state["event"]
+        self._attach()
+
+    # Producer ----------------------------------------------------------------
+    def put(self, frame, tag=0, stamp=0.0):
+        # Write frame to buffer, it becomes visible to consumer on commit().
+        # Returns False and drops the frame if there is no room for it.
+        length = len(frame)
+        head = self._head
+        pos = head % self.size
+        skip = self.size - pos
+        if skip >= self._header + length:
+            skip = 0  # Frame fits before end of buffer
+        end = head + skip + self._header + length
+        if end - self._tail > self.size:
+            # Might be full, check how far consumer has read
+            self._tail = self._POSITION.unpack_from(self._shm.buf, 8)[0]
+            if end - self._tail > self.size:
+                self.dropped += 1
+                return False
+        if skip:
+            if skip >= 2:
+                self._LENGTH.pack_into(self._data, pos, self._WRAP)
+            pos = 0
+        record = self._records.get(length)
+        if record is None:
+            # Length prefix, tag, timestamp and frame are written with one
+            # pack_into()
+            record = struct.Struct(
+                "<HB%s%ds" % ("d" if self.timestamps else "", length)
+            )
+            self._records[length] = record
+        if self.timestamps:
+            record.pack_into(self._data, pos, length, tag, stamp, frame)
+        else:
+            record.pack_into(self._data, pos, length, tag, frame)
+        self._head = end
+        return True
+
+    def commit(self):
+        # Publish frames written since last commit and wake up consumer
+        with self._barrier:  # frame data must be visible before head
+            pass
+        self._POSITION.pack_into(self._shm.buf, 0, self._head)
+        if not self._event.is_set():
+            self._event.set()
+
+    # Consumer ----------------------------------------------------------------
+    def get(self, timeout=None):
+        # Returns list of committed frames as memoryviews, their tags are
+        # in self.tags and timestamps in self.times.
+        # Memoryviews are valid until release() is called.
+        # Raises queue.Empty if no frames arrive within timeout seconds.
+        head = self._committed_head()
+        if head == self._tail:
+            self._event.clear()
+            head = self._committed_head()  # Re-check to not miss a commit
+            if head == self._tail:
+                self._event.wait(timeout)
+                head = self._committed_head()
+                if head == self._tail:
+                    raise queue.Empty
+
+        frames = []
+        tags = []
+        times = []
+        tail = self._tail
+        while tail < head:
+            pos = tail % self.size
+            if self.size - pos < self._LENGTH.size:
+                tail += self.size - pos
+                continue
+            length = self._LENGTH.unpack_from(self._data, pos)[0]
+            if length == self._WRAP:
+                tail += self.size - pos
+                continue
+            tags.append(self._data[pos + self._LENGTH.size])
+            if self.timestamps:
+                times.append(self._STAMP.unpack_from(self._data, pos + self._HEADER)[0])
+            pos += self._header
+            frames.append(self._data[pos : pos + length])
+            tail += self._header + length
+        self._read_to = tail
+        self._frames = frames
+        self.tags = tags
+        self.times = times
+        return frames
+
+    def release(self):
+        # Free space of frames returned by last get() for producer
+        for frame in self._frames:
+            frame.release()
+        self._frames = []
+        self._tail = self._read_to
+        self._POSITION.pack_into(self._shm.buf, 8, self._tail)
+
+    def pending_bytes(self):
+        # Bytes committed by producer and not yet released by consumer,
+        # from shared positions, so that either side can ask
+        head, tail = self._POSITIONS.unpack_from(self._shm.buf, 0)
+        return head - tail
+
+    def _committed_head(self):
+        head = self._POSITION.unpack_from(self._shm.buf, 0)[0]
+        with self._barrier:  # read frame data only after head
+            pass
+        return head
+
+    def close(self):
+        for frame in self._frames:
+            frame.release()
+        self._frames = []
+        self._data.release()
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
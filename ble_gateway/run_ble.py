@@ -1,81 +1,306 @@
 import asyncio
+import functools
 
 import aioblescan as aiobs
 
-from ble_gateway import helpers
+from ble_gateway import capture, defs, helpers, metrics, prefilter
 
 
-# Define and run ble scanner asyncio loop
-def run_ble(hci_dev, QUIT_BLE_EVENT, decoder_q):
+class FrameBatcher:
+    """
+    Frames are collected to batches and each batch is sent to decoder
+    with a single put(), when batch is full or batch delay has passed.
+    With ring buffer frames are written to it right away and
+    the batch is committed to decoder at once.
+    With several adapters or reception times batch is sent as
+    (frames, adapters or None, reception times or None).
+    """
 
-    # TIMING
-    my_timer = helpers.StopWatch()
-    # ------------------------------
+    def __init__(self, config, event_loop, decoder_q, ring=None):
+        self.event_loop = event_loop
+        self.decoder_q = decoder_q
+        self.ring = ring
+        self.batch_size = config.IPC_BATCH_SIZE
+        self.batch_delay = config.IPC_BATCH_DELAY
+        self.tag_frames = len(config.DEVICES) > 1
+        self.receive_times = config.RECEIVE_TIMES
+        self.metrics = None  # Frames sent are counted, if set
+        self.batched_key = None
+        self.frames = []
+        self.adapters = []
+        self.times = []
+        self.length = 0
+        self.timer = None
+        self.count = 0  # Batches sent
 
-    event_loop = asyncio.get_event_loop()
+    def add(self, data, adapter, received):
+        if self.ring is None:
+            self.frames.append(data)
+            self.adapters.append(adapter)
+            self.times.append(received)
+            self.length += 1
+        elif self.ring.put(data, adapter, received):
+            self.length += 1
+        if self.length >= self.batch_size:
+            self.send()
+        elif self.length and self.timer is None:
+            self.timer = self.event_loop.call_later(self.batch_delay, self.send)
+
+    def send(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.length:
+            return
+        if self.ring is not None:
+            self.ring.commit()
+        else:
+            if self.tag_frames or self.receive_times:
+                self.decoder_q.put(
+                    (
+                        self.frames,
+                        self.adapters if self.tag_frames else None,
+                        self.times if self.receive_times else None,
+                    )
+                )
+            else:
+                self.decoder_q.put(self.frames)
+            self.frames = []
+            self.adapters = []
+            self.times = []
+        if self.metrics is not None:
+            self.metrics.inc(self.batched_key, self.length)
+        self.length = 0
+        self.count += 1
+
+
+class FrameReceiver:
+    """
+    Handles frames received from BLE adapters, or fed by a replay source,
+    in the asyncio loop: frames are appended to capture file, if recording,
+    passed thru prefilters configured for ble and sent to decoder in
+    batches. Frames held by dedup are batched when they are ready.
+    """
+
+    def __init__(
+        self, config, event_loop, QUIT_BLE_EVENT, decoder_q, ring, pipeline_metrics
+    ):
+        self.event_loop = event_loop
+        self.QUIT_BLE_EVENT = QUIT_BLE_EVENT
+        self.decoder_q = decoder_q
+        self.ring = ring
+        self.metrics = metrics.bind(pipeline_metrics, metrics.BLE)
+        # TIMING
+        self.my_timer = helpers.StopWatch()
+        # ------------------------------
+        # Several adapters receive the same advertisements,
+        # decode only the copy with the best rssi
+        self.filters = prefilter.FrameFilters.from_config(
+            config, "ble", best_rssi=len(config.DEVICES) > 1
+        )
+        self.batcher = FrameBatcher(config, event_loop, decoder_q, ring)
+        self.received_keys = {}
+        self.received_other = None
+        if self.metrics is not None:
+            self.received_keys = {
+                dev: self.metrics.key("frames_received_total", "hci{}".format(dev))
+                for dev in config.DEVICES
+            }
+            self.received_other = self.metrics.key("frames_received_total", "other")
+            self.batcher.metrics = self.metrics
+            self.batcher.batched_key = self.metrics.key("frames_batched_total")
+        self.recorder = None
+        if config.RECORD:
+            self.recorder = capture.CaptureWriter(config.RECORD)
+        self.held_timer = None
 
     # Callback process to handle data received from BLE
     # ---------------------------------------------------
-    def callback_data_handler(data):
+    def callback(self, data, adapter=0):
         # data = byte array of raw data received
+        # adapter = hci device number of adapter which received the data
 
         # TIMING
-        my_timer.start()
+        received = self.my_timer.start()  # Reception time, time.time()
         # ------------------------------
+        if self.metrics is not None:
+            self.metrics.inc(self.received_keys.get(adapter, self.received_other))
+        if self.recorder is not None:
+            self.recorder.write(data, adapter)
 
-        if QUIT_BLE_EVENT.is_set():
-            event_loop.stop()
-        else:
-            # Add message to queue
-            decoder_q.put(data)
+        if self.QUIT_BLE_EVENT.is_set():
+            self.event_loop.stop()
+        elif self.filters.check(data, (adapter, received)):
+            self.batcher.add(data, adapter, received)
+        elif self.held_timer is None:
+            self.schedule_held()
 
         # TIMING
-        my_timer.split()
+        self.my_timer.split()
         # ------------------------------
 
     # ---------------------------------------------------
-    # EOF callback_data_handler
+    # EOF callback
 
-    if int(hci_dev) < 0:
-        print("No device specified, exiting run_ble")
-        return 1
+    def schedule_held(self):
+        # Batch frames held by dedup when the first of them is ready
+        wait = self.filters.time_to_ready()
+        if wait is not None:
+            self.held_timer = self.event_loop.call_later(wait, self.release_held)
 
-    # First create and configure a raw socket
-    mysocket = aiobs.create_bt_socket(hci_dev)
+    def release_held(self):
+        self.held_timer = None
+        for data, (adapter, received) in self.filters.ready():
+            self.batcher.add(data, adapter, received)
+        self.schedule_held()
 
-    # create a connection with the socket
-    fac = event_loop._create_connection_transport(
-        mysocket, aiobs.BLEScanRequester, None, None
-    )
+    def publish_metrics(self):
+        f = self.filters
+        metrics.publish_filters(self.metrics, f.rawfilter, f.dedup, f.throttle)
+        if self.ring is not None:
+            self.metrics.set(
+                self.metrics.key("frames_dropped_total", "ring_full"), self.ring.dropped
+            )
 
-    # Start it
-    conn, btctrl = event_loop.run_until_complete(fac)
+    # Stop the loop also when no data is received
+    def check_quit_event(self):
+        if self.metrics is not None:
+            self.publish_metrics()
+        if self.QUIT_BLE_EVENT.is_set():
+            self.event_loop.stop()
+        else:
+            self.event_loop.call_later(defs.MAX_QUEUE_WAIT, self.check_quit_event)
 
-    # Attach your processing (callback)
-    btctrl.process = callback_data_handler
+    def flush(self):
+        # Send all frames to decoder, also frames held by dedup
+        if self.held_timer is not None:
+            self.held_timer.cancel()
+            self.held_timer = None
+        for data, (adapter, received) in self.filters.ready(float("inf")):
+            self.batcher.add(data, adapter, received)
+        self.batcher.send()
 
-    # Start BLE probe
-    btctrl.send_scan_request()
-    try:
-        event_loop.run_forever()
-    except KeyboardInterrupt:
-        print("\nKeyboard interrupt!")
-    finally:
-        print("Closing ble event loop.")
-        btctrl.stop_scan_request()
-        command = aiobs.HCI_Cmd_LE_Advertise(enable=False)
-        btctrl.send_command(command)
-        conn.close()
-        event_loop.close()
+    def finish_source(self):
+        # Source has fed all frames, send the rest and STOPMESSAGE after
+        # them, so that main decodes all frames before it stops.
+        # Loop runs until main sets QUIT_BLE_EVENT.
+        self.flush()
+        self.send_stop()
 
+    def send_stop(self):
+        # With ring buffer STOPMESSAGE is sent thru decoder_q when main
+        # has released all frames in the ring
+        if self.QUIT_BLE_EVENT.is_set():
+            return
+        if self.ring is not None and self.ring.pending_bytes():
+            self.event_loop.call_later(0.05, self.send_stop)
+        else:
+            self.decoder_q.put(defs.STOPMESSAGE)
+
+    def close(self):
+        if self.held_timer is not None:
+            self.held_timer.cancel()
+            self.held_timer = None
+        if not self.QUIT_BLE_EVENT.is_set():
+            self.flush()
+        if self.metrics is not None:
+            self.publish_metrics()
+
+    def print_stats(self):
         # TIMING
+        my_timer = self.my_timer
         print(my_timer.get_count(), "ble messages.")
         print(
             1000 * 1000 * my_timer.get_average(),
             "usec in average per message in run_ble.callback_data_handler().",
         )
+        print("Time per message in run_ble: {}.".format(my_timer.summary()))
+        print(
+            self.batcher.count,
+            "batches sent to decoder, {:.1f} messages per batch.".format(
+                my_timer.get_count() / max(1, self.batcher.count)
+            ),
+        )
+        self.filters.print_stats(" in run_ble")
+        if self.ring is not None:
+            print(self.ring.dropped, "messages dropped, ring buffer was full.")
+            self.ring.close()
+        if self.recorder is not None:
+            self.recorder.close()
         # ------------------------------
 
+
+def open_adapters(event_loop, hci_devs, callback):
+    # Start scanning with adapters, returns their connections
+    connections = []
+    for hci_dev in hci_devs:
+        # First create and configure a raw socket
+        mysocket = aiobs.create_bt_socket(hci_dev)
+
+        # create a connection with the socket
+        fac = event_loop._create_connection_transport(
+            mysocket, aiobs.BLEScanRequester, None, None
+        )
+
+        # Start it
+        conn, btctrl = event_loop.run_until_complete(fac)
+
+        # Attach your processing (callback)
+        btctrl.process = functools.partial(callback, adapter=hci_dev)
+        connections.append((conn, btctrl))
+
+    # Start BLE probe
+    for conn, btctrl in connections:
+        btctrl.send_scan_request()
+    return connections
+
+
+def close_adapters(connections):
+    for conn, btctrl in connections:
+        btctrl.stop_scan_request()
+        command = aiobs.HCI_Cmd_LE_Advertise(enable=False)
+        btctrl.send_command(command)
+        conn.close()
+
+
+# Define and run ble scanner asyncio loop
+# Received frames are sent to decoder_q or, if given, to ring buffer.
+# With several adapters all of them are scanned in the same loop and
+# each frame is sent with index of the adapter which received it.
+# Metrics, if given, are counted in its BLE row.
+# With record all received frames are appended to a capture file.
+# Source, if given, feeds frames instead of adapters, see
+# capture.Replayer. When it has fed all frames, STOPMESSAGE is sent
+# after them and the loop runs until QUIT_BLE_EVENT is set.
+def run_ble(
+    config, QUIT_BLE_EVENT, decoder_q, ring=None, pipeline_metrics=None, source=None
+):
+    hci_devs = config.DEVICES
+    if source is None and (not hci_devs or min(hci_devs) < 0):
+        print("No device specified, exiting run_ble")
+        return 1
+
+    event_loop = asyncio.get_event_loop()
+    receiver = FrameReceiver(
+        config, event_loop, QUIT_BLE_EVENT, decoder_q, ring, pipeline_metrics
+    )
+    connections = []
+    if source is None:
+        connections = open_adapters(event_loop, hci_devs, receiver.callback)
+    else:
+        source.start(event_loop, receiver.callback, receiver.finish_source)
+    receiver.check_quit_event()
+    try:
+        event_loop.run_forever()
+    except KeyboardInterrupt:
+        print("\nKeyboard interrupt!")
+    finally:
+        print("Closing ble event loop.")
+        receiver.close()
+        close_adapters(connections)
+        event_loop.close()
+        receiver.print_stats()
+
     print("Exiting run_ble.")
     return 0
     # EOF run_ble
@@ -0,0 +1,342 @@
+import queue
+import time
+from multiprocessing import Process, Queue
+
+from ble_gateway import decode, defs, helpers, metrics, prefilter, tracing, wireformat
+
+
+def make_decoder(config):
+    # Decoder with decoders as defined in configuration
+    decoder = decode.Decoder(negative_cache_ttl=config.NEGATIVE_CACHE_TTL)
+    if config.MODE == defs.SCANMODE:
+        decoder.enable_fixed_decoders(config.DECODE)
+    else:
+        decoder.enable_per_mac_decoders(config.SOURCES)
+    return decoder
+
+
+def decoded_messages(config, decoder, frames):
+    # Decoded messages of frames. With batch_decode, frames are decoded
+    # all at once, otherwise one at a time while messages are iterated
+    if config.BATCH_DECODE and not config.SIMULATOR:
+        return decoder.run_batch(frames)
+    return (decoder.run(frame, simulator=config.SIMULATOR) for frame in frames)
+
+
+def decode_and_send(
+    config,
+    decoder,
+    frame,
+    writers_q,
+    adapter=None,
+    pipeline_metrics=None,
+    received=None,
+    dequeued=None,
+):
+    mesg = decoder.run(frame, simulator=config.SIMULATOR)
+    send_decoded(
+        config, mesg, frame, writers_q, adapter, pipeline_metrics, received, dequeued
+    )
+
+
+def send_decoded(
+    config,
+    mesg,
+    frame,
+    writers_q,
+    adapter=None,
+    pipeline_metrics=None,
+    received=None,
+    dequeued=None,
+):
+    # mesg = message decoded from frame
+    # writers_q = queue or wireformat.WireWriter to send message to
+    # adapter = hci device number of the adapter which received the frame,
+    # added to message when scanning several adapters
+    # received = time.time() when frame was received, dequeued = when its
+    # batch was taken from queue, added to message for tracing
+    if pipeline_metrics is not None:
+        pipeline_metrics.inc(
+            pipeline_metrics.key("frames_decoded_total", mesg.get("decoder"))
+        )
+    if "mac" in mesg and (
+        not config.ALLOWED_MACS or mesg["mac"] in config.ALLOWED_MACS
+    ):
+        if adapter is not None:
+            mesg["adapter"] = "hci{}".format(adapter)
+        if received is not None:
+            tracing.stamp(mesg, received, dequeued)
+        # Send decoded message to writers
+        writers_q.put(mesg)
+        if config.SHOWRAW:
+            if isinstance(frame, memoryview):
+                frame = frame.tobytes()
+            print("Raw data: {}".format(frame))
+    elif "mac" in mesg and pipeline_metrics is not None:
+        pipeline_metrics.inc(
+            pipeline_metrics.key("frames_dropped_total", "allowmac_decoded")
+        )
+
+
+# Decoder worker process, decodes batches of frames from decoder_q
+# and sends decoded messages to writers until STOPMESSAGE is received.
+# Histogram of decode times is sent to results queue, if given, on exit.
+def run_decoder(
+    config, decoder_q, writers_q, worker=0, pipeline_metrics=None, results=None
+):
+    decoder = make_decoder(config)
+    writers_q = wireformat.sender(config, writers_q, worker + 1)
+    pipeline_metrics = metrics.bind(pipeline_metrics, metrics.DECODERS + worker)
+    my_timer = helpers.StopWatch()
+    while True:
+        data = decoder_q.get()
+        if pipeline_metrics is not None and pipeline_metrics.publish_due():
+            metrics.publish_decoder(pipeline_metrics, decoder)
+        if data == defs.STOPMESSAGE:
+            break
+        adapters = None
+        times = None
+        if isinstance(data, tuple):
+            data, adapters, times = data
+        dequeued = time.time() if config.TRACE else None
+        # Frames decoded in a batch are timed together with the first one
+        my_timer.start()
+        mesgs = decoded_messages(config, decoder, data)
+        for i, (frame, mesg) in enumerate(zip(data, mesgs)):
+            adapter = adapters[i] if adapters is not None else None
+            received = times[i] if times is not None else None
+            send_decoded(
+                config,
+                mesg,
+                frame,
+                writers_q,
+                adapter,
+                pipeline_metrics,
+                received,
+                dequeued,
+            )
+            my_timer.split()
+            my_timer.start()
+
+    if pipeline_metrics is not None:
+        metrics.publish_decoder(pipeline_metrics, decoder)
+
+    print(
+        "Decoder worker {}: {} messages, {} usecs in average per message.".format(
+            worker, my_timer.get_count(), 1000 * 1000 * my_timer.get_average()
+        )
+    )
+    print("Decoder worker {}: {}.".format(worker, my_timer.summary()))
+    if results is not None:
+        results.put(my_timer.histogram)
+    if not config.SIMULATOR:
+        decoder.print_stats()
+    return 0
+
+
+class DecoderPool:
+    """
+    Decodes frames in worker processes. Frames are sharded by mac, so that
+    frames of each mac are decoded by the same worker, in order.
+
+    put() frames of a batch and flush() them to workers once per batch.
+    Frames put with an adapter number or reception time are sent as
+    (frames, adapters, reception times).
+    """
+
+    def __init__(self, config, writers_q, workers, pipeline_metrics=None):
+        self.queues = [Queue() for i in range(workers)]
+        self.results = Queue()  # Histograms of decode times from workers
+        self.processes = [
+            Process(
+                target=run_decoder,
+                args=(config, q, writers_q, i, pipeline_metrics, self.results),
+            )
+            for i, q in enumerate(self.queues)
+        ]
+        self.shards = [[] for i in range(workers)]
+        self.adapters = [[] for i in range(workers)]
+        self.times = [[] for i in range(workers)]
+        self.counts = [0] * workers
+
+    def start(self):
+        for p in self.processes:
+            p.start()
+
+    def is_alive(self):
+        return all(p.is_alive() for p in self.processes)
+
+    def shard(self, frame):
+        # Index of the worker for frame
+        if isinstance(frame, dict):  # Message from simulator
+            key = frame.get("mac")
+        elif prefilter.is_adv_report(frame):
+            key = prefilter.peer_bytes(frame)
+        else:
+            return 0
+        return hash(key) % len(self.queues)
+
+    def put(self, frame, adapter=None, received=None):
+        if isinstance(frame, memoryview):
+            frame = frame.tobytes()  # Ring buffer space is released after batch
+        i = self.shard(frame)
+        self.shards[i].append(frame)
+        self.adapters[i].append(adapter)
+        self.times[i].append(received)
+
+    def flush(self):
+        # Send frames put since last flush to workers
+        for i, shard in enumerate(self.shards):
+            if shard:
+                adapters = self.adapters[i]
+                times = self.times[i]
+                if adapters[0] is None and times[0] is None:
+                    self.queues[i].put(shard)
+                else:
+                    self.queues[i].put(
+                        (
+                            shard,
+                            adapters if adapters[0] is not None else None,
+                            times if times[0] is not None else None,
+                        )
+                    )
+                self.counts[i] += len(shard)
+                self.shards[i] = []
+                self.adapters[i] = []
+                self.times[i] = []
+
+    def stop(self, timeout=5):
+        # Workers decode all frames sent to them before they exit
+        self.flush()
+        for q in self.queues:
+            q.put(defs.STOPMESSAGE)
+        # Results are read before joining, workers exit once they are sent
+        histogram = helpers.Histogram()
+        for p in self.processes:
+            try:
+                histogram.merge(self.results.get(timeout=timeout))
+            except queue.Empty:
+                break
+        for p in self.processes:
+            p.join(timeout)
+            if p.is_alive():
+                print("Decoder worker did not stop, terminating it.")
+                p.terminate()
+        print("Frames sent to decoder workers: {}".format(self.counts))
+        print("Time for decoding a message in workers: {}.".format(histogram.summary()))
+
+
+class FrameDecoder:
+    """
+    Decodes batches of raw frames from BLE in main process. Frames which
+    pass prefilters configured for main are decoded here, or by a
+    DecoderPool if decoder_workers is set, and sent to writers.
+    my_timer is split for each frame sent to decoding.
+    """
+
+    def __init__(self, config, writers_q, my_timer, pipeline_metrics=None):
+        self.config = config
+        self.my_timer = my_timer
+        self.metrics = metrics.bind(pipeline_metrics, metrics.MAIN)
+        self.decoder = None
+        self.pool = None
+        if config.DECODER_WORKERS > 0:
+            self.pool = DecoderPool(
+                config, writers_q, config.DECODER_WORKERS, pipeline_metrics
+            )
+            self.pool.start()
+        else:
+            self.decoder = make_decoder(config)
+        self.decoded_q = wireformat.sender(config, writers_q)
+        if config.SIMULATOR:
+            self.filters = prefilter.FrameFilters()
+        else:
+            self.filters = prefilter.FrameFilters.from_config(config, "main")
+        self.max_reached = False
+
+    def is_alive(self):
+        return self.pool is None or self.pool.is_alive()
+
+    def time_to_ready(self, max_wait):
+        # Seconds until frames held by prefilters are ready, capped to max_wait
+        return self.filters.time_to_ready(max_wait)
+
+    def _decode(self, frames, dequeued=None, limit=True):
+        # frames = list of (frame, (adapter, received)) which passed prefilters.
+        # With limit, frames beyond max message limit are not decoded.
+        max_mesgs = self.config.MAX_MESGS
+        if limit and max_mesgs:
+            frames = frames[: max(0, max_mesgs - self.my_timer.get_count())]
+        if not frames:
+            return
+        self.my_timer.start()
+        if self.pool is not None:
+            # Sent to decoder workers by pool.flush()
+            for frame, (adapter, received) in frames:
+                self.pool.put(frame, adapter, received)
+                self.my_timer.split()
+                self.my_timer.start()
+        else:
+            # Frames decoded in a batch are timed together with the first one
+            mesgs = decoded_messages(
+                self.config, self.decoder, [frame for frame, tag in frames]
+            )
+            for (frame, (adapter, received)), mesg in zip(frames, mesgs):
+                send_decoded(
+                    self.config,
+                    mesg,
+                    frame,
+                    self.decoded_q,
+                    adapter,
+                    self.metrics,
+                    received,
+                    dequeued,
+                )
+                self.my_timer.split()
+                self.my_timer.start()
+        if max_mesgs and max_mesgs <= self.my_timer.get_count():
+            if not self.max_reached:
+                print("Max message limit reached!")
+            self.max_reached = True
+
+    def decode_batch(self, frames, adapters=None, times=None):
+        # frames with adapter numbers and reception times, if given.
+        # Returns True when max message limit has been reached.
+        dequeued = time.time() if self.config.TRACE else None
+        if frames:
+            self.my_timer.start()  # Reset wait timer
+        passed = []
+        for i, frame in enumerate(frames):
+            tag = (
+                adapters[i] if adapters is not None else None,
+                times[i] if times is not None else None,
+            )
+            if self.filters.check(frame, tag):
+                passed.append((frame, tag))
+        self._decode(passed, dequeued)
+        if not self.max_reached:
+            self._decode(list(self.filters.ready()), dequeued)
+        if self.pool is not None:
+            self.pool.flush()
+        return self.max_reached
+
+    def release_held(self):
+        # Decode all frames held by prefilters, also if max message limit
+        # has been reached
+        self._decode(list(self.filters.ready(float("inf"))), limit=False)
+        if self.pool is not None:
+            self.pool.flush()
+
+    def publish_metrics(self):
+        f = self.filters
+        metrics.publish_filters(self.metrics, f.rawfilter, f.dedup, f.throttle)
+        metrics.publish_decoder(self.metrics, self.decoder)
+
+    def print_stats(self):
+        self.filters.print_stats(" in main")
+        if self.decoder is not None and not self.config.SIMULATOR:
+            self.decoder.print_stats()
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.stop()  # Workers send their last messages before writers stop
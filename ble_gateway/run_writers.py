@@ -1,53 +1,121 @@
 import queue
 
-from ble_gateway import defs, helpers, writers
+from ble_gateway import defs, helpers, metrics, tracing, wireformat, writers
 
 # from pprint import pprint
 
 
+def publish_metrics(pipeline_metrics, destinations, interval_drops, count, tracer):
+    # Counters of writers process and its writers to metrics
+    m = pipeline_metrics
+    m.set(m.key("messages_to_writers_total"), count)
+    drops = {"interval": interval_drops, "drop_route": 0, "inbox_full": 0}
+    for name, w in destinations.all_writers.items():
+        drops["inbox_full"] += getattr(w, "dropped", 0)  # WriterWorker
+        writer = getattr(w, "writer", w)
+        if writer.type == "DROP":
+            drops["drop_route"] += writer.packetcount
+        batch_times = writer.batch_times
+        m.set(m.key("writer_batches_total", name), batch_times.count)
+        m.set(m.key("writer_messages_total", name), writer.batch_messages)
+        m.set(m.key("writer_write_seconds_total", name), batch_times.total / 1e9)
+        m.set(m.key("writer_write_seconds_max", name), batch_times.max / 1e9)
+        m.set(m.key("writer_write_seconds_p99", name), batch_times.percentile(99) / 1e9)
+    m.publish("frames_dropped_total", drops)
+    if tracer is not None:
+        m.publish("latency_seconds_p50", tracer.percentiles(50))
+        m.publish("latency_seconds_p99", tracer.percentiles(99))
+
+
+def take_trace(mesg, tracer, now, use_received):
+    # Take trace times out of message, now = time message was received by
+    # writers process. Returns (trace to pass to writers or None if not
+    # tracing, timestamp of message: reception time from BLE if
+    # use_received, otherwise now).
+    times = tracing.take(mesg)
+    trace = None
+    if tracer is not None:
+        trace = tracer.begin(times, now)
+    if use_received and times[0] is not None:
+        now = times[0]
+    return trace, now
+
+
 # Run_writers takes care of forwarding BLE messages to
 # destinations defined in the configuration
-def run_writers(config, writers_q):
+def run_writers(config, writers_q, pipeline_metrics=None):
     # Instanciate all destination objects with proper configuration
     # pprint(vars(config))
-    SOURCES = list(config.SOURCES.keys())
-    unknown_mac_config = config.SOURCES.get("*", {})
     destinations = writers.Writers()
     destinations.add_writers(config.DESTINATIONS)
     destinations.setup_routing(config.SOURCES)
-    waitlist = writers.IntervalChecker(config.SOURCES)
+    if config.THROTTLE == "none":
+        waitlist = writers.IntervalChecker(config.SOURCES)
+    else:
+        # Source intervals are already applied before decoding
+        waitlist = writers.IntervalChecker(0)
+
+    # Messages may come packed, see writers_q_format
+    wire = wireformat.WireReader()
+    pipeline_metrics = metrics.bind(pipeline_metrics, metrics.WRITERS)
+    interval_drops = 0
+
+    # Latency of messages from reception to write, see tracing
+    tracer = None
+    if config.TRACE:
+        tracer = tracing.Tracer()
+        destinations.enable_tracing(tracer)
+    use_received = config.TIMESTAMP_SOURCE == "received"
 
     # Loop reading Queue and processing messages
     print("Starting run_writers loop.")
     my_timer = helpers.StopWatch()
     while True:
+        # Sleep until a message arrives, it's time to flush some writer's buffer
+        # or to publish metrics
         try:
-            mesg = writers_q.get_nowait()
+            mesg = writers_q.get(
+                timeout=destinations.time_to_flush(max_wait=defs.MAX_QUEUE_WAIT)
+            )
         except queue.Empty:
             mesg = None
+        destinations.flush_due()
+        if pipeline_metrics is not None and pipeline_metrics.publish_due():
+            publish_metrics(
+                pipeline_metrics,
+                destinations,
+                interval_drops,
+                my_timer.get_count(),
+                tracer,
+            )
 
-        if mesg and "mac" in mesg:  # got valid message, let's process it
-            # print("Got message from", mesg["mac"])
-            _now = my_timer.start()
-
-            # When packet is received, check if associated mac has configuration
-            # defined.
+        mac = None
+        if type(mesg) is bytes:  # Packed message, unpacked only if needed
+            mac = wire.mac(mesg)
+        elif wireformat.is_registration(mesg):
+            wire.register(mesg)
+        elif mesg and "mac" in mesg:
             mac = mesg["mac"]
-            mconfig = {}
-            if mac in SOURCES:
-                mconfig = config.SOURCES[mac]
-            elif unknown_mac_config:
-                mconfig = unknown_mac_config
+
+        if mac is not None:  # got valid message, let's process it
+            # print("Got message from", mac)
+            _now = my_timer.start()
 
             # Check interval and discard if last sent time less than interval
             if waitlist.is_wait_over(mac, now=_now):
-                # modify the packet as defined in configuration
+                if type(mesg) is bytes:
+                    mesg = wire.unpack(mesg)
+                trace = None
+                if config.RECEIVE_TIMES:
+                    trace, _now = take_trace(mesg, tracer, _now, use_received)
                 mesg["timestamp"] = _now  # timestamp the message
-                mesg = writers.Writer().modify_packet(mesg, mconfig)
 
-                # *** send modified packet to destinations object
+                # *** send packet to destinations object, which modifies it
+                # as defined for the source and each destination
                 # print("{} - let's write {}".format(time.ctime(wait_start), mesg))
-                destinations.send(mesg)
+                destinations.send(mesg, trace)
+            else:
+                interval_drops += 1
 
             my_timer.split()
 
@@ -70,5 +138,16 @@ def run_writers(config, writers_q):
             my_timer.MAX_SPLIT * 1000 * 1000
         )
     )
+    print("Time for writing a message: {}.".format(my_timer.summary()))
     destinations.close()
+    if tracer is not None:
+        tracer.print_stats()
+    if pipeline_metrics is not None:
+        publish_metrics(
+            pipeline_metrics,
+            destinations,
+            interval_drops,
+            my_timer.get_count(),
+            tracer,
+        )
     return
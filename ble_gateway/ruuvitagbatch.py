@@ -0,0 +1,216 @@
+#
+# Vectorized decoding of many RuuviTag RAWv1 and RAWv2 (Data Formats 3 and 5)
+# payloads at once, e.g. from replay files or micro-batches of frames.
+# Gives same values as RuuviTagRaw.decode() but in columns (numpy arrays).
+#
+
+from ble_gateway import prefilter
+
+try:
+    import numpy as np
+except ImportError:  # numpy is needed only for batch decoding
+    np = None
+
+if np is not None:
+    # Payload after manufacturer id 0x0499, see RuuviTag data format specs
+    DF3_DTYPE = np.dtype(
+        [
+            ("data_format", "u1"),
+            ("humidity", "u1"),
+            ("temperature", "u1"),
+            ("temperature_fraction", "u1"),
+            ("pressure", ">u2"),
+            ("acceleration_x", ">i2"),
+            ("acceleration_y", ">i2"),
+            ("acceleration_z", ">i2"),
+            ("battery", ">u2"),
+        ]
+    )
+    DF5_DTYPE = np.dtype(
+        [
+            ("data_format", "u1"),
+            ("temperature", ">i2"),
+            ("humidity", ">u2"),
+            ("pressure", ">u2"),
+            ("acceleration_x", ">i2"),
+            ("acceleration_y", ">i2"),
+            ("acceleration_z", ">i2"),
+            ("power_info", ">u2"),
+            ("movement_counter", "u1"),
+            ("measurement_sequence_number", ">u2"),
+        ]
+    )
+
+# Result columns in the order RuuviTagRaw.decode() returns them
+DF3_FIELDS = [
+    "data_format",
+    "humidity",
+    "temperature",
+    "pressure",
+    "acceleration",
+    "acceleration_x",
+    "acceleration_y",
+    "acceleration_z",
+    "battery",
+]
+DF5_FIELDS = [
+    "data_format",
+    "temperature",
+    "humidity",
+    "pressure",
+    "acceleration",
+    "acceleration_x",
+    "acceleration_y",
+    "acceleration_z",
+    "movement_counter",
+    "measurement_sequence_number",
+    "battery",
+    "tx_power",
+]
+# Columns which are always integers, others are floats with NaN for None
+INT_FIELDS = [
+    "data_format",
+    "acceleration",
+    "acceleration_x",
+    "acceleration_y",
+    "acceleration_z",
+]
+# Integer values in float columns, because they can be missing (NaN)
+NAN_INT_FIELDS = ["movement_counter", "measurement_sequence_number", "tx_power"]
+
+
+def ruuvi_payload(frame):
+    # Ruuvi payload (after manufacturer id) of a raw HCI advertising report,
+    # None if frame has no Ruuvi manufacturer data
+    if not prefilter.is_adv_report(frame):
+        return None
+    ad = prefilter.find_ad(frame, prefilter.AD_TYPE_MANUFACTURER)
+    if ad is None or ad[1] < 3:
+        return None
+    pos, length = ad
+    if frame[pos] != 0x99 or frame[pos + 1] != 0x04:
+        return None
+    return frame[pos + 2 : pos + length]
+
+
+def decode_batch(payloads):
+    """
+    Decode a sequence of Ruuvi payloads (bytes after manufacturer id 0x0499).
+    Returns dict of columns, each a numpy array with a row per payload:
+    - "valid": True for rows which were decoded
+    - "data_format": 3 or 5, 0 for rows which were not decoded
+    - INT_FIELDS: int64 arrays
+    - other DF3_FIELDS and DF5_FIELDS: float64 arrays, NaN where
+      RuuviTagRaw.decode() would give None or the format has no such field
+    """
+    if np is None:
+        raise RuntimeError("numpy is needed for batch decoding")
+
+    n = len(payloads)
+    columns = {"valid": np.zeros(n, dtype=bool)}
+    for field in DF5_FIELDS:
+        if field in INT_FIELDS:
+            columns[field] = np.zeros(n, dtype=np.int64)
+        else:
+            columns[field] = np.full(n, np.nan)
+
+    for data_format, dtype in ((3, DF3_DTYPE), (5, DF5_DTYPE)):
+        rows = [
+            i
+            for i, p in enumerate(payloads)
+            if len(p) >= dtype.itemsize and p[0] == data_format
+        ]
+        if not rows:
+            continue
+        raw = np.frombuffer(
+            b"".join(bytes(payloads[i][: dtype.itemsize]) for i in rows), dtype=dtype
+        )
+        rows = np.array(rows)
+        decoded = _decode_df3(raw) if data_format == 3 else _decode_df5(raw)
+        for field, values in decoded.items():
+            columns[field][rows] = values
+        columns["data_format"][rows] = data_format
+        columns["valid"][rows] = True
+    return columns
+
+
+def _round(values, ndigits):
+    # Same as python round() for each value. np.round() rounds half way
+    # values to even, but python rounds the exact binary value, which is
+    # a bit above or below half way, so (nearly) half way values are
+    # rounded with python.
+    result = np.round(values, ndigits)
+    scaled = values * 10**ndigits
+    ties = np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6)
+    if len(ties):
+        result[ties] = [round(v, ndigits) for v in values[ties].tolist()]
+    return result
+
+
+def _acceleration(raw):
+    dx = raw["acceleration_x"].astype(np.int64)
+    dy = raw["acceleration_y"].astype(np.int64)
+    dz = raw["acceleration_z"].astype(np.int64)
+    return {
+        "acceleration": np.round(np.sqrt(dx * dx + dy * dy + dz * dz)).astype(np.int64),
+        "acceleration_x": dx,
+        "acceleration_y": dy,
+        "acceleration_z": dz,
+    }
+
+
+def _decode_df3(raw):
+    # Temperature has sign in the first bit and fraction in separate byte
+    temp = raw["temperature"]
+    temperature = (temp & 0x7F) + raw["temperature_fraction"] / 100.0
+    temperature = np.where(temp & 0x80, -temperature, temperature)
+    result = {
+        "humidity": _round(raw["humidity"] / 2.0, 1),
+        "temperature": _round(temperature, 2),
+        "pressure": _round((raw["pressure"] + 50000.0) * (1 / 100), 2),
+        "battery": _round(raw["battery"] * (1 / 1000), 2),
+    }
+    result.update(_acceleration(raw))
+    return result
+
+
+def _decode_df5(raw):
+    # Battery voltage and tx power share power_info, all bits set = missing
+    power = raw["power_info"].astype(np.int64)
+    battery = _round(((power >> 5) + 1600) * (1 / 1000), 2)
+    tx_power = ((power & 0b11111) * 2 - 40).astype(np.float64)
+    result = {
+        "temperature": _round(raw["temperature"] / 200, 2),
+        "humidity": _round(raw["humidity"] / 400, 1),
+        "pressure": _round((raw["pressure"] + 50000.0) * (1 / 100), 2),
+        "movement_counter": raw["movement_counter"].astype(np.float64),
+        "measurement_sequence_number": raw["measurement_sequence_number"].astype(
+            np.float64
+        ),
+        "battery": np.where(power >> 5 == 0b11111111111, np.nan, battery),
+        "tx_power": np.where(power & 0b11111 == 0b11111, np.nan, tx_power),
+    }
+    result.update(_acceleration(raw))
+    return result
+
+
+def to_records(columns):
+    # Columns from decode_batch() to list of dicts as RuuviTagRaw.decode()
+    # gives them, None for rows which were not decoded
+    lists = {k: v.tolist() for k, v in columns.items()}
+    records = []
+    for i, valid in enumerate(lists["valid"]):
+        if not valid:
+            records.append(None)
+            continue
+        fields = DF3_FIELDS if lists["data_format"][i] == 3 else DF5_FIELDS
+        record = {}
+        for field in fields:
+            value = lists[field][i]
+            if value != value:  # NaN
+                value = None
+            elif field in NAN_INT_FIELDS:
+                value = int(value)
+            record[field] = value
+        records.append(record)
+    return records
@@ -24,6 +24,7 @@
 # IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
 
 from math import sqrt
+from struct import Struct
 
 #
 # A few convenience functions
@@ -45,12 +46,18 @@ def rshift(val, n):
 
 
 def scale_n_round(d, key, scale, digits):
-    if key in d:
+    if d.get(key) is not None:
         d[key] = round(d[key] * scale, digits)
 
 
 # Ruuvi tag stuffs
 
+# Raw data formats following the manufacturer id 0x0499:
+# format, humidity, temperature, temperature fraction, pressure, acc x, y, z, battery
+_DF3 = Struct(">BBBBHhhhH")
+# format, temperature, humidity, pressure, acc x, y, z, power info, movement, sequence
+_DF5 = Struct(">BhHHhhhHBH")
+
 
 class RuuviTagRaw(object):
     """
@@ -133,11 +140,12 @@ class RuuviTagRaw(object):
         mfg_specific_data = packet.retrieve("Payload for mfg_specific_data")
         if mfg_specific_data:
             val = mfg_specific_data[0].val
-            if val[0] == 0x99 and val[1] == 0x04:  # looks like Ruuvi
+            if val[:2] == b"\x99\x04":  # looks like Ruuvi
                 val = val[2:]
-                if val[0] == 0x03:  # data format 3
+                # Too short payloads are not decoded, as in decode_frame()
+                if val[:1] == b"\x03" and len(val) >= _DF3.size:  # data format 3
                     self._decode_df3(val, result)
-                elif val[0] == 0x05:  # data format 5
+                elif val[:1] == b"\x05" and len(val) >= _DF5.size:  # data format 5
                     self._decode_df5(val, result)
                 else:
                     return None
@@ -152,3 +160,70 @@ class RuuviTagRaw(object):
                 return result
 
         return None
+
+    def decode_frame(self, frame):
+        """
+        Fast path for decode(): decodes Ruuvi data directly from a raw HCI
+        advertising report (bytes or memoryview) without building aioblescan
+        objects. Returns rssi and same result as decode(), or None if frame
+        is not a well formed RAWv1/RAWv2 advertisement.
+        """
+        # Walk AD structures (length, type, data) until rssi at the last byte
+        pos = 14
+        end = len(frame) - 1
+        mfg = None
+        while pos < end:
+            length = frame[pos]
+            if length == 0:
+                return None
+            if mfg is None and frame[pos + 1] == 0xFF:
+                mfg = pos + 2
+                mfg_end = pos + 1 + length
+            pos += 1 + length
+        if pos != end or mfg is None:
+            return None
+        if frame[mfg] != 0x99 or frame[mfg + 1] != 0x04:
+            return None
+        mfg += 2
+
+        if frame[mfg] == 0x03 and mfg_end - mfg >= _DF3.size:
+            (_, hum, temp, frac, pres, dx, dy, dz, batt) = _DF3.unpack_from(frame, mfg)
+            result = {
+                "data_format": 3,
+                "humidity": round(hum / 2.0, 1),
+                "temperature": round(self._helper_temp_df3(temp, frac), 2),
+                "pressure": round((pres + 50000) * (1 / 100), 2),
+                "acceleration": round(sqrt(dx ** 2 + dy ** 2 + dz ** 2), None),
+                "acceleration_x": dx,
+                "acceleration_y": dy,
+                "acceleration_z": dz,
+                "battery": round(batt * (1 / 1000), 2),
+            }
+        elif frame[mfg] == 0x05 and mfg_end - mfg >= _DF5.size:
+            (_, temp, hum, pres, dx, dy, dz, power, move, seq) = _DF5.unpack_from(
+                frame, mfg
+            )
+            battery = tx_power = None
+            if power >> 5 != 0b11111111111:
+                battery = round(((power >> 5) + 1600) * (1 / 1000), 2)
+            if power & 0b11111 != 0b11111:
+                tx_power = (power & 0b11111) * 2 - 40
+            result = {
+                "data_format": 5,
+                "temperature": round(temp / 200, 2),
+                "humidity": round(hum / 400, 1),
+                "pressure": round((pres + 50000) * (1 / 100), 2),
+                "acceleration": round(sqrt(dx ** 2 + dy ** 2 + dz ** 2), None),
+                "acceleration_x": dx,
+                "acceleration_y": dy,
+                "acceleration_z": dz,
+                "movement_counter": move,
+                "measurement_sequence_number": seq,
+                "battery": battery,
+                "tx_power": tx_power,
+            }
+        else:
+            return None
+
+        rssi = frame[end]
+        return rssi - 256 if rssi > 127 else rssi, result
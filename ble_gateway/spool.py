@@ -0,0 +1,272 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+class Spool:
+    """
+    Write-ahead spool on disk for batches a writer could not write, e.g.
+    while InfluxDB is down. Batches are lists of serialized records
+    (strings, e.g. line protocol lines) and are replayed in order.
+
+    Batches are appended to memory-mapped segment files of segment_size
+    bytes in directory. Each batch is stored as a header and records
+    joined by newlines:
+      length of data (4 bytes), number of records (4 bytes),
+      time.time() when spooled (8 bytes), data
+    Zero length marks the end of written data in a segment.
+
+    Position of the oldest batch not yet replayed is saved in file
+    "cursor", so that replay continues where it was after a restart.
+    Cursor is always in the oldest segment, replayed segments are
+    deleted. If spool grows over max_bytes, oldest segments are deleted
+    and their records are lost.
+
+    Writer:  append(records)
+    Replay:  records, position = read(max_records), write records,
+             commit(position) if they were written
+    """
+
+    _HEADER = struct.Struct("<IId")
+    _SUFFIX = ".seg"
+    DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+    DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+    def __init__(
+        self,
+        directory,
+        segment_size=DEFAULT_SEGMENT_SIZE,
+        max_bytes=DEFAULT_MAX_BYTES,
+        fsync=True,
+    ):
+        self.directory = directory
+        self.segment_size = max(self._HEADER.size * 2, int(segment_size))
+        self.max_bytes = int(max_bytes)
+        self.fsync = fsync  # Flush each appended batch to disk
+        self.lock = threading.Lock()  # Batches may be spooled from many threads
+        self.stats = {
+            "spooled": 0,  # Records appended
+            "replayed": 0,  # Records committed as written
+            "dropped": 0,  # Records deleted because spool was full
+        }
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(
+            int(f[: -len(self._SUFFIX)])
+            for f in os.listdir(directory)
+            if f.endswith(self._SUFFIX) and f[: -len(self._SUFFIX)].isdigit()
+        )
+        self.cursor = self._load_cursor()
+        self._map = None  # Memory map of the segment being written
+        self._write_pos = 0
+        self._counts = {}  # Segment -> records in it not yet replayed
+        self._pending = 0  # Sum of _counts, updated under lock
+        for seg in [s for s in self.segments if s < self.cursor[0]]:
+            self._remove(seg)  # Replayed, but not deleted before a restart
+        if self.segments:
+            self._open_segment(self.segments[-1], self.segment_size)
+            self._write_pos = self._end_of_data(self._map)
+        self._fix_cursor()
+        for seg in self.segments:
+            self._counts[seg] = self._count(seg, self._start(seg))
+            self._pending += self._counts[seg]
+
+    @classmethod
+    def from_config(cls, name, sconfig):
+        # Spool of writer 'name' as defined in its 'spool' setting,
+        # None if spooling is not enabled
+        if not sconfig:
+            return None
+        if not isinstance(sconfig, dict):
+            sconfig = {"directory": sconfig}
+        return cls(
+            os.path.join(sconfig.get("directory", "spool"), name),
+            sconfig.get("segment_size", cls.DEFAULT_SEGMENT_SIZE),
+            sconfig.get("max_bytes", cls.DEFAULT_MAX_BYTES),
+            sconfig.get("fsync", True),
+        )
+
+    def _path(self, seg):
+        return os.path.join(self.directory, "{:010d}{}".format(seg, self._SUFFIX))
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, "cursor")) as f:
+                seg, pos = f.read().split()
+                return int(seg), int(pos)
+        except (OSError, ValueError):
+            return (self.segments[0], 0) if self.segments else (0, 0)
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, "cursor")
+        with open(path + ".tmp", "w") as f:
+            f.write("{} {}".format(*self.cursor))
+        os.replace(path + ".tmp", path)
+
+    def _start(self, seg):
+        # Position of first batch not replayed in segment seg
+        return self.cursor[1] if seg == self.cursor[0] else 0
+
+    def _fix_cursor(self):
+        # Move cursor to the start of the oldest segment, if its
+        # segment has been deleted
+        if self.segments and self.cursor[0] < self.segments[0]:
+            self.cursor = (self.segments[0], 0)
+            self._save_cursor()
+
+    def _open_segment(self, seg, size=0):
+        if self._map is not None:
+            self._map.close()
+        path = self._path(seg)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)  # Sparse file, reads as zeros
+            self._map = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+
+    def _end_of_data(self, buf, pos=0):
+        while pos + self._HEADER.size <= len(buf):
+            length = self._HEADER.unpack_from(buf, pos)[0]
+            if length == 0:
+                break
+            pos += self._HEADER.size + length
+        return pos
+
+    def _batches(self, seg, pos):
+        # (position, number of records, time spooled, data) of batches
+        # in segment seg starting from pos
+        if self._map is not None and seg == self.segments[-1]:
+            buf = self._map
+        else:
+            with open(self._path(seg), "rb") as f:
+                buf = f.read()
+        while pos + self._HEADER.size <= len(buf):
+            length, count, spooled_t = self._HEADER.unpack_from(buf, pos)
+            if length == 0:
+                break
+            start = pos + self._HEADER.size
+            yield pos, count, spooled_t, buf[start : start + length]
+            pos = start + length
+
+    def _count(self, seg, pos):
+        return sum(count for p, count, t, d in self._batches(seg, pos))
+
+    def _bytes(self):
+        return sum(os.path.getsize(self._path(seg)) for seg in self.segments)
+
+    def append(self, records):
+        # Spool a batch of records (strings)
+        if not records:
+            return
+        data = "\n".join(records).encode()
+        size = self._HEADER.size + len(data)
+        with self.lock:
+            if self._map is None or self._write_pos + size + self._HEADER.size > len(
+                self._map
+            ):
+                self._rotate(size + self._HEADER.size)
+            self._HEADER.pack_into(
+                self._map, self._write_pos, len(data), len(records), time.time()
+            )
+            start = self._write_pos + self._HEADER.size
+            self._map[start : start + len(data)] = data
+            if self.fsync:
+                self._map.flush()
+            self._write_pos += size
+            self._counts[self.segments[-1]] += len(records)
+            self._pending += len(records)
+            self.stats["spooled"] += len(records)
+
+    def _rotate(self, size):
+        # Start a new segment with room for at least size bytes
+        seg = (self.segments[-1] if self.segments else self.cursor[0]) + 1
+        size = max(self.segment_size, size)
+        for old in list(self.segments):
+            if not self._counts[old]:
+                self._remove(old)  # Fully replayed
+        while self.segments and self._bytes() + size > self.max_bytes:
+            self._drop_oldest()
+        self.segments.append(seg)
+        self._counts[seg] = 0
+        self._open_segment(seg, size)
+        self._write_pos = 0
+        self._fix_cursor()
+
+    def _drop_oldest(self):
+        seg = self.segments[0]
+        dropped = self._counts[seg]
+        self.stats["dropped"] += dropped
+        self._remove(seg)
+        self._fix_cursor()
+        print("Spool {} full, {} records dropped.".format(self.directory, dropped))
+
+    def _remove(self, seg):
+        self.segments.remove(seg)
+        self._pending -= self._counts.pop(seg, 0)
+        if not self.segments and self._map is not None:
+            self._map.close()
+            self._map = None
+        os.remove(self._path(seg))
+
+    def pending(self):
+        # Records not yet replayed, may be asked from any thread
+        return self._pending
+
+    def lag(self, now=None):
+        # Seconds the oldest batch not replayed has been spooled, 0 if none
+        with self.lock:
+            for seg in self.segments:
+                for pos, count, spooled_t, data in self._batches(seg, self._start(seg)):
+                    return max(0.0, (now or time.time()) - spooled_t)
+        return 0.0
+
+    def read(self, max_records):
+        # Oldest batches not replayed, max_records records but at least one
+        # batch. Returns (records, position to commit() after writing them).
+        records = []
+        with self.lock:
+            position = self.cursor
+            for seg in self.segments:
+                for pos, count, spooled_t, data in self._batches(seg, self._start(seg)):
+                    if records and len(records) + count > max_records:
+                        return records, position
+                    records.extend(bytes(data).decode().split("\n"))
+                    position = (seg, pos + self._HEADER.size + len(data))
+        return records, position
+
+    def commit(self, position):
+        # Records up to position have been written, remove them from spool
+        with self.lock:
+            pending = self._pending
+            seg, pos = position
+            for old in [s for s in self.segments if s < seg]:
+                self._remove(old)  # Fully replayed
+            if seg in self._counts and (seg, pos) > self.cursor:
+                self.cursor = position
+                count = self._count(seg, pos)
+                self._pending += count - self._counts[seg]
+                self._counts[seg] = count
+                if not self._counts[seg] and seg != self.segments[-1]:
+                    self._remove(seg)  # Fully replayed and no longer written
+            self._fix_cursor()
+            self._save_cursor()
+            self.stats["replayed"] += pending - self._pending
+
+    def close(self):
+        with self.lock:
+            if self._map is not None:
+                self._map.flush()
+                self._map.close()
+                self._map = None
+            self._save_cursor()
+
+    def print_stats(self, name=""):
+        print(
+            "Spool{}: {spooled} records spooled, {replayed} replayed, "
+            "{dropped} dropped, {pending} pending, replay lag {lag:.1f} secs.".format(
+                name, pending=self.pending(), lag=self.lag(), **self.stats
+            )
+        )
@@ -0,0 +1,111 @@
+#
+# End-to-end latency tracing of messages.
+#
+# run_ble takes time.time() when a frame is received and it is carried
+# with the frame to decoding. Decoder adds the times when the batch of
+# the frame was taken from queue and when the frame was decoded to the
+# message as fields RECEIVED, DEQUEUED and DECODED. Writers process takes
+# them out of the message, and writers which acknowledge writes (InfluxDB
+# and file) close the trace when the batch of the message is written.
+#
+# Stages:
+#   to_decoder   received in run_ble .. taken from decoder queue
+#   decode       taken from decoder queue .. decoded
+#   to_writers   decoded .. received by writers process
+#   writer:NAME  received by writers process .. written by writer NAME
+#   total:NAME   received in run_ble .. written by writer NAME
+#
+
+import threading
+import time
+
+from ble_gateway import helpers
+
+RECEIVED = "_received"
+DEQUEUED = "_dequeued"
+DECODED = "_decoded"
+STAGES = ("to_decoder", "decode", "to_writers")
+
+
+def stage_names(destinations):
+    # All stages of writers in destinations
+    names = list(STAGES)
+    for name in destinations:
+        names += ["writer:" + name, "total:" + name]
+    return names
+
+
+def stamp(mesg, received, dequeued=None):
+    # Add trace times to decoded message
+    mesg[RECEIVED] = received
+    if dequeued is not None:
+        mesg[DEQUEUED] = dequeued
+        mesg[DECODED] = time.time()
+
+
+def take(mesg):
+    # Remove trace times from message, returns (received, dequeued, decoded),
+    # None for each time not in message
+    return (
+        mesg.pop(RECEIVED, None),
+        mesg.pop(DEQUEUED, None),
+        mesg.pop(DECODED, None),
+    )
+
+
+class Tracer:
+    """
+    Latency histograms of stages, in nanoseconds. Stages up to writers
+    process are recorded by begin(), which returns the trace to pass to
+    writers with the message, and writer stages by acknowledge() when a
+    writer has written the messages of traces.
+    """
+
+    def __init__(self):
+        self.histograms = {stage: helpers.Histogram() for stage in STAGES}
+        self.lock = threading.Lock()  # Writers acknowledge in their own threads
+
+    def _record(self, stage, start, end):
+        if start is not None and end is not None:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = helpers.Histogram()
+            histogram.record(int((end - start) * 1e9))
+
+    def begin(self, times, now):
+        # times = (received, dequeued, decoded) from take(), now = time
+        # message was received by writers process. Returns trace.
+        received, dequeued, decoded = times
+        with self.lock:
+            self._record("to_decoder", received, dequeued)
+            self._record("decode", dequeued, decoded)
+            self._record("to_writers", decoded, now)
+        return (received, now)
+
+    def acknowledge(self, name, traces, now=None):
+        # Messages of traces were written by writer name
+        if now is None:
+            now = time.time()
+        with self.lock:
+            for trace in traces:
+                if trace is not None:
+                    self._record("writer:" + name, trace[1], now)
+                    self._record("total:" + name, trace[0], now)
+
+    def percentiles(self, p):
+        # {stage: seconds at percentile p}
+        with self.lock:
+            return {
+                stage: histogram.percentile(p) / 1e9
+                for stage, histogram in self.histograms.items()
+            }
+
+    def print_stats(self):
+        with self.lock:
+            for stage, histogram in self.histograms.items():
+                if histogram.count:
+                    print(
+                        "Latency {}: {} messages, {}.".format(
+                            stage, histogram.count, histogram.summary(1e6, "ms")
+                        )
+                    )
@@ -0,0 +1,231 @@
+#
+# Compact binary encoding of decoded messages sent to writers process.
+#
+# Layout of each kind of message (field names and value types, e.g. all
+# RuuviTag DF5 messages) is sent once as a registration tuple
+#   (LAYOUT, producer, layout id, field names, value codes)
+# and then each message as bytes:
+#   producer (1 byte), layout id (2 bytes), mac (6 bytes), packed values,
+#   strings as length (2 bytes) and utf-8 bytes
+# Value codes: i = int32, q = int64, d = float, ? = bool, s = string,
+# n = None, m = mac in header. Messages with other value types are sent
+# as they are (pickled).
+#
+# Each process sending messages has its own producer number, so that
+# layout ids of several decoder workers don't collide. Layout is sent
+# before any message using it on the same queue, so it is registered
+# before the message is read.
+#
+
+import struct
+from operator import itemgetter
+
+from ble_gateway.measurement import Measurement, Schema
+
+LAYOUT = "LAYOUT"
+_HEADER = struct.Struct("<BH6s")
+_LENGTH = struct.Struct("<H")
+_NO_MAC = bytes(6)
+_FIXED_CODES = {int: "i", float: "d", bool: "?"}
+
+
+def _to_mac(mac_b):
+    return ":".join("{:02x}".format(b) for b in mac_b)
+
+
+def _getter(indexes):
+    # Function returning tuple of items at indexes, also for 0 or 1 index
+    if len(indexes) > 1:
+        return itemgetter(*indexes)
+    if indexes:
+        i = indexes[0]
+        return lambda row: (row[i],)
+    return lambda row: ()
+
+
+class Layout:
+    # Packing and unpacking of messages with the same keys and value codes
+
+    def __init__(self, producer, layout_id, keys, codes):
+        self.producer = producer
+        self.id = layout_id
+        self.keys = keys
+        self.codes = codes
+        self.schema = Schema.of(keys)
+        fixed = [i for i, c in enumerate(codes) if c in "iqd?"]
+        self.strings = [i for i, c in enumerate(codes) if c == "s"]
+        self.struct = struct.Struct(_HEADER.format + "".join(codes[i] for i in fixed))
+        self.get_fixed = _getter(fixed)
+        # Unpacked values are (fixed values..., strings..., mac, None),
+        # order picks them to fields in message order
+        order = []
+        n = len(fixed) + len(self.strings)
+        for i, c in enumerate(codes):
+            if c in "iqd?":
+                order.append(fixed.index(i))
+            elif c == "s":
+                order.append(len(fixed) + self.strings.index(i))
+            elif c == "m":
+                order.append(n)
+            else:
+                order.append(n + 1)
+        self.order = _getter(order)
+
+    def registration(self):
+        return (LAYOUT, self.producer, self.id, self.keys, self.codes)
+
+    def pack(self, row, mac):
+        data = self.struct.pack(self.producer, self.id, mac, *self.get_fixed(row))
+        if not self.strings:
+            return data
+        parts = [data]
+        for i in self.strings:
+            s = row[i].encode()
+            parts.append(_LENGTH.pack(len(s)))
+            parts.append(s)
+        return b"".join(parts)
+
+    def unpack(self, data, mac):
+        values = self.struct.unpack_from(data)[3:]
+        if self.strings:
+            pos = self.struct.size
+            strings = []
+            for i in self.strings:
+                length = _LENGTH.unpack_from(data, pos)[0]
+                pos += _LENGTH.size
+                strings.append(data[pos : pos + length].decode())
+                pos += length
+            values += tuple(strings)
+        return Measurement(self.schema, list(self.order(values + (mac, None))))
+
+
+class WireWriter:
+    """
+    Sends messages packed to queue, has the same put() as the queue.
+    producer = number of the sending process, 0..255.
+    """
+
+    MAX_LAYOUTS = 65536
+
+    def __init__(self, queue, producer=0):
+        self.queue = queue
+        self.producer = producer
+        self.layouts = {}  # (schema, value types, mac in header, wide) -> Layout
+        self._macs = {}  # mac string -> 6 bytes, None if not a mac
+        self.packed = 0
+        self.pickled = 0
+
+    def mac_bytes(self, mac):
+        mac_b = self._macs.get(mac, False)
+        if mac_b is False:
+            mac_b = None
+            if isinstance(mac, str) and len(mac) == 17:
+                try:
+                    mac_b = bytes.fromhex(mac.replace(":", ""))
+                except ValueError:
+                    pass
+                if mac_b is not None and (len(mac_b) != 6 or _to_mac(mac_b) != mac):
+                    mac_b = None  # Would not be decoded back as the same string
+            if len(self._macs) >= 10000:
+                self._macs.clear()
+            self._macs[mac] = mac_b
+        return mac_b
+
+    def put(self, mesg):
+        if type(mesg) is not Measurement or len(self.layouts) >= self.MAX_LAYOUTS:
+            self.pickled += 1
+            self.queue.put(mesg)
+            return
+        row = mesg.row
+        types = tuple(map(type, row))
+        mac = self.mac_bytes(mesg.get("mac"))
+        layout = self.layouts.get((mesg.schema, types, mac is not None, False))
+        if layout is None:
+            layout = self._layout(mesg, types, mac is not None, False)
+        if layout is not False:
+            try:
+                data = layout.pack(row, mac or _NO_MAC)
+            except struct.error:  # Integer doesn't fit to 32 bits
+                layout = self._layout(mesg, types, mac is not None, True)
+                try:
+                    data = layout.pack(row, mac or _NO_MAC)
+                except struct.error:  # or to 64 bits
+                    layout = False
+        if layout is False:
+            self.pickled += 1
+            self.queue.put(mesg)
+        else:
+            self.packed += 1
+            self.queue.put(data)
+
+    def _layout(self, mesg, types, mac_in_header, wide):
+        # New layout for messages like mesg, registered to reader thru queue.
+        # False if message has values which can't be packed.
+        key = (mesg.schema, types, mac_in_header, wide)
+        layout = self.layouts.get(key)
+        if layout is not None:
+            return layout
+        codes = []
+        for k, t in zip(mesg.schema.keys, types):
+            if k == "mac" and mac_in_header:
+                codes.append("m")
+            elif t is int:
+                codes.append("q" if wide else "i")
+            elif t in _FIXED_CODES:
+                codes.append(_FIXED_CODES[t])
+            elif t is str:
+                codes.append("s")
+            elif t is type(None):
+                codes.append("n")
+            else:
+                self.layouts[key] = False
+                return False
+        layout = Layout(
+            self.producer, len(self.layouts), mesg.schema.keys, "".join(codes)
+        )
+        self.layouts[key] = layout
+        self.queue.put(layout.registration())
+        return layout
+
+
+class WireReader:
+    # Unpacks messages sent by WireWriters
+
+    def __init__(self):
+        self.layouts = {}  # (producer, layout id) -> Layout
+        self._macs = {}  # 6 bytes -> mac string
+
+    def register(self, registration):
+        tag, producer, layout_id, keys, codes = registration
+        self.layouts[producer, layout_id] = Layout(producer, layout_id, keys, codes)
+
+    def _mac(self, mac_b):
+        mac = self._macs.get(mac_b)
+        if mac is None:
+            if len(self._macs) >= 10000:
+                self._macs.clear()
+            mac = self._macs[mac_b] = _to_mac(mac_b)
+        return mac
+
+    def mac(self, data):
+        # Mac of packed message without unpacking the rest of it
+        producer, layout_id, mac_b = _HEADER.unpack_from(data)
+        layout = self.layouts[producer, layout_id]
+        if "m" in layout.codes:
+            return self._mac(mac_b)
+        return layout.unpack(data, None).get("mac")
+
+    def unpack(self, data):
+        producer, layout_id, mac_b = _HEADER.unpack_from(data)
+        return self.layouts[producer, layout_id].unpack(data, self._mac(mac_b))
+
+
+def is_registration(mesg):
+    return type(mesg) is tuple and mesg and mesg[0] == LAYOUT
+
+
+def sender(config, writers_q, producer=0):
+    # Queue or WireWriter to send decoded messages to writers
+    if config.WRITERS_Q_FORMAT == "struct":
+        return WireWriter(writers_q, producer)
+    return writers_q
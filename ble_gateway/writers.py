@@ -1,39 +1,131 @@
+import concurrent.futures
+import csv
+import gzip
+import http.client
+import json
+import os
+import queue
+import shutil
+import threading
 import time
-from queue import SimpleQueue
+import urllib.parse
+from collections import deque
 
 from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
 
-from ble_gateway import helpers
+from ble_gateway import defs, helpers, lineprotocol, spool
+from ble_gateway.measurement import Measurement, as_dict, compile_steps
+
+
+def estimate_size(mesg):
+    # Rough size in bytes of message when written, e.g. as line protocol
+    size = 0
+    for key, value in mesg.items():
+        size += len(key) + len(str(value)) + 2
+    return size
 
 
 class MessageBuffer:
-    def __init__(self, batch_size):
-        self._buffer = SimpleQueue()
+    # Batch of messages, ready to be written when batch_size messages or
+    # max_bytes (estimated) are buffered or oldest message has waited
+    # max_latency seconds. Zero max_latency or max_bytes means no limit.
+    def __init__(self, batch_size, max_latency=0, max_bytes=0):
+        self._buffer = deque()
+        self._bytes = 0  # Estimated size of buffered messages if max_bytes is set
+        self._oldest_t = None  # time.monotonic() when oldest message was buffered
         self.set_batch_size(batch_size)
+        self.set_max_latency(max_latency)
+        self.set_max_bytes(max_bytes)
 
     def put(self, mesg):
-        self._buffer.put(mesg)
-        return self.batch_size - self._buffer.qsize()
+        if self._oldest_t is None:
+            self._oldest_t = time.monotonic()
+        if self.max_bytes:
+            size = estimate_size(mesg)
+            self._bytes += size
+            self._buffer.append((mesg, size))
+        else:
+            self._buffer.append((mesg, 0))
+        return self.batch_size - len(self._buffer)
 
     def get(self):
-        if not self._buffer.empty():
-            return self._buffer.get()
+        if self._buffer:
+            mesg, size = self._buffer.popleft()
+            self._bytes -= size
+            if not self._buffer:
+                self._oldest_t = None
+                self._bytes = 0
+            return mesg
         return None
 
-    def is_batch_ready(self):
-        return self.batch_size <= self._buffer.qsize()
+    def is_batch_ready(self, now=None):
+        if self.batch_size <= len(self._buffer):
+            return True
+        if self.max_bytes and self.max_bytes <= self._bytes:
+            return True
+        # Partial batch is ready if oldest message has waited max_latency
+        deadline = self.deadline()
+        if deadline is None:
+            return False
+        if now is None:
+            now = time.monotonic()
+        return deadline <= now
+
+    def deadline(self):
+        # time.monotonic() by which buffered messages should be flushed,
+        # None if buffer is empty or max_latency not set
+        if self._oldest_t is None or not self.max_latency:
+            return None
+        return self._oldest_t + self.max_latency
+
+    def restart_deadline(self, now=None):
+        # Give remaining messages another max_latency to get flushed
+        if self._oldest_t is not None:
+            self._oldest_t = time.monotonic() if now is None else now
 
     def empty(self):
-        return self._buffer.empty()
+        return not self._buffer
+
+    def qsize(self):
+        return len(self._buffer)
+
+    def nbytes(self):
+        # Estimated size of buffered messages, 0 if max_bytes is not set
+        return self._bytes
 
     def set_batch_size(self, batch_size):
-        if batch_size < 1 or not isinstance(batch_size, (int, float)):
+        if not isinstance(batch_size, (int, float)) or batch_size < 1:
             batch_size = 1
         self.batch_size = int(batch_size)
 
     def get_batch_size(self):
         return self.batch_size
 
+    def set_max_latency(self, max_latency):
+        if not isinstance(max_latency, (int, float)) or max_latency < 0:
+            max_latency = 0
+        self.max_latency = max_latency
+
+    def set_max_bytes(self, max_bytes):
+        if not isinstance(max_bytes, (int, float)) or max_bytes < 0:
+            max_bytes = 0
+        self.max_bytes = int(max_bytes)
+
+    @classmethod
+    def from_config(cls, wconfig):
+        # Writer's 'batch' setting is either batch size or a mapping
+        # {size: N, max_latency: SECS, max_bytes: BYTES}. max_latency and
+        # max_bytes can be given also directly in writer's configuration.
+        batch = wconfig.get("batch", 0)
+        if not isinstance(batch, dict):
+            batch = {"size": batch}
+        return cls(
+            batch.get("size", 0),
+            batch.get("max_latency", wconfig.get("max_latency", 0)),
+            batch.get("max_bytes", wconfig.get("max_bytes", 0)),
+        )
+
 
 class IntervalChecker:
     def __init__(self, config=None):
@@ -76,9 +168,128 @@ class IntervalChecker:
         return True
 
 
+def _parse_pairs(fields, what):
+    # ["from=to", ...] -> [("from", "to"), ...]
+    pairs = []
+    for f in fields:
+        (t, _, v) = str(f).partition("=")
+        if t and v:
+            pairs.append((t, v))
+        else:
+            print("Invalid {} '{}', ignored.".format(what, f))
+    return pairs
+
+
+def _remove_fields(mesg, fields):
+    for f in fields:
+        if f in mesg:
+            mesg.pop(f)
+    return mesg
+
+
+def _rename_fields(mesg, pairs):
+    # NOTE! this will not preserve order of the fields
+    for (t, v) in pairs:
+        if t in mesg:
+            mesg[v] = mesg.pop(t)
+    return mesg
+
+
+def _add_fields(mesg, fields):
+    mesg.update(fields)
+    return mesg
+
+
+def _uppercase_values(mesg, fields):
+    for f in fields:
+        if f in mesg:
+            value = mesg[f]
+            if isinstance(value, str):
+                mesg[f] = value.upper()
+    return mesg
+
+
+def _order_fields(mesg, fields):
+    ordered_fields = {}
+    for f in fields:
+        if f in mesg:
+            ordered_fields[f] = mesg.pop(f)
+    return {**ordered_fields, **mesg}
+
+
+class TransformPlan:
+    """
+    Message modifications of a source or destination configuration,
+    parsed once to a list of steps:
+    1. fields_remove  2. fields_rename  3. fields_add  4. values_uppercase
+    5. fields_order
+    Plans are combined with +, e.g. source plan + destination plan.
+    For Measurements the steps are compiled once per schema to a
+    function which builds the modified measurement directly.
+    """
+
+    MAX_COMPILED = 1000
+
+    def __init__(self, mconfig=None):
+        mconfig = mconfig or {}
+        steps = [
+            (_remove_fields, tuple(mconfig.get("fields_remove") or [])),
+            (
+                _rename_fields,
+                tuple(_parse_pairs(mconfig.get("fields_rename") or [], "rename")),
+            ),
+            (_add_fields, dict(_parse_pairs(mconfig.get("fields_add") or [], "field"))),
+            (_uppercase_values, tuple(mconfig.get("values_uppercase") or [])),
+            (_order_fields, tuple(mconfig.get("fields_order") or [])),
+        ]
+        # Steps with nothing to do are left out
+        self.steps = tuple((func, arg) for func, arg in steps if arg)
+        self._compiled = {}  # Schema -> function building modified measurement
+
+    def __add__(self, other):
+        plan = TransformPlan()
+        plan.steps = self.steps + other.steps
+        return plan
+
+    def apply(self, mesg):
+        # Modified message, mesg itself may be modified
+        if not self.steps:
+            return mesg
+        if type(mesg) is Measurement:
+            return self._build(mesg)
+        for func, arg in self.steps:
+            mesg = func(mesg, arg)
+        return mesg
+
+    def apply_to_copy(self, mesg):
+        # Modified copy of message, mesg is not modified
+        if type(mesg) is Measurement and self.steps:
+            return self._build(mesg)
+        return self.apply(mesg.copy())
+
+    def _build(self, mesg):
+        # Modified measurement built by steps compiled for its schema
+        build = self._compiled.get(mesg.schema)
+        if build is None:
+            if len(self._compiled) >= self.MAX_COMPILED:
+                self._compiled.clear()
+            build = compile_steps(mesg.schema, self.steps, _uppercase_values)
+            self._compiled[mesg.schema] = build
+        return build(mesg)
+
+
+def _retryable(status):
+    # Write failed with HTTP status which may succeed later, e.g. server
+    # error or too many requests. Other errors are client errors.
+    return status is None or status >= 500 or status == 429
+
+
 class Writer:
     # Parent class for all the writer classes
     type = "WriterBaseClass"
+    threaded = True  # Run in own WriterWorker thread if destination allows
+    can_spool = False  # Implements _write_records() for replaying spool
+    acks = False  # Acknowledges written messages, closing their traces
 
     def __init__(self, name=None, wconfig={}):
         if name:
@@ -86,9 +297,18 @@ class Writer:
         else:
             self.name = self.type
         self.packetcount = 0
+        # Messages written in batches and nanoseconds to write each batch
+        self.batch_messages = 0
+        self.batch_times = helpers.Histogram()
         self.waitlist = IntervalChecker(wconfig.get("interval", 0))
-        self.buffer = MessageBuffer(wconfig.get("batch", 0))
+        self.buffer = MessageBuffer.from_config(wconfig)
         self.config = wconfig
+        self.plan = TransformPlan(wconfig)
+        self.tracer = None
+        self.traces = None  # Traces of buffered messages, if tracing
+        self.spool = None
+        if wconfig.get("spool"):
+            self.setup_spool(wconfig)
         # Lastly call configure:
         self.configure(wconfig)
 
@@ -99,81 +319,156 @@ class Writer:
 
     def close(self):
         self.buffer.set_batch_size(1)
-        self._process_buffer()  # Process remaining messages
+        self._flush()  # Process remaining messages
         print(self.name, "closing,", self.packetcount, "messages processed.")
+        if self.batch_times.count:
+            print(
+                "{}: {} batches, time to write a batch {}.".format(
+                    self.name, self.batch_times.count, self.batch_times.summary()
+                )
+            )
         self._close()
+        if self.spool is not None:
+            self.spool.print_stats(" of " + self.name)
+            self.spool.close()
+
+    def setup_spool(self, wconfig):
+        # Batches which could not be written are spooled to disk and
+        # replayed max replay_batch records at a time, replay_rate records
+        # per second in average, while new messages are written as usual
+        if not self.can_spool:
+            print("Writer {} can't spool failed batches.".format(self.name))
+            return
+        sconfig = wconfig["spool"]
+        if not isinstance(sconfig, dict):
+            sconfig = {"directory": sconfig}
+        self.spool = spool.Spool.from_config(self.name, sconfig)
+        self.replay_batch = max(1, int(sconfig.get("replay_batch", 5000)))
+        self.replay_rate = max(1, sconfig.get("replay_rate", 1000))
+        self.replay_retry = sconfig.get("retry", 10)  # Secs after failed write
+        self._next_replay = 0.0  # time.monotonic() of next replay
+        self._replay_lock = threading.Lock()  # _next_replay is set from many threads
 
     def _close(self):
         # Each subclass should define class specific _close()
         pass
 
-    def send(self, mesg):
+    def enable_tracing(self, tracer):
+        # Writers which acknowledge writes close traces with tracer
+        if self.acks:
+            self.tracer = tracer
+            self.traces = deque()
+
+    def send(self, mesg, plan=None, trace=None):
+        # plan = TransformPlan to apply instead of writer's own plan,
+        # e.g. source plan + writer's plan
+        # trace = trace of message from Tracer.begin()
         if self.waitlist.is_wait_over(mesg["mac"]):
             self.packetcount += 1
-            mesg = self.modify_packet(mesg, self.config)
+            mesg = (plan or self.plan).apply_to_copy(mesg)
             self.buffer.put(mesg)
-            self._process_buffer()
+            if self.traces is not None:
+                self.traces.append(trace)
+            self._flush()
+
+    def take_traces(self, n):
+        # Traces of n messages taken from buffer, None if not tracing
+        if self.traces is None:
+            return None
+        return [self.traces.popleft() for i in range(n)]
+
+    def acknowledge(self, traces):
+        # Messages of traces are written. May be called from other threads.
+        if traces:
+            self.tracer.acknowledge(self.name, traces)
+
+    def _flush(self):
+        # Process buffer, messages which left it count as a written batch
+        pending = self.buffer.qsize()
+        start = time.perf_counter_ns()
+        self._process_buffer()
+        written = pending - self.buffer.qsize()
+        if written > 0:
+            self.batch_times.record(time.perf_counter_ns() - start)
+            self.batch_messages += written
 
     def _process_buffer(self):
         # Each writer subclass should implement destination specific process
         pass
 
-    def rename_fields(self, mesg, fields):
-        # NOTE! this will not preserve order of the fields
-        for f in fields:
-            (t, v) = f.split("=")
-            if t and v and t in mesg:
-                mesg[v] = mesg.pop(t)
-        return mesg
-
-    def remove_fields(self, mesg, fields):
-        for f in fields:
-            if f in mesg:
-                mesg.pop(f)
-        return mesg
+    def _write_records(self, records):
+        # Writers which can spool write serialized records here, returns
+        # True if they were written, False if writing failed and should be
+        # retried, None if destination rejected them and they are dropped
+        return False
+
+    def write_failed(self, records):
+        # Batch could not be written, spool it to be written later.
+        # May be called from other threads than the writer's own.
+        if self.spool is None:
+            print("{}: {} messages lost.".format(self.name, len(records)))
+            return
+        self.spool.append(records)
+        with self._replay_lock:
+            self._next_replay = time.monotonic() + self.replay_retry
 
-    def add_fields(self, mesg, fields):
-        for f in fields:
-            (t, v) = f.split("=")
-            if t and v:
-                mesg[t] = v
-        return mesg
+    def replay_spool(self, now=None):
+        # Write oldest spooled records, rate limited to replay_rate
+        if now is None:
+            now = time.monotonic()
+        records, position = self.spool.read(self.replay_batch)
+        if records and self._write_records(records) is not False:
+            self.spool.commit(position)  # Written or rejected
+            next_replay = now + len(records) / self.replay_rate
+        else:
+            next_replay = now + self.replay_retry
+        with self._replay_lock:
+            # Keep retry delay of a write which failed meanwhile in other thread
+            self._next_replay = max(self._next_replay, next_replay)
+
+    def next_replay(self):
+        # time.monotonic() when spooled records are due to be replayed,
+        # None if there are none
+        if self.spool is None or not self.spool.pending():
+            return None
+        with self._replay_lock:
+            return self._next_replay
+
+    def deadline(self):
+        # time.monotonic() when buffered messages are due to be flushed
+        # or spooled messages to be replayed
+        deadline = self.buffer.deadline()
+        next_replay = self.next_replay()
+        if next_replay is not None and (deadline is None or next_replay < deadline):
+            return next_replay
+        return deadline
+
+    def flush_if_due(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        deadline = self.buffer.deadline()
+        if deadline is not None and deadline <= now:
+            self._flush()
+            if not self.buffer.empty():
+                # Could not flush, try again after max_latency
+                self.buffer.restart_deadline(now)
+        next_replay = self.next_replay()
+        if next_replay is not None and next_replay <= now:
+            self.replay_spool(now)
 
     def order_fields(self, mesg, fields):
-        ordered_fields = {}
-        for f in fields:
-            if f in mesg:
-                ordered_fields[f] = mesg.pop(f)
-        mesg = {**ordered_fields, **mesg}
-        return mesg
-
-    def uppercase_values(self, mesg, fields):
-        for f in fields:
-            if f in mesg:
-                value = mesg[f]
-                if isinstance(value, str):
-                    mesg[f] = value.upper()
-        return mesg
+        return _order_fields(mesg, fields)
 
     def modify_packet(self, mesg, mconfig):
-        # *** do per source modifications:
-        # 1. Remove fields
-        mesg = self.remove_fields(mesg, mconfig.get("fields_remove", []))
-        # 2. Rename fields
-        mesg = self.rename_fields(mesg, mconfig.get("fields_rename", []))
-        # 3. Add fields
-        mesg = self.add_fields(mesg, mconfig.get("fields_add", []))
-        # Change fields' value to uppercase
-        mesg = self.uppercase_values(mesg, mconfig.get("values_uppercase", []))
-        # 4. Order fields - should be last modification
-        mesg = self.order_fields(mesg, mconfig.get("fields_order", []))
-
-        return mesg
+        # Modify the packet as defined in source or destination configuration
+        return TransformPlan(mconfig).apply(mesg)
 
 
 class InfluxDBWriter(Writer):
     # Writer class for InfluxDB destination
     type = "influxdb"
+    can_spool = True
+    acks = True
     connection_defaults = {
         "host": "localhost",
         "port": 8086,
@@ -192,52 +487,251 @@ class InfluxDBWriter(Writer):
         self.client = InfluxDBClient(**self.connection_settings)
         self.tags = wconfig.get("tags", [])
         self.measurement = wconfig.get("measurement", None)
+        self.serializer = lineprotocol.LineSerializer(self.measurement, self.tags)
 
     def _process_buffer(self):
         if self.buffer.is_batch_ready():
-            data = []
-            influx_mesg = "{measurement},{tags} {fields} {timestamp}"
+            mesgs = []
             while not self.buffer.empty():
-                mesg = self.buffer.get()
-                mesg["timestamp"] = int(mesg["timestamp"] * 1000)
-                # Construct InfluxDB line protocol message
-                measurement = self.measurement
-                timestamp = mesg.pop("timestamp")
-                tags = []
-                for tag in self.tags:
-                    if tag in list(mesg.keys()):
-                        tags.append("{}={}".format(tag, mesg.pop(tag)))
-                tags.sort()
-                fields = []
-                for field, value in mesg.items():
-                    if isinstance(value, int):
-                        fields.append("{}={}i".format(field, value))
-                    else:
-                        fields.append("{}={}".format(field, value))
-                data.append(
-                    influx_mesg.format(
-                        measurement=measurement,
-                        tags=",".join(tags),
-                        fields=",".join(fields),
-                        timestamp=timestamp,
-                    )
-                )
+                mesgs.append(self.buffer.get())
+            traces = self.take_traces(len(mesgs))
+            data = self.serializer.lines(mesgs)
             # for line in data:
             #    print(line)
 
             # Write to influxdb
+            written = self._write_records(data) if data else True
+            if written is False:
+                self.write_failed(data)
+            elif written:
+                self.acknowledge(traces)
+
+    def _write_records(self, records):
+        try:
             self.client.write_points(
-                data,
+                records,
                 database=self.connection_settings["database"],
                 time_precision="ms",
-                batch_size=self.buffer.get_batch_size(),
+                batch_size=max(self.buffer.get_batch_size(), len(records)),
                 protocol="line",
             )
+        except InfluxDBClientError as e:
+            if not _retryable(e.code):
+                print("{}: {} points rejected: {}".format(self.name, len(records), e))
+                return None
+            print("{}: write failed: {}".format(self.name, e))
+            return False
+        except Exception as e:
+            print("{}: write failed: {}".format(self.name, e))
+            return False
+        return True
+
+
+class InfluxDBHTTPWriter(Writer):
+    """
+    Writer class for InfluxDB destination, writes line protocol directly
+    with HTTP to InfluxDB 1.x /write or 2.x /api/v2/write endpoint.
+    Batches are gzip compressed and written by a pool of threads with
+    keep-alive connections, so several batches can be in flight at once.
+    """
+
+    type = "influxdb_http"
+    can_spool = True
+    acks = True
+    connection_defaults = {
+        "url": "http://localhost:8086",
+        "version": 1,
+        # version 1
+        "database": "none",
+        "username": "",
+        "password": "",
+        # version 2
+        "org": "",
+        "bucket": "",
+        "token": "",
+        # HTTP
+        "gzip": True,
+        "connections": 4,  # Max batches in flight
+        "timeout": 10,
+    }
+
+    def configure(self, wconfig):
+        settings = self.connection_defaults.copy()
+        settings.update(
+            {k: wconfig[k] for k in set(wconfig).intersection(self.connection_defaults)}
+        )
+        self.connection_settings = settings
+        self.tags = wconfig.get("tags", [])
+        self.measurement = wconfig.get("measurement", None)
+        self.serializer = lineprotocol.LineSerializer(self.measurement, self.tags)
+
+        url = urllib.parse.urlsplit(settings["url"])
+        self.https = url.scheme == "https"
+        self.netloc = url.netloc
+        self.headers = {"Content-Type": "text/plain; charset=utf-8"}
+        if int(settings["version"]) == 2:
+            params = {
+                "org": settings["org"],
+                "bucket": settings["bucket"],
+                "precision": "ms",
+            }
+            self.path = url.path.rstrip("/") + "/api/v2/write"
+            if settings["token"]:
+                self.headers["Authorization"] = "Token " + settings["token"]
+        else:
+            params = {"db": settings["database"], "precision": "ms"}
+            if settings["username"]:
+                params["u"] = settings["username"]
+                params["p"] = settings["password"]
+            self.path = url.path.rstrip("/") + "/write"
+        self.path += "?" + urllib.parse.urlencode(params)
+        if settings["gzip"]:
+            self.headers["Content-Encoding"] = "gzip"
+
+        self.max_in_flight = max(1, int(settings["connections"]))
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            self.max_in_flight, thread_name_prefix="influx-" + self.name
+        )
+        self.local = threading.local()  # Connection of each pool thread
+        self.connections = []
+        self.lock = threading.Lock()
+        self.in_flight = []
+        self.stats = {
+            "points": 0,
+            "batches": 0,
+            "failed": 0,
+            "rejected": 0,
+            "bytes": 0,
+            "request_secs": 0.0,
+        }
+
+    def _connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            cls = (
+                http.client.HTTPSConnection
+                if self.https
+                else http.client.HTTPConnection
+            )
+            conn = cls(self.netloc, timeout=self.connection_settings["timeout"])
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def _post(self, body, points):
+        # Runs in a pool thread. Retries once, connection may have been
+        # closed by server while it was idle.
+        start_t = time.monotonic()
+        for attempt in (1, 2):
+            conn = self._connection()
+            try:
+                conn.request("POST", self.path, body, self.headers)
+                response = conn.getresponse()
+                response.read()
+                break
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                if attempt == 2:
+                    print("{}: write failed: {}".format(self.name, e))
+                    with self.lock:
+                        self.stats["failed"] += 1
+                    return False
+        status = response.status
+        with self.lock:
+            self.stats["request_secs"] += time.monotonic() - start_t
+            if status < 300:
+                self.stats["points"] += points
+                self.stats["batches"] += 1
+                self.stats["bytes"] += len(body)
+            elif _retryable(status):
+                self.stats["failed"] += 1
+            else:
+                self.stats["rejected"] += 1
+        if status < 300:
+            return True
+        if _retryable(status):
+            print("{}: write failed: {} {}".format(self.name, status, response.reason))
+            return False
+        # Bad request, authorization, database etc., would never succeed
+        print(
+            "{}: {} points rejected: {} {}".format(
+                self.name, points, status, response.reason
+            )
+        )
+        return None
+
+    def _process_buffer(self):
+        if self.buffer.is_batch_ready():
+            mesgs = []
+            while not self.buffer.empty():
+                mesgs.append(self.buffer.get())
+            traces = self.take_traces(len(mesgs))
+            data = self.serializer.lines(mesgs)
+            if not data:
+                self.acknowledge(traces)
+                return
+
+            # Wait for the oldest batch if max batches are already in flight
+            self.in_flight = [f for f in self.in_flight if not f.done()]
+            if len(self.in_flight) >= self.max_in_flight:
+                concurrent.futures.wait(
+                    self.in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+            self.in_flight.append(self.executor.submit(self._send_lines, data, traces))
+
+    def _send_lines(self, lines, traces=None):
+        # Runs in a pool thread
+        written = self._write_records(lines)
+        if written is False:
+            self.write_failed(lines)
+        elif written:
+            self.acknowledge(traces)
+
+    def _write_records(self, records):
+        body = "\n".join(records).encode()
+        if self.connection_settings["gzip"]:
+            body = gzip.compress(body, compresslevel=5)
+        return self._post(body, len(records))
+
+    def _close(self):
+        self.executor.shutdown(wait=True)
+        for conn in self.connections:
+            conn.close()
+        print(
+            "{}: {points} points in {batches} batches written, {failed} batches "
+            "failed, {rejected} rejected, {bytes} bytes sent, {avg:.1f} msecs per request.".format(
+                self.name,
+                avg=1000 * self.stats["request_secs"] / max(1, self.stats["batches"]),
+                **self.stats
+            )
+        )
 
 
 class FileWriter(Writer):
-    # Writer class for file destination
+    """
+    Writer class for file destination. Formats:
+    - repr: python dict per line with time.ctime() timestamp (default)
+    - jsonl: JSON object per line
+    - csv: columns in given order, header line at start of each file
+    jsonl and csv have timestamp in seconds since epoch.
+
+    File is rotated when it grows over rotate_bytes or is older than
+    rotate_secs: it is renamed with a time suffix and, with compress,
+    gzipped by a background thread. Written batches are flushed and
+    fsynced at most once in fsync_interval seconds.
+    """
+
     type = "file"
+    acks = True
+    file_defaults = {
+        "format": "repr",
+        "columns": [],  # csv columns, default is keys of first message
+        "fsync_interval": 0,  # 0 = no fsync
+        "rotate_bytes": 0,  # 0 = no size limit
+        "rotate_secs": 0,  # 0 = no age limit
+        "compress": False,
+    }
 
     def configure(self, wconfig):
         self.filename = wconfig.get("filename", "")
@@ -246,21 +740,125 @@ class FileWriter(Writer):
             print("No filename specified!")
             return
 
-        self.f_handle = open(self.filename, "a+")
+        settings = self.file_defaults.copy()
+        settings.update(
+            {k: wconfig[k] for k in set(wconfig).intersection(self.file_defaults)}
+        )
+        self.format = settings["format"]
+        if self.format not in ("repr", "jsonl", "csv"):
+            print("Unknown file format {}, using repr.".format(self.format))
+            self.format = "repr"
+        self.columns = list(settings["columns"])
+        self.fsync_interval = settings["fsync_interval"]
+        self.rotate_bytes = settings["rotate_bytes"]
+        self.rotate_secs = settings["rotate_secs"]
+        self.compressor = None
+        if settings["compress"]:
+            self.compressor = concurrent.futures.ThreadPoolExecutor(
+                1, thread_name_prefix="gzip-" + self.name
+            )
+        self.last_fsync = time.monotonic()
+        self._open()
         print(self.filename, self.f_handle.writable())
 
+    def _open(self):
+        self.f_handle = open(self.filename, "a", newline="")
+        self.opened_t = time.time()
+        self.size = self.f_handle.tell()
+        self.csv_writer = None
+        if self.format == "csv":
+            self.csv_writer = csv.writer(self.f_handle, lineterminator="\n")
+            if self.size and not self.columns:
+                with open(self.filename, newline="") as f:
+                    self.columns = next(csv.reader(f), [])
+
+    def _rotate(self):
+        self._sync()
+        self.f_handle.close()
+        base = "{}.{}".format(
+            self.filename, time.strftime("%Y%m%d-%H%M%S", time.localtime())
+        )
+        rotated = base
+        n = 1
+        while os.path.exists(rotated) or os.path.exists(rotated + ".gz"):
+            rotated = "{}.{}".format(base, n)
+            n += 1
+        os.replace(self.filename, rotated)
+        if self.compressor is not None:
+            self.compressor.submit(_compress_file, rotated)
+        self._open()
+
+    def _format(self, mesgs):
+        if self.format == "jsonl":
+            return "".join(
+                json.dumps(as_dict(mesg), separators=(",", ":"), default=str) + "\n"
+                for mesg in mesgs
+            )
+        lines = []
+        for mesg in mesgs:
+            mesg["timestamp"] = time.ctime(mesg["timestamp"])
+            lines.append("{}\r\n".format(mesg))
+        return "".join(lines)
+
+    def _write_csv(self, mesgs):
+        if not self.columns:
+            self.columns = list(mesgs[0])
+        if not self.size:
+            self.csv_writer.writerow(self.columns)
+        rows = [[mesg.get(c, "") for c in self.columns] for mesg in mesgs]
+        self.csv_writer.writerows(rows)
+
+    def _sync(self):
+        self.f_handle.flush()
+        if self.fsync_interval:
+            os.fsync(self.f_handle.fileno())
+            self.last_fsync = time.monotonic()
+
     def _process_buffer(self):
         if self.f_handle is not None:
             if self.buffer.is_batch_ready():
+                mesgs = []
                 while not self.buffer.empty():
-                    mesg = self.buffer.get()
-                    mesg["timestamp"] = time.ctime(mesg["timestamp"])
-                    self.f_handle.write("{}\r\n".format(mesg))
+                    mesgs.append(self.buffer.get())
+                if not mesgs:
+                    return
+                traces = self.take_traces(len(mesgs))
+                if (self.rotate_bytes and self.size >= self.rotate_bytes) or (
+                    self.rotate_secs
+                    and time.time() - self.opened_t >= self.rotate_secs
+                    and self.size
+                ):
+                    self._rotate()
+                if self.csv_writer is not None:
+                    self._write_csv(mesgs)
+                else:
+                    self.f_handle.write(self._format(mesgs))
+                self.size = self.f_handle.tell()
+                if (
+                    self.fsync_interval
+                    and time.monotonic() - self.last_fsync >= self.fsync_interval
+                ):
+                    self._sync()
+                else:
+                    self.f_handle.flush()
+                self.acknowledge(traces)
 
     def _close(self):
         if self.f_handle is not None:
-            self.f_handle.flush()
+            self._sync()
             self.f_handle.close()
+            if self.compressor is not None:
+                self.compressor.shutdown(wait=True)
+
+
+def _compress_file(filename):
+    # gzip a rotated file in background and remove the original
+    try:
+        with open(filename, "rb") as f_in, gzip.open(filename + ".gz", "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        os.remove(filename)
+    except OSError as e:
+        print("Compressing {} failed: {}".format(filename, e))
 
 
 class ThingspeakWriter(Writer):
@@ -277,6 +875,11 @@ class ThingspeakWriter(Writer):
 class DropWriter(Writer):
     # Will simply drop the packet
     type = "DROP"
+    threaded = False
+
+    def _process_buffer(self):
+        while not self.buffer.empty():
+            self.buffer.get()
 
 
 class ScanWriter(Writer):
@@ -298,39 +901,189 @@ class ScanWriter(Writer):
             print(mesg)
 
 
+class WriterWorker:
+    """
+    Runs a writer in its own thread, so that a slow destination does not
+    hold up other destinations. Messages are passed to the thread thru
+    a bounded inbox, messages are dropped if the inbox is full.
+    Has the same interface as Writer for Writers.
+    """
+
+    def __init__(self, writer, inbox_size=1000):
+        self.writer = writer
+        self.name = writer.name
+        self.plan = writer.plan
+        self.inbox = queue.Queue(max(1, int(inbox_size)))
+        self.max_depth = 0
+        self.dropped = 0
+        self.errors = 0
+        self.write_timer = helpers.StopWatch()  # Time to write a message
+        self._thread = threading.Thread(
+            target=self._run, name="writer-" + self.name, daemon=True
+        )
+        self._thread.start()
+
+    def enable_tracing(self, tracer):
+        self.writer.enable_tracing(tracer)
+
+    def send(self, mesg, plan=None, trace=None):
+        try:
+            self.inbox.put_nowait((mesg, plan, trace))
+        except queue.Full:
+            self.dropped += 1
+            return
+        self.max_depth = max(self.max_depth, self.inbox.qsize())
+
+    def deadline(self):
+        return None  # Worker flushes its writer itself
+
+    def flush_if_due(self, now=None):
+        pass
+
+    def _run(self):
+        writer = self.writer
+        while True:
+            # Sleep until a message arrives or it's time to flush writer's buffer
+            timeout = writer.deadline()
+            if timeout is not None:
+                timeout = max(0.0, timeout - time.monotonic())
+            try:
+                item = self.inbox.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item == defs.STOPMESSAGE:
+                break
+            try:
+                if item is not None:
+                    self.write_timer.start()
+                    writer.send(*item)
+                    self.write_timer.split()
+                writer.flush_if_due()
+            except Exception as e:
+                self.errors += 1
+                print("Error in writer {}: {}".format(self.name, e))
+        try:
+            writer.close()
+        except Exception as e:
+            print("Error closing writer {}: {}".format(self.name, e))
+
+    def stats(self):
+        return {
+            "depth": self.inbox.qsize(),
+            "max_depth": self.max_depth,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "messages": self.write_timer.get_count(),
+            "avg_write_usecs": 1000 * 1000 * self.write_timer.get_average(),
+            "max_write_usecs": 1000 * 1000 * self.write_timer.MAX_SPLIT,
+            "p99_write_usecs": 1000 * 1000 * self.write_timer.get_percentile(99),
+        }
+
+    def close(self, timeout=10):
+        try:
+            self.inbox.put(defs.STOPMESSAGE, timeout=timeout)
+        except queue.Full:
+            print("Writer {} is stuck, inbox is full.".format(self.name))
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            print("Writer {} did not close in {} seconds.".format(self.name, timeout))
+        print(
+            "Writer {}: {messages} messages, inbox max depth {max_depth}, "
+            "{dropped} dropped, {errors} errors, write time avg "
+            "{avg_write_usecs:.1f} usecs p99 {p99_write_usecs:.1f} usecs "
+            "max {max_write_usecs:.1f} usecs.".format(self.name, **self.stats())
+        )
+
+
 class Writers:
     # collection of writer classes
 
     def __init__(self):
         self.all_writers = {}
         self.destinations = {}
+        self.routes = {}  # mac -> [(writer, source plan + writer plan), ...]
         self.writer_classes = {}
         for cls in Writer.__subclasses__():
             self.writer_classes[cls.type] = cls
+        self.inbox_sizes = {}  # name -> inbox size of writer to run in a thread
 
     def setup_routing(self, sources_config):
+        # Writers must be added before routing is set up
         for mac in sources_config:
-            self.destinations[mac] = sources_config[mac].get("destinations", "DROP")
-
-    def send(self, mesg):
+            mconfig = sources_config[mac]
+            self.destinations[mac] = mconfig.get("destinations", ["DROP"])
+        self.start_workers()
+        for mac in sources_config:
+            mconfig = sources_config[mac]
+            source_plan = TransformPlan(mconfig)
+            self.routes[mac] = [
+                (self.all_writers[dest], source_plan + self.all_writers[dest].plan)
+                for dest in self.destinations[mac]
+                if dest in self.all_writers
+            ]
+
+    def start_workers(self):
+        # Threaded writers of routed destinations are run in WriterWorkers,
+        # writers no source is routed to, e.g. SCAN in gateway mode, get
+        # no thread
+        routed = {dest for dests in self.destinations.values() for dest in dests}
+        for wname, inbox_size in self.inbox_sizes.items():
+            writer = self.all_writers[wname]
+            if wname in routed and not isinstance(writer, WriterWorker):
+                self.all_writers[wname] = WriterWorker(writer, inbox_size)
+
+    def enable_tracing(self, tracer):
+        for writer in self.all_writers.values():
+            writer.enable_tracing(tracer)
+
+    def send(self, mesg, trace=None):
+        # Modify message as defined for its source and each destination
+        # and send it to the destinations. trace = trace of the message.
         if not self.destinations:
             print("{} - Routing not setup!".format(self))
             return
 
         # print("Writers.send(): mesg:", mesg)
-        dest_list = self.destinations.get(mesg["mac"], self.destinations.get("*"))
-        for dest in dest_list:
-            if dest in self.all_writers:
-                self.all_writers[dest].send(mesg.copy())
+        route = self.routes.get(mesg["mac"])
+        if route is None:
+            route = self.routes.get("*", [])
+        for writer, plan in route:
+            writer.send(mesg, plan, trace)  # Writer modifies a copy of message
 
     def close(self):
         for w in self.all_writers.values():
             w.close()
 
+    def time_to_flush(self, now=None, max_wait=None):
+        # Seconds until next writer's flush deadline, capped to max_wait.
+        # Returns max_wait (None = wait forever) if nothing is buffered,
+        # e.g. when all writers run in their own threads.
+        deadlines = [
+            d
+            for d in (w.deadline() for w in self.all_writers.values())
+            if d is not None
+        ]
+        if not deadlines:
+            return max_wait
+        if now is None:
+            now = time.monotonic()
+        wait = max(0.0, min(deadlines) - now)
+        return wait if max_wait is None else min(wait, max_wait)
+
+    def flush_due(self, now=None):
+        # Flush writers whose buffered messages have waited long enough
+        if now is None:
+            now = time.monotonic()
+        for w in self.all_writers.values():
+            w.flush_if_due(now)
+
     def add_writer(self, wname, wconfig):
         wtype = wconfig.get("type", None)
         if wtype in self.writer_classes:
             new_writer = self.writer_classes[wtype](wname, wconfig)
+            if new_writer and new_writer.threaded and wconfig.get("threaded", True):
+                # Started in a WriterWorker when routing is set up
+                self.inbox_sizes[wname] = wconfig.get("inbox_size", 1000)
             if new_writer:
                 self.all_writers[wname] = new_writer
                 return new_writer
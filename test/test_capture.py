@@ -0,0 +1,124 @@
+import asyncio
+import struct
+
+import pytest
+
+from ble_gateway import capture
+
+FRAMES = [
+    (1600000000000000000, 0, bytes.fromhex("043e2b02010001")),
+    (1600000000250000000, 1, bytes.fromhex("043e0c02010001ffeeddccbbaa00c0")),
+    (1600000001000000000, 0, b""),
+]
+
+
+@pytest.fixture
+def capfile(tmp_path):
+    filename = str(tmp_path / "frames.cap")
+    recorder = capture.CaptureWriter(filename)
+    for t_ns, adapter, frame in FRAMES:
+        recorder.write(frame, adapter, t_ns)
+    recorder.close()
+    return filename
+
+
+def test_file_layout(capfile):
+    with open(capfile, "rb") as f:
+        data = f.read()
+    assert data[:9] == b"BLEGWCAP\x01"
+    assert struct.unpack_from("<qBH", data, 9) == (FRAMES[0][0], 0, 7)
+    assert data[20:27] == FRAMES[0][2]
+
+
+def test_read_back(capfile):
+    assert list(capture.read_capture(capfile)) == FRAMES
+
+
+def test_recording_appends(capfile):
+    recorder = capture.CaptureWriter(capfile)
+    recorder.write(memoryview(b"\x04\x3e"), 2, 1600000002000000000)
+    recorder.close()
+    assert list(capture.read_capture(capfile)) == FRAMES + [
+        (1600000002000000000, 2, b"\x04\x3e")
+    ]
+
+
+def test_killed_recording(capfile):
+    # Incomplete last record is skipped, whether header or frame is cut
+    with open(capfile, "rb") as f:
+        data = f.read()
+    for cut in (1, 15, 16, 25):
+        with open(capfile, "wb") as f:
+            f.write(data[: len(data) - 11 - cut])
+        assert list(capture.read_capture(capfile)) == FRAMES[:1]
+
+
+@pytest.mark.parametrize("content", [b"", b"BLEGW", b"# some log\n", b"BLEGWCAP\x02"])
+def test_not_a_capture(tmp_path, content):
+    filename = tmp_path / "other"
+    filename.write_bytes(content)
+    with pytest.raises(ValueError):
+        next(capture.read_capture(str(filename)))
+
+
+def test_no_recording_over_other_file(tmp_path):
+    filename = tmp_path / "notes.txt"
+    filename.write_text("important")
+    with pytest.raises(ValueError):
+        capture.CaptureWriter(str(filename))
+    assert filename.read_text() == "important"
+
+
+@pytest.mark.parametrize(
+    "speed, factor",
+    [(None, 0.0), ("max", 0.0), ("", 0.0), ("0.5", 0.5), (10, 10.0)],
+)
+def test_parse_speed(speed, factor):
+    assert capture.parse_speed(speed) == factor
+
+
+def test_bad_speed():
+    for speed in ("-1", "fast"):
+        with pytest.raises(ValueError):
+            capture.parse_speed(speed)
+
+
+def run_replay(replayer):
+    # Replays capture in an event loop, returns (loop time, frame, adapter)
+    loop = asyncio.new_event_loop()
+    fed = []
+    try:
+        replayer.start(
+            loop,
+            lambda frame, adapter: fed.append((loop.time(), frame, adapter)),
+            loop.stop,
+        )
+        loop.run_forever()
+    finally:
+        loop.close()
+    return fed
+
+
+def test_replay_at_recorded_pace(capfile):
+    replayer = capture.Replayer(capfile, 4)
+    fed = run_replay(replayer)
+    assert [(frame, adapter) for t, frame, adapter in fed] == [
+        (frame, adapter) for t_ns, adapter, frame in FRAMES
+    ]
+    assert fed[1][0] - fed[0][0] == pytest.approx(0.25 / 4, abs=0.03)
+    assert fed[2][0] - fed[0][0] == pytest.approx(1.0 / 4, abs=0.03)
+    assert replayer.count == 3
+
+
+def test_replay_at_max_speed(tmp_path, monkeypatch):
+    filename = str(tmp_path / "many.cap")
+    recorder = capture.CaptureWriter(filename)
+    for i in range(1000):
+        recorder.write(i.to_bytes(2, "big"), 0, i * 10**9)
+    recorder.close()
+    monkeypatch.setattr(capture.Replayer, "CHUNK", 100)
+    fed = run_replay(capture.Replayer(filename, "max"))
+    assert [frame for t, frame, adapter in fed] == [
+        i.to_bytes(2, "big") for i in range(1000)
+    ]
+    assert fed[-1][0] - fed[0][0] < 1  # Recorded over 999 seconds
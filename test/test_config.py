@@ -0,0 +1,36 @@
+from ble_gateway.config_management import Configuration
+
+
+def configure(common):
+    config = Configuration()
+    config.update_config({"common": common}, True)
+    return config
+
+
+def test_ipc_batch_defaults():
+    config = Configuration()
+    assert config.IPC_BATCH_SIZE == 32
+    assert config.IPC_BATCH_DELAY == 0.05
+
+
+def test_ipc_batch_from_configfile():
+    config = configure({"IPC_batch_size": 1, "ipc_batch_delay": 0})
+    assert config.IPC_BATCH_SIZE == 1  # Frame by frame
+    assert config.IPC_BATCH_DELAY == 0
+
+
+def test_transport():
+    config = Configuration()
+    assert config.TRANSPORT == "queue"
+    assert config.RING_SIZE == 1024 * 1024
+    config = configure({"transport": "shm", "ring_size": 65536})
+    assert (config.TRANSPORT, config.RING_SIZE) == ("shm", 65536)
+
+
+def test_devices():
+    config = Configuration()
+    assert (config.DEVICE, config.DEVICES) == (0, [0])
+    config = configure({"device": [1, "2"]})
+    assert (config.DEVICE, config.DEVICES) == (1, [1, 2])
+    config = configure({"device": []})
+    assert (config.DEVICE, config.DEVICES) == (-1, [])
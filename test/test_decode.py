@@ -0,0 +1,132 @@
+from ble_gateway import decode, prefilter
+
+MAC = "c0:00:00:00:00:01"
+DF5 = bytes.fromhex(
+    "020106" "1bff9904" "0512fc5394c37c0004fffc040cac364200cdcbb8334c884f"
+)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeDecoder(decode.Decoder):
+    # Events are dicts of decoder name -> decoded fields
+    all_decoders = {
+        "first": lambda ev: ev.get("first"),
+        "second": lambda ev: ev.get("second"),
+    }
+
+
+def ruuvi_frame(mac=MAC):
+    report = bytes([0x02, 1, 0x00, 0x01]) + prefilter.mac_to_bytes(mac)
+    report += bytes([len(DF5)]) + DF5 + b"\xc0"
+    return bytes([0x04, 0x3E, len(report)]) + report
+
+
+def test_pinned_decoder_hit():
+    decoder = FakeDecoder()
+    ev = {"second": {"value": 1}}
+    assert decoder.dispatch(ev, MAC, ["first", "second"]) == ("second", {"value": 1})
+    assert decoder.pinned == {MAC: "second"}
+    assert decoder.stats == {"hits": 0, "misses": 0, "scans": 1, "negative": 0}
+    assert decoder.failures == {"first": 1, "second": 0}
+    assert decoder.dispatch(ev, MAC, ["first", "second"]) == ("second", {"value": 1})
+    assert decoder.stats == {"hits": 1, "misses": 0, "scans": 1, "negative": 0}
+    assert decoder.failures == {"first": 1, "second": 0}  # first was not tried
+
+
+def test_miss_rescans_and_repins():
+    decoder = FakeDecoder()
+    decoder.dispatch({"second": {"value": 1}}, MAC, ["first", "second"])
+    ev = {"first": {"value": 2}}
+    assert decoder.dispatch(ev, MAC, ["first", "second"]) == ("first", {"value": 2})
+    assert decoder.pinned == {MAC: "first"}
+    assert decoder.stats == {"hits": 0, "misses": 1, "scans": 2, "negative": 0}
+    assert decoder.failures == {"first": 1, "second": 1}
+    # Pinned decoder is kept if no decoder succeeds, mac is not skipped
+    for i in range(decode.Decoder.NEGATIVE_CACHE_AFTER + 1):
+        assert decoder.dispatch({}, MAC, ["first", "second"]) is None
+    assert decoder.pinned == {MAC: "first"}
+    assert decoder.negative == {}
+
+
+def test_negative_cache_suppresses_scans(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(decode.time, "monotonic", clock)
+    decoder = FakeDecoder(negative_cache_ttl=60)
+    for i in range(decode.Decoder.NEGATIVE_CACHE_AFTER):
+        assert MAC not in decoder.negative
+        assert decoder.dispatch({}, MAC, ["first", "second"]) is None
+    assert decoder.negative == {MAC: clock.now + 60}
+    assert decoder.stats["scans"] == 3
+    assert decoder.failures == {"first": 3, "second": 3}
+
+    # Decoders are not tried, also if they would succeed
+    clock.now += 59
+    assert decoder.dispatch({"first": {}}, MAC, ["first", "second"]) is None
+    assert decoder.stats == {"hits": 0, "misses": 0, "scans": 3, "negative": 1}
+    assert decoder.failures == {"first": 3, "second": 3}
+    # Catch-all decoder gives basic info
+    assert decoder.dispatch({}, MAC, ["first", "unknown"]) == ("unknown", {})
+    assert decoder.stats["negative"] == 2
+
+
+def test_negative_cache_expires(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(decode.time, "monotonic", clock)
+    decoder = FakeDecoder(negative_cache_ttl=60)
+    for i in range(decode.Decoder.NEGATIVE_CACHE_AFTER):
+        decoder.dispatch({}, MAC, ["first"])
+    assert decoder.is_negative(MAC)
+    clock.now += 60
+    assert not decoder.is_negative(MAC)
+    assert decoder.negative == {}
+    ev = {"first": {"value": 1}}
+    assert decoder.dispatch(ev, MAC, ["first"]) == ("first", {"value": 1})
+    assert decoder.pinned == {MAC: "first"}
+    assert decoder.stats == {"hits": 0, "misses": 0, "scans": 4, "negative": 0}
+
+
+def test_failures_reset_by_success():
+    decoder = FakeDecoder(negative_cache_ttl=60)
+    for i in range(5):
+        for j in range(decode.Decoder.NEGATIVE_CACHE_AFTER - 1):
+            decoder.dispatch({}, MAC, ["first"])
+        decoder.dispatch({"first": {"value": 1}}, MAC, ["first"])
+        decoder.pinned.clear()
+    assert decoder.negative == {}
+
+
+def test_no_negative_cache():
+    decoder = FakeDecoder(negative_cache_ttl=0)
+    for i in range(10):
+        decoder.dispatch({}, MAC, ["first", "second"])
+    assert decoder.negative == {}
+    assert decoder.stats == {"hits": 0, "misses": 0, "scans": 10, "negative": 0}
+
+
+def test_run_skips_negative_macs():
+    decoder = decode.Decoder()
+    decoder.enable_fixed_decoders(["pebble"])  # Can't decode Ruuvi frames
+    for i in range(decode.Decoder.NEGATIVE_CACHE_AFTER):
+        assert decoder.run(ruuvi_frame())["decoder"] == "none"
+    assert decoder.is_negative(MAC)
+    assert decoder.run(ruuvi_frame())["decoder"] == "none"
+    assert decoder.stats["negative"] == 1
+    assert decoder.failures["pebble"] == decode.Decoder.NEGATIVE_CACHE_AFTER
+
+
+def test_run_fast_path_pins_ruuviraw():
+    decoder = decode.Decoder()
+    decoder.enable_fixed_decoders(["ruuviraw", "pebble"])
+    mesg = decoder.run(memoryview(ruuvi_frame()))
+    assert (mesg["decoder"], mesg["mac"], mesg["rssi"]) == ("ruuviraw", MAC, -64)
+    assert decoder.run(ruuvi_frame()) == mesg
+    assert decoder.pinned == {MAC: "ruuviraw"}
+    assert decoder.stats == {"hits": 1, "misses": 0, "scans": 1, "negative": 0}
+    assert decoder.fast_count == 2
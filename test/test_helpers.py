@@ -0,0 +1,95 @@
+import random
+
+import pytest
+
+from ble_gateway import helpers
+from ble_gateway.helpers import Histogram
+
+
+def test_exact_below_precision():
+    h = Histogram(precision=8)
+    for value in range(256):
+        assert h._highest(h._index(value)) == value
+
+
+@pytest.mark.parametrize("precision", [4, 8, 11])
+def test_buckets_cover_range_within_error(precision):
+    # Buckets are contiguous and narrower than 2**(1-precision) of
+    # their lowest value, up to max_value
+    h = Histogram(precision=precision, max_value=1 << 30)
+    lowest = 0
+    for index in range(len(h.counts)):
+        highest = h._highest(index)
+        assert h._index(lowest) == index
+        assert h._index(highest) == index
+        assert highest - lowest + 1 <= max(1, lowest * 2 ** (1 - precision))
+        lowest = highest + 1
+    assert h._index(1 << 30) == len(h.counts) - 1
+
+
+def test_percentiles_of_latencies():
+    rng = random.Random(5)
+    values = [int(rng.lognormvariate(11, 1)) for i in range(10000)]  # ~60 usecs
+    h = Histogram()
+    for value in values:
+        h.record(value)
+    values.sort()
+    for p in (50, 90, 99, 99.9):
+        exact = values[-int(-p * len(values) // 100) - 1]
+        assert exact <= h.percentile(p) <= exact * 1.008
+    assert h.percentile(100) == h.max == values[-1]
+    assert h.min == values[0]
+    assert h.average() == pytest.approx(sum(values) / len(values))
+
+
+def test_out_of_range_values():
+    h = Histogram(max_value=10000)
+    h.record(-1)
+    h.record(10**9)
+    assert (h.min, h.max, h.count) == (0, 10000, 2)
+
+
+def test_merged_and_delta_histograms():
+    # E.g. histograms of decoder workers merged, and a rolling window
+    workers = [Histogram(), Histogram()]
+    for i in range(1000):
+        workers[i % 2].record(i)
+    merged = Histogram().merge(workers[0]).merge(workers[1])
+    assert merged.count == 1000
+    assert merged.percentile(50) == 499
+    earlier = merged.snapshot()
+    for i in range(1000, 1100):
+        merged.record(i)
+    window = merged.delta(earlier)
+    assert window.count == 100
+    assert window.total == sum(range(1000, 1100))
+    assert window.percentile(1) >= 1000
+    with pytest.raises(ValueError):
+        merged.merge(Histogram(precision=6))
+
+
+def test_stopwatch_records_splits(monkeypatch):
+    clock = iter([0, 1000, 2000, 5000, 8000, 9000, 10000]).__next__
+    monkeypatch.setattr(helpers.time, "perf_counter_ns", clock)
+    watch = helpers.StopWatch()  # Reads clock once
+    watch.start()
+    watch.split()  # 1000 ns
+    watch.start()
+    watch.split()  # 3000 ns
+    assert watch.get_count() == 2
+    assert watch.get_average() == pytest.approx(2e-6)
+    assert watch.MAX_SPLIT == pytest.approx(3e-6)
+    assert watch.get_percentile(50) == pytest.approx(1e-6, rel=0.008)
+    assert watch.interval().count == 2
+    watch.start()
+    watch.split()  # 1000 ns
+    window = watch.interval()
+    assert (window.count, window.total) == (1, 1000)
+    assert watch.summary() == ("avg 1.7 p50 1.0 p99 3.0 p99.9 3.0 max 3.0 usecs")
+
+
+def test_empty_histogram():
+    h = Histogram()
+    assert h.percentile(99) == 0
+    assert h.average() == 0
+    assert h.summary() == "avg 0.0 p50 0.0 p99 0.0 p99.9 0.0 max 0.0 usecs"
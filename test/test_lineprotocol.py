@@ -0,0 +1,122 @@
+import pytest
+
+from ble_gateway.lineprotocol import LineSerializer, format_field
+
+MAC = "cb:b8:33:4c:88:4f"
+
+
+@pytest.mark.parametrize(
+    "value, field",
+    [
+        (1.5, "1.5"),
+        (-0.1, "-0.1"),
+        (1e-07, "1e-07"),
+        (3, "3i"),
+        (True, "true"),
+        (False, "false"),
+        ("text", '"text"'),
+        ('say "hi"', '"say \\"hi\\""'),
+        ("back\\slash", '"back\\\\slash"'),
+        ("two\nlines", '"two\\nlines"'),
+        (float("nan"), None),
+        (float("-inf"), None),
+        (None, None),
+        ([1, 2], '"[1, 2]"'),
+    ],
+)
+def test_format_field(value, field):
+    assert format_field(value) == field
+
+
+@pytest.mark.parametrize(
+    "mesg, line",
+    [
+        (
+            {"mac": MAC, "temperature": 24.3, "humidity": 53, "timestamp": 1600000000},
+            "ruuvi,mac=cb:b8:33:4c:88:4f temperature=24.3,humidity=53i 1600000000000",
+        ),
+        (
+            {"temperature": 24.3, "location": "Olohuone", "mac": MAC},
+            "ruuvi,location=Olohuone,mac=cb:b8:33:4c:88:4f temperature=24.3",
+        ),
+        # Missing and empty tags are left out
+        ({"mac": "", "humidity": 53}, "ruuvi humidity=53i"),
+        # Fractions of a second in milliseconds
+        (
+            {"humidity": 53, "timestamp": 1600000000.1234},
+            "ruuvi humidity=53i 1600000000123",
+        ),
+        # Non-finite floats and None values are left out
+        (
+            {"a": float("nan"), "b": 2.0, "c": None, "d": float("inf")},
+            "ruuvi b=2.0",
+        ),
+        ({"a": float("nan"), "timestamp": 1}, None),
+        ({"mac": MAC}, None),
+    ],
+)
+def test_line(mesg, line):
+    assert LineSerializer("ruuvi", ["mac", "location"]).line(mesg) == line
+
+
+def test_escaping():
+    serializer = LineSerializer("ble, gw", ["loc ation"])
+    mesg = {"loc ation": "a=b,c", "field=1": 'x "y"', "count%": 5}
+    assert serializer.line(mesg) == (
+        'ble\\,\\ gw,loc\\ ation=a\\=b\\,c field\\=1="x \\"y\\"",count%=5i'
+    )
+
+
+def test_newlines_are_escaped():
+    serializer = LineSerializer("ruuvi", ["mac"])
+    for i in range(2):  # Template is cached on first line
+        line = serializer.line({"mac": "a\nb", "na\nme": "x\ny", "n": 1})
+        assert line == 'ruuvi,mac=a\\nb na\\nme="x\\ny",n=1i'
+        assert "\n" not in line
+
+
+def test_non_finite_floats_with_cached_template():
+    serializer = LineSerializer("ruuvi")
+    values = [1.5, float("nan"), float("inf"), -1e308 * 10, 2.5]
+    lines = [serializer.line({"info": "nan inf", "t": t, "u": 1.0}) for t in values]
+    assert lines == [
+        'ruuvi info="nan inf",t=1.5,u=1.0',
+        'ruuvi info="nan inf",u=1.0',
+        'ruuvi info="nan inf",u=1.0',
+        'ruuvi info="nan inf",u=1.0',
+        'ruuvi info="nan inf",t=2.5,u=1.0',
+    ]
+    assert len(serializer._templates) == 1
+    # Finite values are written also if their sum overflows
+    mesg = {"info": "", "t": 1e308, "u": 1e308}
+    assert serializer.line(mesg) == 'ruuvi info="",t=1e+308,u=1e+308'
+
+
+def test_same_layout_formatted_with_cached_template():
+    serializer = LineSerializer("ruuvi", ["mac"])
+    lines = serializer.lines(
+        [{"mac": MAC, "temperature": 20.0 + i, "battery": 3000 - i} for i in range(3)]
+        + [{"mac": MAC, "temperature": "n/a", "battery": 2997}]
+    )
+    assert lines == [
+        "ruuvi,mac=cb:b8:33:4c:88:4f temperature=20.0,battery=3000i",
+        "ruuvi,mac=cb:b8:33:4c:88:4f temperature=21.0,battery=2999i",
+        "ruuvi,mac=cb:b8:33:4c:88:4f temperature=22.0,battery=2998i",
+        'ruuvi,mac=cb:b8:33:4c:88:4f temperature="n/a",battery=2997i',
+    ]
+    assert len(serializer._templates) == 2  # By value types
+    assert len(serializer._prefixes) == 1
+
+
+def test_caches_are_bounded():
+    serializer = LineSerializer("ruuvi", ["mac"], max_cached=10)
+    for i in range(100):
+        serializer.line({"mac": str(i), "v" + str(i): i})
+    assert len(serializer._prefixes) <= 10
+    assert len(serializer._templates) <= 10
+
+
+def test_serialize_batch():
+    serializer = LineSerializer("ruuvi")
+    batch = serializer.serialize([{"a": 1}, {"b": None}, {"name": "Sää"}])
+    assert batch == 'ruuvi a=1i\nruuvi name="Sää"'.encode()
@@ -0,0 +1,83 @@
+import pickle
+
+from ble_gateway.measurement import Measurement, Schema, as_dict, compile_steps
+
+
+def upper(mesg, fields):
+    # Stands for the writers' uppercase step, applied by compile_steps
+    return mesg
+
+
+def rename(mesg, pairs):
+    return {pairs.get(k, k): v for k, v in mesg.items()}
+
+
+def add(mesg, fields):
+    mesg = dict(mesg)
+    mesg.update(fields)
+    return mesg
+
+
+def test_behaves_like_dict():
+    m = Measurement.from_dict({"mac": "aa", "temperature": 21.5})
+    assert m["mac"] == "aa"
+    assert m.get("humidity") is None
+    assert "temperature" in m and "humidity" not in m
+    m["humidity"] = 40
+    assert list(m) == ["mac", "temperature", "humidity"]
+    del m["temperature"]
+    assert m.pop("humidity") == 40
+    assert m.pop("humidity", None) is None
+    assert m == {"mac": "aa"}
+    assert as_dict(m) == {"mac": "aa"} and type(as_dict(m)) is dict
+
+
+def test_schemas_are_interned_and_transitions_cached():
+    a = Measurement.from_dict({"mac": "aa", "x": 1})
+    b = Measurement.from_dict({"mac": "bb", "x": 2})
+    assert a.schema is b.schema
+    a["y"] = 1
+    b["y"] = 2
+    assert a.schema is b.schema
+    assert a.schema.keys == ("mac", "x", "y")
+
+
+def test_copy_does_not_share_row():
+    a = Measurement.from_dict({"mac": "aa", "x": 1})
+    b = a.copy()
+    b["x"] = 2
+    assert a["x"] == 1
+
+
+def test_equality_without_shared_schema():
+    a = Measurement.from_dict({"mac": "aa", "x": 1})
+    Schema._schemas.clear()
+    b = Measurement.from_dict({"mac": "aa", "x": 1})
+    assert a.schema is not b.schema
+    assert a == b
+    assert a != Measurement.from_dict({"mac": "aa", "x": 2})
+
+
+def test_equality_ignores_field_order_like_dict():
+    a = Measurement.from_dict({"mac": "aa", "x": 1})
+    b = Measurement.from_dict({"x": 1, "mac": "aa"})
+    assert a == b
+    assert a != Measurement.from_dict({"mac": "aa"})
+
+
+def test_pickle_round_trip():
+    a = Measurement.from_dict({"mac": "aa", "x": 1.5, "s": None})
+    b = pickle.loads(pickle.dumps(a))
+    assert b == a
+    assert b.schema is Schema.of(("mac", "x", "s"))
+
+
+def test_compile_steps():
+    m = Measurement.from_dict({"mac": "aa:bb", "x": 1, "loc": "out"})
+    steps = [(rename, {"x": "temp"}), (add, {"site": "home"}), (upper, ["mac"])]
+    build = compile_steps(m.schema, steps, upper)
+    out = build(m)
+    assert out == {"mac": "AA:BB", "temp": 1, "loc": "out", "site": "home"}
+    assert list(out) == ["mac", "temp", "loc", "site"]
+    assert m["mac"] == "aa:bb"  # Input is not modified
+    assert build(Measurement.from_dict({"mac": 5, "x": 2, "loc": "in"}))["mac"] == 5
@@ -0,0 +1,69 @@
+import asyncio
+import queue
+import threading
+
+from ble_gateway import metrics, prefilter, run_ble, run_decoder
+from ble_gateway.config_management import Configuration
+
+MAC = "c0:00:00:00:00:01"
+DF5 = bytes.fromhex(
+    "020106" "1bff9904" "0512fc5394c37c0004fffc040cac364200cdcbb8334c884f"
+)
+
+
+def ruuvi_frame(mac=MAC):
+    report = bytes([0x02, 1, 0x00, 0x01]) + prefilter.mac_to_bytes(mac)
+    report += bytes([len(DF5)]) + DF5 + b"\xc0"
+    return bytes([0x04, 0x3E, len(report)]) + report
+
+
+def make_config(common={}):
+    config = Configuration()
+    config.update_config(
+        {
+            "common": common,
+            "sources": {"*": {"decoders": ["ruuviraw"], "destinations": ["f"]}},
+        },
+        True,
+    )
+    return config
+
+
+class RawFilter:
+    drops = {"invalid": 0, "allowmac": 5, "unrouted": 0, "manufacturer": 0}
+
+
+def test_filter_and_decoded_allowmac_drops_have_own_slots():
+    config = make_config({"allowmac": ["c0:00:00:00:00:02"]})
+    pipeline_metrics = metrics.Metrics(config)
+    main = metrics.bind(pipeline_metrics, metrics.MAIN)
+    decoder = run_decoder.make_decoder(config)
+    writers_q = queue.Queue()
+    for i in range(2):
+        metrics.publish_filters(main, RawFilter())
+        mesg = decoder.run(ruuvi_frame())
+        run_decoder.send_decoded(config, mesg, ruuvi_frame(), writers_q, 0, main)
+    metrics.publish_filters(main, RawFilter())
+    assert writers_q.empty()
+    drops = pipeline_metrics.totals("frames_dropped_total")
+    assert (drops["allowmac"], drops["allowmac_decoded"]) == (5, 2)
+
+
+def test_frames_of_unknown_adapter_are_counted():
+    config = make_config()
+    pipeline_metrics = metrics.Metrics(config)
+    receiver = run_ble.FrameReceiver(
+        config,
+        asyncio.new_event_loop(),
+        threading.Event(),
+        queue.Queue(),
+        None,
+        pipeline_metrics,
+    )
+    receiver.callback(ruuvi_frame(), config.DEVICES[0])
+    receiver.callback(ruuvi_frame(), 7)  # E.g. from replayed capture
+    assert pipeline_metrics.totals("frames_received_total") == {
+        "hci{}".format(config.DEVICES[0]): 1,
+        "other": 1,
+    }
+    receiver.event_loop.close()
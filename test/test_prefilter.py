@@ -0,0 +1,227 @@
+from ble_gateway import prefilter
+from ble_gateway.config_management import Configuration
+
+RUUVI_MAC = "cb:b8:33:4c:88:4f"
+OTHER_MAC = "12:34:56:78:9a:bc"
+# Ruuvi data format 5 test vector, manufacturer data after flags
+RUUVI_DATA = bytes.fromhex(
+    "020106" "1bff9904" "0512fc5394c37c0004fffc040cac364200cdcbb8334c884f"
+)
+APPLE_DATA = bytes.fromhex("020106" "0aff4c0010050b1c2f3a4b")
+
+
+def adv_report(mac, data, rssi=-70):
+    # HCI LE advertising report event as read from the bluetooth socket
+    report = bytes([0x02, 1, 0x00, 0x01]) + prefilter.mac_to_bytes(mac)
+    report += bytes([len(data)]) + data + bytes([rssi & 0xFF])
+    return bytes([0x04, 0x3E, len(report)]) + report
+
+
+def test_frame_parsing():
+    frame = adv_report(RUUVI_MAC, RUUVI_DATA)
+    assert prefilter.is_adv_report(frame)
+    assert prefilter.bytes_to_mac(prefilter.peer_bytes(frame)) == RUUVI_MAC
+    assert prefilter.manufacturer_id(frame) == 0x0499
+    assert prefilter.manufacturer_id(adv_report(OTHER_MAC, APPLE_DATA)) == 0x004C
+    assert prefilter.manufacturer_id(adv_report(OTHER_MAC, b"\x02\x01\x06")) is None
+    assert not prefilter.is_adv_report(frame[:10])
+    assert not prefilter.is_adv_report(b"\x04\x0e" + frame[2:])
+
+
+def test_truncated_ad_structure():
+    frame = adv_report(RUUVI_MAC, RUUVI_DATA[:20])
+    assert prefilter.find_ad(frame, prefilter.AD_TYPE_MANUFACTURER) is None
+
+
+def test_allowed_macs_and_manufacturer_ids():
+    rawfilter = prefilter.RawFilter([RUUVI_MAC, OTHER_MAC], None, ["0x0499"])
+    assert rawfilter.check(adv_report(RUUVI_MAC, RUUVI_DATA))
+    assert not rawfilter.check(adv_report("aa:bb:cc:dd:ee:ff", RUUVI_DATA))
+    assert not rawfilter.check(adv_report(OTHER_MAC, APPLE_DATA))
+    assert not rawfilter.check(b"\x04\x3e\x00")
+    assert rawfilter.passed == 1
+    assert rawfilter.drops == {
+        "invalid": 1,
+        "allowmac": 1,
+        "unrouted": 0,
+        "manufacturer": 1,
+    }
+
+
+def test_unrouted_macs_dropped_in_gateway_mode():
+    config = Configuration()
+    config.update_config(
+        {
+            "sources": {
+                RUUVI_MAC: {"destinations": ["influx"]},
+                OTHER_MAC: {"destinations": ["DROP"]},
+            }
+        },
+        True,
+    )
+    rawfilter = prefilter.RawFilter.from_config(config)
+    assert rawfilter.check(adv_report(RUUVI_MAC, RUUVI_DATA))
+    assert not rawfilter.check(adv_report(OTHER_MAC, RUUVI_DATA))
+    assert rawfilter.drops["unrouted"] == 1
+
+    # Unknown macs are written somewhere, all macs are decoded
+    config.update_config({"sources": {"*": {"destinations": ["influx"]}}}, True)
+    rawfilter = prefilter.RawFilter.from_config(config)
+    assert rawfilter.check(adv_report(OTHER_MAC, RUUVI_DATA))
+
+
+def test_scan_mode_decodes_all_macs():
+    config = Configuration()
+    config.update_config({"common": {"mode": "SCAN"}, "sources": {RUUVI_MAC: {}}}, True)
+    rawfilter = prefilter.RawFilter.from_config(config)
+    assert rawfilter.routed_macs is None
+    assert rawfilter.check(adv_report(OTHER_MAC, APPLE_DATA))
+
+
+def test_prefilter_defaults():
+    config = Configuration()
+    assert config.PREFILTER == "main"
+    assert config.MANUFACTURER_IDS == []
+    rawfilter = prefilter.RawFilter.from_config(config)
+    assert rawfilter.allowed_macs is None
+    assert rawfilter.manufacturer_ids is None
+
+
+def test_throttle_source_intervals():
+    config = Configuration()
+    config.update_config({"sources": {RUUVI_MAC: {"interval": 10}}}, True)
+    assert config.THROTTLE == "none"  # Applied in writers by default
+    throttle = prefilter.IntervalThrottle(config.SOURCES)
+    ruuvi = adv_report(RUUVI_MAC, RUUVI_DATA)
+    other = adv_report(OTHER_MAC, APPLE_DATA)
+    assert throttle.check(ruuvi, now=100.0)
+    assert not throttle.check(ruuvi, now=109.9)
+    assert throttle.check(ruuvi, now=110.0)
+    # Unknown macs get the interval of "*", from source defaults
+    assert throttle.check(other, now=100.0)
+    assert not throttle.check(other, now=102.0)
+    assert throttle.check(other, now=103.0)
+    assert throttle.check(b"\x04\x3e\x00", now=103.0)  # Left to decoder
+    assert (throttle.passed, throttle.throttled) == (4, 2)
+
+
+def test_throttle_forgets_expired_macs():
+    throttle = prefilter.IntervalThrottle({"*": {"interval": 5}})
+    throttle.MAX_MACS = 2
+    throttle.check(adv_report("00:00:00:00:00:01", APPLE_DATA), now=0.0)
+    throttle.check(adv_report("00:00:00:00:00:02", APPLE_DATA), now=4.0)
+    throttle.check(adv_report("00:00:00:00:00:03", APPLE_DATA), now=6.0)
+    assert sorted(map(prefilter.bytes_to_mac, throttle.last_sent)) == [
+        "00:00:00:00:00:02",
+        "00:00:00:00:00:03",
+    ]
+
+
+def ruuvi_report(seq, rssi=-70, mac=RUUVI_MAC):
+    # RUUVI_DATA with measurement sequence number seq
+    data = RUUVI_DATA[:23] + seq.to_bytes(2, "big") + RUUVI_DATA[25:]
+    return adv_report(mac, data, rssi)
+
+
+def test_dedup_keys():
+    key = prefilter.DedupCache.key
+    assert key(ruuvi_report(205)) == key(adv_report(RUUVI_MAC, RUUVI_DATA))
+    assert key(ruuvi_report(205, rssi=-40)) == key(ruuvi_report(205, rssi=-90))
+    assert key(ruuvi_report(205)) != key(ruuvi_report(206))
+    assert key(ruuvi_report(205)) != key(ruuvi_report(205, mac=OTHER_MAC))
+    # Invalid sequence number, other manufacturers: by advertising data
+    assert key(ruuvi_report(0xFFFF)) == ruuvi_report(0xFFFF)[7:-1]
+    assert key(adv_report(OTHER_MAC, APPLE_DATA, -40)) == key(
+        adv_report(OTHER_MAC, APPLE_DATA, -90)
+    )
+
+
+def test_dedup_copies_dropped_for_ttl():
+    dedup = prefilter.DedupCache(ttl=1.0)
+    assert dedup.check(ruuvi_report(1), now=10.0)
+    assert not dedup.check(ruuvi_report(1), now=10.5)
+    assert dedup.check(ruuvi_report(2), now=10.5)
+    assert not dedup.check(ruuvi_report(1), now=10.99)
+    assert dedup.check(ruuvi_report(1), now=11.0)  # Expired
+    assert dedup.stats["passed"] == 3
+    assert dedup.stats["duplicates"] == 2
+    assert dedup.stats["expired"] == 1
+
+
+def test_dedup_evicts_least_recently_seen():
+    dedup = prefilter.DedupCache(ttl=60, max_entries=2)
+    dedup.check(ruuvi_report(1), now=0.0)
+    dedup.check(ruuvi_report(2), now=1.0)
+    dedup.check(ruuvi_report(1), now=2.0)  # Seen again, 2 is the oldest
+    dedup.check(ruuvi_report(3), now=3.0)
+    assert dedup.stats["evicted"] == 1
+    assert not dedup.check(ruuvi_report(1), now=4.0)
+    assert dedup.check(ruuvi_report(2), now=4.0)
+
+
+def test_dedup_keeps_copy_with_best_rssi():
+    # Copies received by several adapters, tag = adapter
+    dedup = prefilter.DedupCache(ttl=1.0, keep_best_rssi=True, window=0.1)
+    assert dedup.hold(ruuvi_report(1, -80), 0, now=0.0)
+    assert dedup.hold(ruuvi_report(1, -50), 1, now=0.02)
+    assert dedup.hold(ruuvi_report(1, -60), 2, now=0.04)
+    assert dedup.hold(ruuvi_report(2, -90), 0, now=0.05)
+    assert dedup.ready(now=0.09) == []
+    assert dedup.ready(now=0.1) == [(ruuvi_report(1, -50), 1)]
+    assert dedup.hold(ruuvi_report(1, -30), 2, now=0.2)  # Within ttl, dropped
+    assert dedup.ready(now=float("inf")) == [(ruuvi_report(2, -90), 0)]
+    assert dedup.stats["replaced"] == 1
+    assert dedup.stats["duplicates"] == 3
+    assert not dedup.hold(b"\x04\x3e\x00")
+
+
+def test_dedup_defaults():
+    config = Configuration()
+    assert config.DEDUP == "none"
+    dedup = prefilter.DedupCache.from_config(config)
+    assert (dedup.ttl, dedup.max_entries, dedup.keep_best_rssi) == (1.0, 10000, False)
+
+
+def test_filters_in_order():
+    # Frames rejected by prefilter are not remembered by dedup, and
+    # copies dropped by dedup don't restart throttle interval
+    filters = prefilter.FrameFilters(
+        prefilter.RawFilter([RUUVI_MAC]),
+        prefilter.DedupCache(ttl=100),
+        prefilter.IntervalThrottle({"*": {"interval": 100}}),
+    )
+    assert not filters.check(adv_report(OTHER_MAC, APPLE_DATA))
+    assert filters.check(ruuvi_report(1))
+    assert not filters.check(ruuvi_report(1))
+    assert not filters.check(ruuvi_report(2))
+    assert filters.rawfilter.drops["allowmac"] == 1
+    assert filters.dedup.stats == dict(filters.dedup.stats, passed=2, duplicates=1)
+    assert (filters.throttle.passed, filters.throttle.throttled) == (1, 1)
+    assert filters.ready() == []
+
+
+def test_held_frames_with_tags():
+    filters = prefilter.FrameFilters(
+        dedup=prefilter.DedupCache(keep_best_rssi=True, window=0.05)
+    )
+    assert not filters.check(ruuvi_report(1, -80), (0, 100.0))
+    assert not filters.check(ruuvi_report(1, -40), (1, 100.01))
+    assert 0 < filters.time_to_ready(1.0) <= 0.05
+    assert filters.ready(float("inf")) == [(ruuvi_report(1, -40), (1, 100.01))]
+    assert filters.time_to_ready(1.0) == 1.0
+
+
+def test_filters_by_process():
+    config = Configuration()
+    config.update_config(
+        {"common": {"prefilter": "ble", "dedup": "main", "throttle": "ble"}}, True
+    )
+    ble = prefilter.FrameFilters.from_config(config, "ble")
+    main = prefilter.FrameFilters.from_config(config, "main")
+    assert ble.rawfilter is not None and ble.throttle is not None
+    assert ble.dedup is None
+    assert main.dedup is not None and not main.dedup.keep_best_rssi
+    assert (main.rawfilter, main.throttle) == (None, None)
+    # Copies from several adapters are always removed in ble process
+    ble = prefilter.FrameFilters.from_config(config, "ble", best_rssi=True)
+    assert ble.dedup.keep_best_rssi
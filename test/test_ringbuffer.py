@@ -0,0 +1,119 @@
+import multiprocessing
+import queue
+
+import pytest
+
+from ble_gateway import ringbuffer
+
+pytestmark = pytest.mark.skipif(
+    ringbuffer.shared_memory is None, reason="shared memory requires python 3.8+"
+)
+
+
+def produce(ring, frames):
+    for frame in frames:
+        ring.put(frame)
+    ring.commit()
+
+
+def test_frames_are_visible_after_commit():
+    ring = ringbuffer.RingBuffer(256)
+    try:
+        ring.put(b"first")
+        ring.put(b"")
+        with pytest.raises(queue.Empty):
+            ring.get(timeout=0.01)
+        ring.commit()
+        assert [bytes(f) for f in ring.get(timeout=0.01)] == [b"first", b""]
+        ring.release()
+        with pytest.raises(queue.Empty):
+            ring.get(timeout=0.01)
+    finally:
+        ring.close()
+        ring.unlink()
+
+
+def test_tags():
+    ring = ringbuffer.RingBuffer(256)
+    try:
+        ring.put(b"hci0", 0)
+        ring.put(b"hci1", 1)
+        ring.put(b"untagged")
+        ring.commit()
+        assert [bytes(f) for f in ring.get(timeout=0.01)] == [
+            b"hci0",
+            b"hci1",
+            b"untagged",
+        ]
+        assert ring.tags == [0, 1, 0]
+        ring.release()
+    finally:
+        ring.close()
+        ring.unlink()
+
+
+def test_timestamps():
+    ring = ringbuffer.RingBuffer(256, timestamps=True)
+    try:
+        ring.put(b"first", 0, 1600000000.25)
+        ring.put(b"second", 1, 1600000000.5)
+        ring.commit()
+        assert len(ring.get(timeout=0.01)) == 2
+        assert ring.tags == [0, 1]
+        assert ring.times == [1600000000.25, 1600000000.5]
+        ring.release()
+    finally:
+        ring.close()
+        ring.unlink()
+
+
+def test_full_ring_drops_until_released():
+    ring = ringbuffer.RingBuffer(64)
+    try:
+        assert ring.put(bytes(29))
+        assert ring.put(bytes(29))
+        assert not ring.put(bytes(1))
+        assert ring.dropped == 1
+        ring.commit()
+        assert len(ring.get(timeout=0.01)) == 2
+        assert not ring.put(bytes(1))  # Frames not released yet
+        ring.release()
+        assert ring.put(bytes(1))
+    finally:
+        ring.close()
+        ring.unlink()
+
+
+def test_frames_never_wrap():
+    # Frame lengths which leave 0, 1 and more bytes at the end of buffer,
+    # so that the rest of it is skipped without or with a wrap marker
+    ring = ringbuffer.RingBuffer(64)
+    try:
+        for length in (0, 7, 13, 29, 28, 1, 5):
+            for i in range(20):
+                frame = bytes([i]) * length
+                assert ring.put(frame)
+                ring.commit()
+                assert [bytes(f) for f in ring.get(timeout=0.01)] == [frame]
+                ring.release()
+        assert ring.dropped == 0
+    finally:
+        ring.close()
+        ring.unlink()
+
+
+def test_frames_from_another_process():
+    ring = ringbuffer.RingBuffer(4096)
+    frames = [bytes([i]) * (i % 40) for i in range(100)]
+    producer = multiprocessing.Process(target=produce, args=(ring, frames))
+    producer.start()
+    received = []
+    try:
+        while len(received) < len(frames):
+            received.extend(bytes(f) for f in ring.get(timeout=5))
+            ring.release()
+    finally:
+        producer.join()
+        ring.close()
+        ring.unlink()
+    assert received == frames
@@ -0,0 +1,131 @@
+import queue
+from multiprocessing import Queue
+
+from ble_gateway import defs, helpers, prefilter, run_decoder
+from ble_gateway.config_management import Configuration
+
+# Ruuvi data format 5 test vector, sequence number at DF5_SEQ
+DF5 = bytes.fromhex(
+    "020106" "1bff9904" "0512fc5394c37c0004fffc040cac364200cdcbb8334c884f"
+)
+DF5_SEQ = 23
+MACS = ["c0:00:00:00:00:0{}".format(i) for i in range(6)]
+
+
+def ruuvi_frame(mac, seq):
+    data = DF5[:DF5_SEQ] + seq.to_bytes(2, "big") + DF5[DF5_SEQ + 2 :]
+    report = bytes([0x02, 1, 0x00, 0x01]) + prefilter.mac_to_bytes(mac)
+    report += bytes([len(data)]) + data + b"\xc0"
+    return bytes([0x04, 0x3E, len(report)]) + report
+
+
+def ruuvi_config(workers):
+    config = Configuration()
+    config.update_config(
+        {
+            "common": {"decoder_workers": workers},
+            "sources": {"*": {"decoders": ["ruuviraw"], "destinations": ["f"]}},
+        },
+        True,
+    )
+    return config
+
+
+def test_frames_sharded_by_mac():
+    pool = run_decoder.DecoderPool(ruuvi_config(3), None, 3)
+    for seq in range(4):
+        for mac in MACS:
+            pool.put(memoryview(ruuvi_frame(mac, seq)))
+    pool.put(b"\x04\x0e\x04")  # Not an advertising report, to first worker
+    assert sum(len(shard) for shard in pool.shards) == 4 * len(MACS) + 1
+    for shard in pool.shards:
+        assert all(isinstance(frame, bytes) for frame in shard)
+        macs = {prefilter.peer_bytes(f) for f in shard if prefilter.is_adv_report(f)}
+        for peer in macs:
+            seqs = [
+                f[prefilter.ADV_DATA_OFFSET + DF5_SEQ + 1]  # Low byte of sequence
+                for f in shard
+                if prefilter.is_adv_report(f) and prefilter.peer_bytes(f) == peer
+            ]
+            assert seqs == [0, 1, 2, 3]  # All frames of mac, in order
+    assert pool.shards[0][-1] == b"\x04\x0e\x04"
+    assert pool.shard({"mac": MACS[0]}) == pool.shard({"mac": MACS[0]})
+
+
+def test_workers_decode_all_frames():
+    config = ruuvi_config(2)
+    assert config.DECODER_WORKERS == 2
+    writers_q = Queue()
+    pool = run_decoder.DecoderPool(config, writers_q, 2)
+    pool.start()
+    for seq in range(10):
+        for mac in MACS:
+            pool.put(ruuvi_frame(mac, seq))
+        pool.flush()
+    assert pool.is_alive()
+    pool.stop()
+    assert sum(pool.counts) == 10 * len(MACS)
+    decoded = {}
+    while True:
+        try:
+            mesg = writers_q.get(timeout=1)
+        except queue.Empty:
+            break
+        decoded.setdefault(mesg["mac"], []).append(mesg["measurement_sequence_number"])
+    assert decoded == {mac: list(range(10)) for mac in MACS}
+
+
+def test_single_decoder_by_default():
+    config = Configuration()
+    assert config.DECODER_WORKERS == 0
+    decoder = run_decoder.make_decoder(config)
+    assert (
+        decoder.negative_cache_ttl
+        == defs.DEFAULT_CONFIG["common"]["negative_cache_ttl"]
+    )
+
+
+def test_adapters_and_times_passed_to_workers():
+    pool = run_decoder.DecoderPool(ruuvi_config(1), None, 1)
+    pool.queues = [queue.Queue()]
+    pool.put(ruuvi_frame(MACS[0], 1), 0)
+    pool.put(ruuvi_frame(MACS[0], 1), 1)
+    pool.flush()
+    pool.put(ruuvi_frame(MACS[1], 2))
+    pool.flush()
+    pool.put(ruuvi_frame(MACS[1], 3), None, 100.5)
+    pool.flush()
+    frames, adapters, times = pool.queues[0].get_nowait()
+    assert len(frames) == 2
+    assert (adapters, times) == ([0, 1], None)
+    assert pool.queues[0].get_nowait() == [ruuvi_frame(MACS[1], 2)]
+    assert pool.queues[0].get_nowait() == ([ruuvi_frame(MACS[1], 3)], None, [100.5])
+
+
+def test_adapter_added_to_message():
+    config = ruuvi_config(0)
+    decoder = run_decoder.make_decoder(config)
+    writers_q = queue.Queue()
+    run_decoder.decode_and_send(config, decoder, ruuvi_frame(MACS[0], 1), writers_q, 1)
+    run_decoder.decode_and_send(config, decoder, ruuvi_frame(MACS[0], 2), writers_q)
+    assert writers_q.get_nowait()["adapter"] == "hci1"
+    assert "adapter" not in writers_q.get_nowait()
+
+
+def test_batch_decode():
+    config = ruuvi_config(0)
+    assert not config.BATCH_DECODE
+    config.update_config({"common": {"batch_decode": True, "max_mesgs": 8}}, True)
+    writers_q = queue.Queue()
+    frame_decoder = run_decoder.FrameDecoder(config, writers_q, helpers.StopWatch())
+    frames = [ruuvi_frame(mac, seq) for seq in range(2) for mac in MACS]
+    adapters = list(range(len(frames)))
+    assert not frame_decoder.decode_batch(frames[:4], adapters[:4])
+    assert frame_decoder.decode_batch(frames[4:], adapters[4:])  # Max reached
+    mesgs = [writers_q.get_nowait() for i in range(8)]
+    assert writers_q.empty()
+    assert [(m["mac"], m["measurement_sequence_number"]) for m in mesgs] == [
+        (mac, seq) for seq in range(2) for mac in MACS
+    ][:8]
+    assert [m["adapter"] for m in mesgs] == ["hci{}".format(i) for i in range(8)]
+    assert frame_decoder.my_timer.get_count() == 8
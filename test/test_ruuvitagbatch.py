@@ -0,0 +1,105 @@
+import random
+
+import pytest
+
+from ble_gateway import decode, prefilter, ruuvitagbatch
+from ble_gateway.ruuvitagraw import RuuviTagRaw
+
+pytest.importorskip("numpy")
+
+# Test vectors from RuuviTag data format specifications (payload after 0x0499)
+PAYLOADS = [
+    "0512FC5394C37C0004FFFC040CAC364200CDCBB8334C884F",  # DF5 valid
+    "057FFFFFFEFFFE7FFF7FFF7FFFFFDEFEFFFECBB8334C884F",  # DF5 max
+    "058001000000008001800180010000000000CBB8334C884F",  # DF5 min
+    "058000FFFFFFFF800080008000FFFFFFFFFFCBB8334C884F",  # DF5 invalid
+    "03291A1ECE1EFC18F94202CA0B53",  # DF3 valid
+    "03FF7F63FFFF7FFF7FFF7FFFFFFF",  # DF3 max
+    "03FFFF630000800180018001FFFF",  # DF3 min
+]
+MAC = "c0:00:00:00:00:01"
+
+
+def ruuvi_frame(payload, rssi=-60, mac=MAC):
+    mfg = b"\x99\x04" + payload
+    data = bytes.fromhex("020106") + bytes([len(mfg) + 1, 0xFF]) + mfg
+    report = bytes([0x02, 1, 0x00, 0x01]) + prefilter.mac_to_bytes(mac)
+    report += bytes([len(data)]) + data + bytes([rssi & 0xFF])
+    return bytes([0x04, 0x3E, len(report)]) + report
+
+
+def random_frames(count, short=0.1, seed=1):
+    # Random DF3/DF5 payloads, share short of them too short
+    rnd = random.Random(seed)
+    frames = []
+    for i in range(count):
+        fmt = rnd.choice([3, 5])
+        length = 14 if fmt == 3 else 24
+        if rnd.random() < short:
+            length = rnd.randrange(1, 14 if fmt == 3 else 18)
+        payload = bytes([fmt]) + bytes(rnd.randrange(256) for i in range(length - 1))
+        frames.append(ruuvi_frame(payload, rnd.randrange(-100, 0)))
+    return frames
+
+
+def frames(short=0.1):
+    vectors = [ruuvi_frame(bytes.fromhex(p)) for p in PAYLOADS]
+    return vectors + random_frames(2000, short)
+
+
+def test_payload():
+    frame = ruuvi_frame(bytes.fromhex(PAYLOADS[0]))
+    assert bytes(ruuvitagbatch.ruuvi_payload(frame)) == bytes.fromhex(PAYLOADS[0])
+    apple = bytes.fromhex("020106") + bytes.fromhex("05ff4c000215")
+    report = bytes([0x02, 1, 0x00, 0x01]) + prefilter.mac_to_bytes(MAC)
+    report += bytes([len(apple)]) + apple + b"\xc0"
+    assert (
+        ruuvitagbatch.ruuvi_payload(bytes([0x04, 0x3E, len(report)]) + report) is None
+    )
+    assert ruuvitagbatch.ruuvi_payload(b"\x04\x0e\x04") is None
+
+
+def test_same_as_decode_frame():
+    ruuvi = RuuviTagRaw()
+    corpus = frames()
+    payloads = [ruuvitagbatch.ruuvi_payload(frame) for frame in corpus]
+    records = ruuvitagbatch.to_records(ruuvitagbatch.decode_batch(payloads))
+    assert len(records) == len(corpus)
+    for frame, record in zip(corpus, records):
+        decoded = ruuvi.decode_frame(frame)
+        if decoded is None:
+            assert record is None
+        else:
+            assert record == decoded[1]
+            assert list(record) == list(decoded[1])  # Same order of fields
+            assert [type(v) for v in record.values()] == [
+                type(v) for v in decoded[1].values()
+            ]
+
+
+def test_short_and_unknown_payloads():
+    payloads = [b"\x05" * 17, b"\x03" * 13, b"\x04" * 24, b""]
+    columns = ruuvitagbatch.decode_batch(payloads)
+    assert not columns["valid"].any()
+    assert ruuvitagbatch.to_records(columns) == [None] * 4
+    assert ruuvitagbatch.to_records(ruuvitagbatch.decode_batch([])) == []
+
+
+def test_decoder_run_batch():
+    decoder = decode.Decoder()
+    expected = decode.Decoder()  # Decodes one frame at a time
+    for d in (decoder, expected):
+        d.enable_fixed_decoders(["ruuviraw", "unknown"])
+    corpus = frames(short=0)
+    apple = bytes.fromhex("020106") + bytes.fromhex("05ff4c000215")
+    report = bytes([0x02, 1, 0x00, 0x01]) + prefilter.mac_to_bytes(MAC)
+    report += bytes([len(apple)]) + apple + b"\xc0"
+    corpus[10:10] = [bytes([0x04, 0x3E, len(report)]) + report, memoryview(corpus[0])]
+    mesgs = decoder.run_batch(corpus)
+    assert len(mesgs) == len(corpus)
+    for frame, mesg in zip(corpus, mesgs):
+        if isinstance(frame, memoryview):
+            frame = frame.tobytes()
+        assert mesg == expected.run(frame)
+    assert decoder.fast_count == sum(m["decoder"] == "ruuviraw" for m in mesgs)
+    assert decoder.pinned == {MAC: "ruuviraw"}
@@ -0,0 +1,101 @@
+import random
+
+import aioblescan as aiobs
+import pytest
+
+from ble_gateway import prefilter
+from ble_gateway.ruuvitagraw import RuuviTagRaw
+
+MAC = "c0:00:00:00:00:01"
+# Test vectors from RuuviTag data format specifications (payload after 0x0499)
+PAYLOADS = {
+    "df5 valid": "0512FC5394C37C0004FFFC040CAC364200CDCBB8334C884F",
+    "df5 max": "057FFFFFFEFFFE7FFF7FFF7FFFFFDEFEFFFECBB8334C884F",
+    "df5 min": "058001000000008001800180010000000000CBB8334C884F",
+    "df5 invalid": "058000FFFFFFFF800080008000FFFFFFFFFFCBB8334C884F",
+    "df5 -1.0 C": "05FF385394C37C0004FFFC040CAC364200CDCBB8334C884F",
+    "df5 no tx power": "0512FC5394C37C0004FFFC040CAC3F4200CDCBB8334C884F",
+    "df3 valid": "03291A1ECE1EFC18F94202CA0B53",
+    "df3 max": "03FF7F63FFFF7FFF7FFF7FFFFFFF",
+    "df3 min": "03FFFF630000800180018001FFFF",
+    "df3 -1.05 C": "03298105CE1EFC18F94202CA0B53",
+}
+
+
+def ruuvi_frame(payload, rssi=-60):
+    mfg = b"\x99\x04" + payload
+    data = bytes.fromhex("020106") + bytes([len(mfg) + 1, 0xFF]) + mfg
+    report = bytes([0x02, 1, 0x00, 0x01]) + prefilter.mac_to_bytes(MAC)
+    report += bytes([len(data)]) + data + bytes([rssi & 0xFF])
+    return bytes([0x04, 0x3E, len(report)]) + report
+
+
+def baseline(frame):
+    # Decoded by aioblescan and RuuviTagRaw.decode(), as without fast path
+    ev = aiobs.HCI_Event()
+    ev.decode(frame)
+    result = RuuviTagRaw().decode(ev)
+    if result is None:
+        return None
+    return ev.retrieve("rssi")[-1].val, result
+
+
+def assert_same(frame):
+    expected = baseline(frame)
+    got = RuuviTagRaw().decode_frame(memoryview(frame))
+    assert got == expected
+    if got is not None:
+        assert list(got[1]) == list(expected[1])  # Same order of fields
+        assert [type(v) for v in got[1].values()] == [
+            type(v) for v in expected[1].values()
+        ]
+    return got
+
+
+@pytest.mark.parametrize("name", PAYLOADS)
+def test_test_vectors(name):
+    assert assert_same(ruuvi_frame(bytes.fromhex(PAYLOADS[name]))) is not None
+
+
+def test_decoded_values():
+    rssi, df5 = assert_same(ruuvi_frame(bytes.fromhex(PAYLOADS["df5 valid"]), -70))
+    assert rssi == -70
+    assert df5["temperature"] == 24.3
+    assert df5["humidity"] == 53.5
+    assert df5["pressure"] == 1000.44
+    assert (df5["movement_counter"], df5["measurement_sequence_number"]) == (66, 205)
+    assert (df5["battery"], df5["tx_power"]) == (2.98, 4)
+    df5 = assert_same(ruuvi_frame(bytes.fromhex(PAYLOADS["df5 invalid"])))[1]
+    assert (df5["battery"], df5["tx_power"]) == (None, None)
+    assert df5["movement_counter"] == 255
+    df5 = assert_same(ruuvi_frame(bytes.fromhex(PAYLOADS["df5 no tx power"])))[1]
+    assert df5["battery"] is not None and df5["tx_power"] is None
+    assert (
+        assert_same(ruuvi_frame(bytes.fromhex(PAYLOADS["df5 -1.0 C"])))[1][
+            "temperature"
+        ]
+        == -1.0
+    )
+    df3 = assert_same(ruuvi_frame(bytes.fromhex(PAYLOADS["df3 -1.05 C"])))[1]
+    assert df3["temperature"] == -1.05
+
+
+@pytest.mark.parametrize("name", ["df3 valid", "df5 valid"])
+def test_short_payloads(name):
+    payload = bytes.fromhex(PAYLOADS[name])
+    size = 14 if payload[0] == 3 else 18  # Bytes of the format's fields
+    for length in range(1, size):
+        assert assert_same(ruuvi_frame(payload[:length])) is None
+    assert assert_same(ruuvi_frame(payload[:size])) is not None
+
+
+def test_other_formats():
+    assert assert_same(ruuvi_frame(bytes.fromhex("04" + "00" * 20))) is None
+
+
+def test_random_payloads():
+    rnd = random.Random(1)
+    for i in range(2000):
+        fmt = rnd.choice([3, 5])
+        payload = bytes([fmt]) + bytes(rnd.randrange(256) for i in range(23))
+        assert_same(ruuvi_frame(payload[: 14 if fmt == 3 else 24]))
@@ -0,0 +1,125 @@
+import threading
+import time
+
+from ble_gateway.spool import Spool
+
+
+def replay(spool, max_records=100):
+    records, position = spool.read(max_records)
+    spool.commit(position)
+    return records
+
+
+def test_append_read_commit(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=4096)
+    spool.append(["a 1", "a 2"])
+    spool.append(["b 1"])
+    assert spool.pending() == 3
+    records, position = spool.read(100)
+    assert records == ["a 1", "a 2", "b 1"]
+    assert spool.pending() == 3  # Not committed yet
+    spool.commit(position)
+    assert spool.pending() == 0
+    assert spool.read(100)[0] == []
+    assert spool.stats["replayed"] == 3
+
+
+def test_read_max_records_keeps_batches_whole(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=4096)
+    spool.append(["a 1", "a 2"])
+    spool.append(["b 1", "b 2"])
+    assert replay(spool, 3) == ["a 1", "a 2"]
+    assert replay(spool, 1) == ["b 1", "b 2"]  # At least one batch
+    assert spool.pending() == 0
+
+
+def test_rotate_after_replay_does_not_resend(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=64)
+    spool.append(["x" * 20])
+    assert replay(spool) == ["x" * 20]
+    spool.append(["y" * 20])  # Rotates, nothing pending
+    spool.append(["z" * 20])  # Rotates again
+    assert spool.pending() == 2
+    assert replay(spool) == ["y" * 20, "z" * 20]
+    assert spool.pending() == 0
+    assert spool.stats["replayed"] == 3
+    spool.append(["w" * 20])
+    assert spool.pending() == 1
+    assert replay(spool) == ["w" * 20]
+    assert spool.pending() == 0
+    spool.close()
+
+
+def test_rotate_read_commit_reopen(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=64)
+    for i in range(4):
+        spool.append(["record {} ".format(i) + "x" * 20])
+    assert len(spool.segments) > 1
+    assert replay(spool, 1) == ["record 0 " + "x" * 20]
+    spool.close()
+
+    spool = Spool(str(tmp_path), segment_size=64)
+    assert spool.pending() == 3
+    assert replay(spool, 2) == ["record 1 " + "x" * 20, "record 2 " + "x" * 20]
+    spool.close()
+
+    spool = Spool(str(tmp_path), segment_size=64)
+    assert spool.pending() == 1
+    assert replay(spool) == ["record 3 " + "x" * 20]
+    assert spool.pending() == 0
+    spool.append(["after reopen"])
+    assert replay(spool) == ["after reopen"]
+    spool.close()
+
+    spool = Spool(str(tmp_path), segment_size=64)
+    assert spool.pending() == 0
+    assert spool.read(100)[0] == []
+
+
+def test_uncommitted_read_is_replayed_again(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=4096)
+    spool.append(["a"])
+    assert spool.read(100)[0] == ["a"]  # Write failed, no commit
+    spool.close()
+    spool = Spool(str(tmp_path), segment_size=4096)
+    assert replay(spool) == ["a"]
+
+
+def test_full_spool_drops_oldest(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=64, max_bytes=3 * 64)
+    for i in range(6):
+        spool.append(["{}".format(i) * 30])
+    assert spool.stats["dropped"] > 0
+    assert spool.pending() + spool.stats["dropped"] == 6
+    records = replay(spool)
+    assert records == ["{}".format(i) * 30 for i in range(6 - len(records), 6)]
+    assert spool.pending() == 0
+
+
+def test_lag(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=4096)
+    assert spool.lag() == 0.0
+    spool.append(["a"])
+    assert 9 < spool.lag(time.time() + 10) < 11
+
+
+def test_pending_while_appending_from_threads(tmp_path):
+    # Rotation adds segments while pending() is asked from another thread
+    spool = Spool(str(tmp_path), segment_size=256, fsync=False)
+    threads = [
+        threading.Thread(target=lambda: [spool.append(["x" * 20]) for i in range(100)])
+        for t in range(4)
+    ]
+    for t in threads:
+        t.start()
+    while any(t.is_alive() for t in threads):
+        assert 0 <= spool.pending() <= 400
+    for t in threads:
+        t.join()
+    assert spool.pending() == 400 == sum(spool._counts.values())
+    while spool.pending():
+        replay(spool, 70)
+        assert spool.pending() == sum(spool._counts.values())
+    assert spool.stats["replayed"] == 400
+    spool.close()
+    assert Spool(str(tmp_path), segment_size=256).pending() == 0
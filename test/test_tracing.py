@@ -0,0 +1,78 @@
+import pytest
+
+from ble_gateway import tracing, writers
+from ble_gateway.config_management import Configuration
+
+MAC = "cb:b8:33:4c:88:4f"
+
+
+def test_times_carried_in_message():
+    mesg = {"mac": MAC, "temperature": 24.3}
+    tracing.stamp(mesg, 100.0, 100.5)
+    assert mesg[tracing.RECEIVED] == 100.0
+    assert mesg[tracing.DEQUEUED] == 100.5
+    assert mesg[tracing.DECODED] >= 100.5
+    received, dequeued, decoded = tracing.take(mesg)
+    assert (received, dequeued) == (100.0, 100.5)
+    assert mesg == {"mac": MAC, "temperature": 24.3}
+    assert tracing.take(mesg) == (None, None, None)
+
+
+def test_stage_latencies():
+    tracer = tracing.Tracer()
+    trace = tracer.begin((100.0, 100.002, 100.003), now=100.010)
+    assert trace == (100.0, 100.010)
+    tracer.begin((None, None, None), now=101.0)  # Not traced, e.g. simulator
+    tracer.acknowledge("influx", [trace, None], now=100.110)
+    ms = {
+        stage: round(seconds * 1000, 1)
+        for stage, seconds in tracer.percentiles(100).items()
+    }
+    assert ms == {
+        "to_decoder": 2.0,
+        "decode": 1.0,
+        "to_writers": 7.0,
+        "writer:influx": 100.0,
+        "total:influx": 110.0,
+    }
+    assert tracer.histograms["to_decoder"].count == 1
+    assert tracing.stage_names(["influx"]) == list(tracing.STAGES) + [
+        "writer:influx",
+        "total:influx",
+    ]
+
+
+def test_file_writer_acknowledges_written_batch(tmp_path):
+    tracer = tracing.Tracer()
+    writer = writers.FileWriter(
+        "log", {"filename": str(tmp_path / "log.txt"), "batch": 3}
+    )
+    writer.enable_tracing(tracer)
+    for i in range(5):
+        writer.send({"mac": MAC, "timestamp": 0, "i": i}, trace=(0.0, 0.0))
+    assert tracer.histograms["writer:log"].count == 3  # One batch written
+    writer.close()
+    assert tracer.histograms["total:log"].count == 5
+
+
+def test_writers_without_acks_ignore_traces():
+    tracer = tracing.Tracer()
+    writer = writers.DropWriter("drop", {})
+    writer.enable_tracing(tracer)
+    writer.send({"mac": MAC}, trace=(0.0, 0.0))
+    assert writer.traces is None
+    assert set(tracer.histograms) == set(tracing.STAGES)
+
+
+@pytest.mark.parametrize(
+    "common, receive_times",
+    [
+        ({}, False),
+        ({"trace": True}, True),
+        ({"timestamp_source": "received"}, True),
+    ],
+)
+def test_reception_times_carried_when_needed(common, receive_times):
+    config = Configuration()
+    config.update_config({"common": common}, True)
+    assert config.RECEIVE_TIMES is receive_times
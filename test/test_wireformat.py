@@ -0,0 +1,122 @@
+import queue
+
+import pytest
+
+from ble_gateway.measurement import Measurement
+from ble_gateway.wireformat import WireReader, WireWriter, is_registration
+
+MAC = "cb:b8:33:4c:88:4f"
+RUUVI = {
+    "decoder": "ruuviraw",
+    "rssi": -70,
+    "mac": MAC,
+    "data_format": 5,
+    "temperature": 24.3,
+    "humidity": 53.49,
+    "pressure": 1000.44,
+    "movement_counter": 66,
+    "measurement_sequence_number": 205,
+    "battery": 2.977,
+    "tx_power": 4,
+}
+
+
+def received(q):
+    # Messages as writers process reads them from writers_q
+    reader = WireReader()
+    messages = []
+    while not q.empty():
+        item = q.get_nowait()
+        if is_registration(item):
+            reader.register(item)
+        elif isinstance(item, bytes):
+            messages.append(reader.unpack(item))
+        else:
+            messages.append(item)
+    return messages
+
+
+def test_ruuvi_messages():
+    q = queue.Queue()
+    writer = WireWriter(q)
+    sent = []
+    for seq in range(5):
+        mesg = Measurement.from_dict(dict(RUUVI, measurement_sequence_number=seq))
+        writer.put(mesg)
+        sent.append(mesg)
+    assert q.qsize() == 6  # Layout sent once
+    messages = received(q)
+    assert messages == sent
+    assert [list(m) for m in messages] == [list(RUUVI)] * 5
+    assert writer.packed == 5
+    assert writer.pickled == 0
+
+
+@pytest.mark.parametrize(
+    "value",
+    [0, -1, 2**31 - 1, -(2**31), 2**31, -(2**40), 2**63 - 1, 2**64],
+)
+def test_integer_range(value):
+    q = queue.Queue()
+    mesg = Measurement.from_dict({"mac": MAC, "value": value})
+    WireWriter(q).put(mesg)
+    (out,) = received(q)
+    assert out == mesg
+    assert type(out["value"]) is int
+
+
+@pytest.mark.parametrize(
+    "fields",
+    [
+        {"name": "Sauna ääkköset", "empty": ""},
+        {"moving": True, "battery": None, "temperature": -12.5},
+        {"mac": "CB:B8:33:4C:88:4F"},  # Not in header, wouldn't decode back
+        {"mac": "cb-b8-33-4c-88-4f"},
+        {"mac": None},
+        {},
+    ],
+)
+def test_value_types(fields):
+    q = queue.Queue()
+    mesg = Measurement.from_dict(dict({"mac": MAC}, **fields))
+    WireWriter(q).put(mesg)
+    assert received(q) == [mesg]
+
+
+def test_other_messages_are_pickled():
+    q = queue.Queue()
+    writer = WireWriter(q)
+    messages = [
+        dict(RUUVI),  # Not a Measurement, e.g. from simulator
+        Measurement.from_dict({"mac": MAC, "values": [1, 2, 3]}),
+        Measurement.from_dict({"mac": MAC, "big": 2**64}),
+    ]
+    for mesg in messages:
+        writer.put(mesg)
+    assert received(q) == messages
+    assert (writer.packed, writer.pickled) == (0, 3)
+
+
+def test_several_producers():
+    q = queue.Queue()
+    workers = [WireWriter(q, producer) for producer in range(3)]
+    for i, writer in enumerate(workers):
+        writer.put(Measurement.from_dict({"mac": MAC, "worker": i}))
+        writer.put(Measurement.from_dict({"mac": MAC, "name": str(i)}))
+    assert received(q) == [
+        m
+        for i in range(3)
+        for m in ({"mac": MAC, "worker": i}, {"mac": MAC, "name": str(i)})
+    ]
+
+
+def test_mac_of_packed_message():
+    q = queue.Queue()
+    writer = WireWriter(q)
+    writer.put(Measurement.from_dict(RUUVI))
+    writer.put(Measurement.from_dict({"mac": "unknown", "x": 1}))
+    reader = WireReader()
+    reader.register(q.get_nowait())
+    assert reader.mac(q.get_nowait()) == MAC
+    reader.register(q.get_nowait())
+    assert reader.mac(q.get_nowait()) == "unknown"
@@ -0,0 +1,541 @@
+import gzip
+import http.server
+import threading
+import time
+import urllib.parse
+
+import pytest
+
+from ble_gateway import writers
+from ble_gateway.measurement import Measurement, as_dict
+from ble_gateway.writers import (
+    InfluxDBHTTPWriter,
+    MessageBuffer,
+    TransformPlan,
+    Writer,
+    Writers,
+    WriterWorker,
+    estimate_size,
+)
+
+
+class FakeInflux(http.server.BaseHTTPRequestHandler):
+    status = 204
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append((self.path, dict(self.headers), body))
+        self.send_response(self.server.status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def influx():
+    server = http.server.HTTPServer(("127.0.0.1", 0), FakeInflux)
+    server.status = 204
+    server.requests = []  # (path, headers, body) of each request
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class RecordingWriter(Writer):
+    # Keeps sent messages, blocks while blocked is set
+    def configure(self, wconfig):
+        self.messages = []
+        self.blocked = threading.Event()
+
+    def send(self, mesg, plan=None, trace=None):
+        while self.blocked.is_set():
+            time.sleep(0.001)
+        self.messages.append(mesg)
+
+
+def wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end:
+        time.sleep(0.001)
+    return condition()
+
+
+def http_writer(influx, tmp_path):
+    return InfluxDBHTTPWriter(
+        "influx",
+        {
+            "url": "http://127.0.0.1:{}".format(influx.server_port),
+            "spool": {"directory": str(tmp_path)},
+        },
+    )
+
+
+@pytest.mark.parametrize(
+    "status, written, spooled",
+    [(204, True, 0), (503, False, 1), (429, False, 1), (400, None, 0), (404, None, 0)],
+)
+def test_http_status_decides_spooling(influx, tmp_path, status, written, spooled):
+    influx.status = status
+    writer = http_writer(influx, tmp_path)
+    assert writer._write_records(["m a=1 1"]) is written
+    writer._send_lines(["m a=1 1"])
+    assert writer.spool.pending() == spooled
+    writer.close()
+
+
+def posted(influx):
+    # Path, query, headers and body of the only request to server
+    assert len(influx.requests) == 1
+    path, headers, body = influx.requests[0]
+    url = urllib.parse.urlsplit(path)
+    return url.path, dict(urllib.parse.parse_qsl(url.query)), headers, body
+
+
+def test_http_v1_request(influx):
+    writer = InfluxDBHTTPWriter(
+        "influx",
+        {
+            "url": "http://127.0.0.1:{}".format(influx.server_port),
+            "database": "ble",
+            "username": "user",
+            "password": "secret",
+        },
+    )
+    assert writer._write_records(["m a=1 1", "m a=2 2"])
+    path, query, headers, body = posted(influx)
+    assert path == "/write"
+    assert query == {"db": "ble", "precision": "ms", "u": "user", "p": "secret"}
+    assert headers["Content-Encoding"] == "gzip"
+    assert "Authorization" not in headers
+    assert gzip.decompress(body) == b"m a=1 1\nm a=2 2"
+    writer.close()
+
+
+def test_http_v2_request(influx):
+    writer = InfluxDBHTTPWriter(
+        "influx",
+        {
+            "url": "http://127.0.0.1:{}/influx/".format(influx.server_port),
+            "version": 2,
+            "org": "home",
+            "bucket": "ble/raw",
+            "token": "abc==",
+        },
+    )
+    assert writer._write_records(["m a=1 1"])
+    path, query, headers, body = posted(influx)
+    assert path == "/influx/api/v2/write"
+    assert query == {"org": "home", "bucket": "ble/raw", "precision": "ms"}
+    assert headers["Authorization"] == "Token abc=="
+    assert headers["Content-Encoding"] == "gzip"
+    assert headers["Content-Type"] == "text/plain; charset=utf-8"
+    assert gzip.decompress(body) == b"m a=1 1"
+    writer.close()
+
+
+def test_http_uncompressed_batch_of_messages(influx):
+    writer = InfluxDBHTTPWriter(
+        "influx",
+        {
+            "url": "http://127.0.0.1:{}".format(influx.server_port),
+            "gzip": False,
+            "measurement": "ruuvi",
+            "tags": ["mac"],
+            "batch": 2,
+        },
+    )
+    for i in range(2):
+        writer.send(
+            {"mac": "c0:01", "temperature": 20.5 + i, "timestamp": 1600000000 + i}
+        )
+    writer.close()  # Waits for batches in flight
+    path, query, headers, body = posted(influx)
+    assert "Content-Encoding" not in headers
+    assert body == (
+        b"ruuvi,mac=c0:01 temperature=20.5 1600000000000\n"
+        b"ruuvi,mac=c0:01 temperature=21.5 1600000001000"
+    )
+    assert writer.stats["points"] == 2
+
+
+def test_rejected_batch_is_removed_from_spool(influx, tmp_path):
+    writer = http_writer(influx, tmp_path)
+    writer.spool.append(["bad line"])
+    influx.status = 400
+    writer.replay_spool()
+    assert writer.spool.pending() == 0
+    assert writer.stats["rejected"] == 1
+    writer.close()
+
+
+def test_workers_only_for_routed_destinations(tmp_path):
+    destinations = Writers()
+    destinations.add_writers(
+        {
+            "log": {"type": "file", "filename": str(tmp_path / "log.txt")},
+            "unrouted": {"type": "file", "filename": str(tmp_path / "other.txt")},
+            "DROP": {"type": "DROP"},
+            "SCAN": {"type": "SCAN"},
+        }
+    )
+    destinations.setup_routing({"*": {"destinations": ["log", "DROP"]}})
+    assert isinstance(destinations.all_writers["log"], WriterWorker)
+    assert not isinstance(destinations.all_writers["unrouted"], WriterWorker)
+    assert not isinstance(destinations.all_writers["DROP"], WriterWorker)
+    assert not isinstance(destinations.all_writers["SCAN"], WriterWorker)
+    destinations.close()
+
+
+def test_slow_destination_does_not_stall_others():
+    slow = WriterWorker(RecordingWriter("slow"), inbox_size=2)
+    fast = WriterWorker(RecordingWriter("fast"))
+    slow.writer.blocked.set()
+    slow.send({"mac": "m", "n": 0})
+    assert wait_for(lambda: slow.inbox.empty())  # Taken by blocked thread
+    for n in range(10):
+        slow.send({"mac": "m", "n": n + 1})
+        fast.send({"mac": "m", "n": n})
+    assert wait_for(lambda: len(fast.writer.messages) == 10)
+    assert slow.writer.messages == []
+    # Inbox holds 2 messages, the rest are dropped and counted
+    assert slow.stats()["dropped"] == 8
+    assert slow.stats()["max_depth"] == 2
+    assert fast.stats()["dropped"] == 0
+    slow.writer.blocked.clear()
+    slow.close()
+    fast.close()
+    assert [m["n"] for m in slow.writer.messages] == [0, 1, 2]
+
+
+def test_time_to_flush_capped_when_all_writers_are_threaded(tmp_path):
+    destinations = Writers()
+    destinations.add_writers(
+        {"log": {"type": "file", "filename": str(tmp_path / "log.txt")}}
+    )
+    destinations.setup_routing({"*": {"destinations": ["log"]}})
+    assert isinstance(destinations.all_writers["log"], WriterWorker)
+    assert destinations.time_to_flush() is None
+    assert destinations.time_to_flush(max_wait=1.0) == 1.0
+    destinations.close()
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class BatchWriter(Writer):
+    # Keeps written batches
+    type = "test_batch"
+
+    def configure(self, wconfig):
+        self.batches = []
+
+    def _process_buffer(self):
+        if self.buffer.is_batch_ready():
+            mesgs = []
+            while not self.buffer.empty():
+                mesgs.append(self.buffer.get())
+            self.batches.append([m["n"] for m in mesgs])
+
+
+def test_buffer_ready_by_size_and_bytes():
+    buffer = MessageBuffer(3, max_bytes=50)
+    mesg = {"mac": "m", "n": 1}  # estimate_size() = 10
+    assert estimate_size(mesg) == 10
+    for i in range(2):
+        buffer.put(mesg)
+    assert not buffer.is_batch_ready()
+    buffer.put(mesg)
+    assert buffer.is_batch_ready()  # batch_size
+
+    buffer = MessageBuffer(100, max_bytes=50)
+    for i in range(4):
+        buffer.put(mesg)
+    assert (buffer.nbytes(), buffer.is_batch_ready()) == (40, False)
+    buffer.put(mesg)
+    assert (buffer.nbytes(), buffer.is_batch_ready()) == (50, True)
+    while not buffer.empty():
+        buffer.get()
+    assert (buffer.nbytes(), buffer.deadline()) == (0, None)
+
+
+def test_buffer_ready_by_latency(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(writers.time, "monotonic", clock)
+    buffer = MessageBuffer(100, max_latency=2)
+    assert buffer.deadline() is None
+    buffer.put({"mac": "m", "n": 1})
+    clock.now += 1
+    buffer.put({"mac": "m", "n": 2})
+    assert buffer.deadline() == 1002  # Oldest message decides
+    assert not buffer.is_batch_ready(1001.9)
+    assert buffer.is_batch_ready(1002)
+    buffer.restart_deadline(1003)
+    assert buffer.deadline() == 1005
+    buffer.get()
+    assert buffer.deadline() == 1005
+    buffer.get()
+    assert buffer.deadline() is None
+    assert MessageBuffer(100).deadline() is None  # No max_latency
+
+
+@pytest.mark.parametrize(
+    "wconfig, expected",
+    [
+        ({}, (1, 0, 0)),
+        ({"batch": 5}, (5, 0, 0)),
+        ({"batch": 5, "max_latency": 3, "max_bytes": 100}, (5, 3, 100)),
+        ({"batch": {"size": 5, "max_latency": 1}, "max_latency": 3}, (5, 1, 0)),
+        ({"batch": {"max_bytes": 10}}, (1, 0, 10)),
+        ({"batch": -1, "max_latency": "x", "max_bytes": -5}, (1, 0, 0)),
+    ],
+)
+def test_buffer_from_config(wconfig, expected):
+    buffer = MessageBuffer.from_config(wconfig)
+    assert (buffer.batch_size, buffer.max_latency, buffer.max_bytes) == expected
+
+
+def test_writer_flushes_when_bytes_or_deadline_reached(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(writers.time, "monotonic", clock)
+    writer = BatchWriter("w", {"batch": 100, "max_latency": 5, "max_bytes": 30})
+    for n in range(3):
+        writer.send({"mac": "m", "n": n})  # Flushed by size of 3 messages
+    assert writer.batches == [[0, 1, 2]]
+    writer.send({"mac": "m", "n": 3})
+    clock.now += 1
+    writer.send({"mac": "m", "n": 4})
+    assert writer.deadline() == 1005
+    clock.now = 1004.9
+    writer.flush_if_due()
+    assert writer.batches == [[0, 1, 2]]
+    clock.now = 1005
+    writer.flush_if_due()
+    assert writer.batches == [[0, 1, 2], [3, 4]]
+    assert writer.deadline() is None
+
+
+def test_time_to_flush_of_several_writers(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(writers.time, "monotonic", clock)
+    destinations = Writers()
+    destinations.add_writers(
+        {
+            "slow": {"type": "test_batch", "batch": 10, "max_latency": 5},
+            "fast": {"type": "test_batch", "batch": 10, "max_latency": 2},
+            "unbuffered": {"type": "test_batch"},
+        }
+    )
+    for name in ("slow", "fast", "unbuffered"):
+        destinations.all_writers[name].threaded = False
+    destinations.inbox_sizes = {}  # All writers in this thread
+    destinations.setup_routing({"*": {"destinations": ["slow", "fast", "unbuffered"]}})
+    assert destinations.time_to_flush() is None
+    destinations.send({"mac": "m", "n": 1})
+    assert destinations.time_to_flush(now=1000.5) == 1.5
+    assert destinations.time_to_flush(now=1000.5, max_wait=1) == 1
+    assert destinations.time_to_flush(now=1010) == 0  # Overdue
+    clock.now = 1002
+    destinations.flush_due()
+    assert destinations.all_writers["fast"].batches == [[1]]
+    assert destinations.all_writers["slow"].batches == []
+    assert destinations.time_to_flush() == 3.0
+    clock.now = 1005
+    destinations.flush_due()
+    assert destinations.all_writers["slow"].batches == [[1]]
+    assert destinations.time_to_flush(max_wait=1) == 1
+    assert destinations.all_writers["unbuffered"].batches == [[1]]
+
+
+def legacy_modify_packet(mesg, mconfig):
+    # Per-packet modifications as they were done before TransformPlan
+    for f in mconfig.get("fields_remove", []):
+        if f in mesg:
+            mesg.pop(f)
+    for f in mconfig.get("fields_rename", []):
+        (t, v) = f.split("=")
+        if t and v and t in mesg:
+            mesg[v] = mesg.pop(t)
+    for f in mconfig.get("fields_add", []):
+        (t, v) = f.split("=")
+        if t and v:
+            mesg[t] = v
+    for f in mconfig.get("values_uppercase", []):
+        if f in mesg and isinstance(mesg[f], str):
+            mesg[f] = mesg[f].upper()
+    ordered_fields = {}
+    for f in mconfig.get("fields_order", []):
+        if f in mesg:
+            ordered_fields[f] = mesg.pop(f)
+    return {**ordered_fields, **mesg}
+
+
+TRANSFORMS = [
+    {},
+    {"fields_remove": ["rssi", "missing", "timestamp"]},
+    {"fields_rename": ["temperature=temp", "missing=x", "rssi=humidity"]},
+    {"fields_add": ["location=Ulkona", "rssi=-1", "decoder=x"]},
+    {"values_uppercase": ["mac", "rssi", "location"]},
+    {"fields_order": ["timestamp", "temperature", "missing", "mac"]},
+    {
+        "fields_remove": ["decoder"],
+        "fields_rename": ["mac=MAC", "temperature=t"],
+        "fields_add": ["location=Sauna", "mac=added"],
+        "values_uppercase": ["MAC", "mac", "location"],
+        "fields_order": ["location", "t", "timestamp"],
+    },
+]
+MESSAGES = [
+    {
+        "decoder": "ruuviraw",
+        "rssi": -64,
+        "mac": "c0:00:00:00:00:01",
+        "temperature": 24.3,
+        "humidity": 53.5,
+        "timestamp": 1600000000.5,
+    },
+    {"decoder": "unknown", "mac": "c0:00:00:00:00:02", "timestamp": 1600000001.0},
+]
+
+
+@pytest.mark.parametrize("source", TRANSFORMS)
+@pytest.mark.parametrize("destination", TRANSFORMS[::-1])
+def test_transform_plan_same_as_legacy(source, destination):
+    plan = TransformPlan(source) + TransformPlan(destination)
+    for mesg in MESSAGES:
+        expected = legacy_modify_packet(
+            legacy_modify_packet(dict(mesg), source), destination
+        )
+        for original in (dict(mesg), Measurement.from_dict(mesg)):
+            got = plan.apply_to_copy(original)
+            assert as_dict(got) == expected
+            assert list(got) == list(expected)  # Same order of fields
+            assert as_dict(original) == mesg  # Copy was modified
+            # Plans compiled for the schema give the same result again
+            assert list(plan.apply_to_copy(original).items()) == list(expected.items())
+
+
+def test_routes_apply_source_and_destination_transforms():
+    destinations = Writers()
+    destinations.add_writers({"log": {"type": "test_batch", **TRANSFORMS[3]}})
+    destinations.inbox_sizes = {}
+    destinations.setup_routing(
+        {
+            "c0:00:00:00:00:01": {"destinations": ["log"], **TRANSFORMS[6]},
+            "*": {"destinations": ["log"]},
+        }
+    )
+    writer = destinations.all_writers["log"]
+    sent = []
+    writer.buffer.put = sent.append
+    for mesg in MESSAGES:
+        destinations.send(Measurement.from_dict(mesg))
+    assert [list(as_dict(m).items()) for m in sent] == [
+        list(
+            legacy_modify_packet(
+                legacy_modify_packet(dict(mesg), source), TRANSFORMS[3]
+            ).items()
+        )
+        for mesg, source in zip(MESSAGES, (TRANSFORMS[6], {}))
+    ]
+
+
+def file_writer(tmp_path, **wconfig):
+    wconfig.setdefault("filename", str(tmp_path / "log"))
+    return writers.FileWriter("log", wconfig)
+
+
+def write_batches(writer, batches):
+    for batch in batches:
+        for n in batch:
+            writer.send({"mac": "c0:01", "timestamp": 1600000000 + n, "n": n})
+
+
+def test_file_writer_jsonl(tmp_path):
+    writer = file_writer(tmp_path, format="jsonl", batch=2)
+    write_batches(writer, [[0, 1], [2, 3], [4]])
+    writer.close()
+    assert (tmp_path / "log").read_text() == "".join(
+        '{{"mac":"c0:01","timestamp":{},"n":{}}}\n'.format(1600000000 + n, n)
+        for n in range(5)
+    )
+
+
+def test_file_writer_csv(tmp_path):
+    writer = file_writer(tmp_path, format="csv", batch=2)
+    write_batches(writer, [[0, 1], [2, 3]])
+    writer.send({"mac": "c0:02", "n": 4, "extra": 1})  # Missing and extra keys
+    writer.close()
+    lines = ["mac,timestamp,n"] + [
+        "c0:01,{},{}".format(1600000000 + n, n) for n in range(4)
+    ]
+    assert (tmp_path / "log").read_text() == "\n".join(lines + ["c0:02,,4\n"])
+
+    # Appending to existing file keeps its columns and does not repeat header
+    writer = file_writer(tmp_path, format="csv", columns=["n", "mac"])
+    assert writer.columns == ["n", "mac"]
+    writer.close()
+    writer = file_writer(tmp_path, format="csv")
+    assert writer.columns == ["mac", "timestamp", "n"]
+    write_batches(writer, [[5]])
+    writer.close()
+    assert (tmp_path / "log").read_text().splitlines()[-2:] == [
+        "c0:02,,4",
+        "c0:01,1600000005,5",
+    ]
+
+
+def rotated_files(tmp_path):
+    return sorted(p.name for p in tmp_path.iterdir() if p.name != "log")
+
+
+def test_file_writer_rotates_by_size(tmp_path):
+    writer = file_writer(tmp_path, format="jsonl", rotate_bytes=100)
+    write_batches(writer, [[0], [1], [2], [3]])  # 45 bytes per line
+    writer.close()
+    rotated = rotated_files(tmp_path)
+    assert len(rotated) == 1
+    assert len((tmp_path / rotated[0]).read_text().splitlines()) == 3
+    assert '"n":3' in (tmp_path / "log").read_text()
+
+
+def test_file_writer_rotates_by_age(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(writers.time, "time", clock)
+    writer = file_writer(tmp_path, format="jsonl", rotate_secs=60)
+    write_batches(writer, [[0], [1]])
+    clock.now += 60
+    write_batches(writer, [[2]])
+    clock.now += 59
+    write_batches(writer, [[3]])
+    clock.now += 1
+    write_batches(writer, [[4]])
+    writer.close()
+    rotated = rotated_files(tmp_path)
+    assert len(rotated) == 2
+    contents = [(tmp_path / name).read_text().count("\n") for name in rotated]
+    assert sorted(contents) == [2, 2]  # n 0, 1 and 2, 3
+    assert '"n":4' in (tmp_path / "log").read_text()
+
+
+def test_file_writer_compresses_rotated_files(tmp_path):
+    writer = file_writer(tmp_path, format="jsonl", rotate_bytes=1, compress=True)
+    write_batches(writer, [[0], [1], [2]])
+    writer.close()  # Waits for compression to finish
+    rotated = rotated_files(tmp_path)
+    assert len(rotated) == 2
+    assert all(name.endswith(".gz") for name in rotated)
+    lines = [
+        gzip.decompress((tmp_path / name).read_bytes()).decode() for name in rotated
+    ]
+    assert sorted(lines) == [
+        '{"mac":"c0:01","timestamp":1600000000,"n":0}\n',
+        '{"mac":"c0:01","timestamp":1600000001,"n":1}\n',
+    ]